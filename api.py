@@ -0,0 +1,360 @@
+"""Read-only JSON API for Warbler, mounted at /api/v1.
+
+Every endpoint selects only the columns a client asks for with
+`?fields=id,text,timestamp` (see the *_FIELDS tables for what's
+available), and serializes the resulting rows straight to compact JSON,
+never loading ORM objects. Lists come back as:
+
+    {"data":[...],"next":"<cursor>"}
+
+where `next` is null on the last page, and is passed back as `?cursor=`
+for the page after. `?limit=` picks a page size up to API_MAX_PAGE_SIZE.
+
+Like the HTML pages, the home timeline and follower lists need a
+logged-in session.
+
+Trending hashtags come from the in-memory counts in trending.py, as
+`{"data":[{"tag":"#warbler","count":12},...]}` for `?window=` (one of
+TRENDING_WINDOWS, by default the first).
+
+Parsing and loading don't touch Flask's request, so asgi.py serves the
+read-only endpoints with the same code.
+"""
+
+import json
+from datetime import datetime
+
+from flask import Blueprint, Response, abort, current_app, g, request
+from werkzeug.exceptions import HTTPException
+
+import trending
+from models import (db, User, Message, Follows, TimelineEntry, iter_messages,
+                    merge_streams, MERGE_BATCH_SIZE)
+from routing import replica_reads
+
+API_PAGE_SIZE = 20
+API_MAX_PAGE_SIZE = 100
+
+USER_FIELDS = {
+    'id': User.id,
+    'username': User.username,
+    'image_url': User.image_url,
+    'header_image_url': User.header_image_url,
+    'bio': User.bio,
+    'location': User.location,
+    'messages_count': User.messages_count,
+    'following_count': User.following_count,
+    'followers_count': User.followers_count,
+    'likes_count': User.likes_count,
+}
+USER_DEFAULT_FIELDS = ['id', 'username', 'image_url']
+
+MESSAGE_FIELDS = {
+    'id': Message.id,
+    'text': Message.text,
+    'timestamp': Message.timestamp,
+    'user_id': Message.user_id,
+    # from the author, joined in only when asked for
+    'username': User.username,
+    'image_url': User.image_url,
+}
+MESSAGE_DEFAULT_FIELDS = ['id', 'text', 'timestamp', 'user_id']
+AUTHOR_FIELDS = {'username', 'image_url'}
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+
+    raise TypeError(f"Can't serialize {type(value).__name__}")
+
+
+encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False, default=_default)
+
+
+##############################################################################
+# Request parsing and responses
+#
+# The parsers take the query string `args` as a dict of strings.
+
+
+def get_fields(args, available, default):
+    """The fields asked for with `?fields=`; aborts with a 400 on unknown ones."""
+
+    fields = args.get('fields')
+    if not fields:
+        return default
+
+    fields = list(dict.fromkeys(f.strip() for f in fields.split(',') if f.strip()))
+    unknown = [f for f in fields if f not in available]
+
+    if unknown or not fields:
+        abort(400, f"Unknown fields: {', '.join(unknown)}. "
+                   f"Choose from: {', '.join(available)}.")
+
+    return fields
+
+
+def get_limit(args):
+    try:
+        limit = int(args.get('limit', API_PAGE_SIZE))
+    except ValueError:
+        abort(400, "limit must be a number.")
+
+    return max(1, min(limit, API_MAX_PAGE_SIZE))
+
+
+def get_cursor(args, parse):
+    """`?cursor=` run through `parse`, or None; aborts with a 400 if malformed."""
+
+    cursor = args.get('cursor')
+    if not cursor:
+        return None
+
+    try:
+        return parse(cursor)
+    except ValueError:
+        abort(400, "Malformed cursor.")
+
+
+def require_login(user):
+    if not user:
+        abort(401, "Log in first.")
+
+
+def stream_json(chunks):
+    return Response(chunks, mimetype='application/json')
+
+
+def encode_row(row, fields):
+    return encoder.encode({field: getattr(row, field) for field in fields})
+
+
+def object_response(row, fields):
+    return stream_json([encode_row(row, fields)])
+
+
+def page_chunks(rows, fields, limit, cursor_of):
+    """JSON for a page of `limit` of `rows`, fetched as `limit + 1` to know if there are more."""
+
+    next_cursor = cursor_of(rows[limit - 1]) if len(rows) > limit else None
+
+    yield '{"data":['
+    for i, row in enumerate(rows[:limit]):
+        yield (',' if i else '') + encode_row(row, fields)
+    yield '],"next":' + encoder.encode(next_cursor) + '}'
+
+
+def page_response(rows, fields, limit, cursor_of):
+    return stream_json(page_chunks(rows, fields, limit, cursor_of))
+
+
+@api.errorhandler(HTTPException)
+def api_error(error):
+    body = encoder.encode({'error': error.description})
+    return Response(body, status=error.code, mimetype='application/json')
+
+
+##############################################################################
+# Queries
+
+
+def user_query(fields):
+    return db.session.query(*(USER_FIELDS[f].label(f) for f in fields))
+
+
+def message_query(fields):
+    """Query for `fields` of messages, plus the id and timestamp needed to page."""
+
+    columns = [Message.id.label('id'), Message.timestamp.label('timestamp')]
+    columns.extend(MESSAGE_FIELDS[f].label(f) for f in fields
+                   if f not in ('id', 'timestamp'))
+
+    query = db.session.query(*columns).select_from(Message)
+
+    if AUTHOR_FIELDS.intersection(fields):
+        query = query.join(User, User.id == Message.user_id)
+
+    return query
+
+
+def message_cursor(row):
+    return Message.make_cursor(row.timestamp, row.id)
+
+
+def user_cursor(row):
+    return str(row.id)
+
+
+# the Follows columns to join users on and to filter by, per list
+USER_LISTS = {
+    'following': (Follows.user_being_followed_id, Follows.user_following_id),
+    'followers': (Follows.user_following_id, Follows.user_being_followed_id),
+}
+
+
+##############################################################################
+# Loading
+#
+# Each loader runs the queries for one endpoint and returns its row, or
+# its page of rows fetched as `limit + 1`.
+
+
+def load_user(user_id, fields):
+    row = user_query(fields).filter(User.id == user_id).first()
+
+    if row is None:
+        abort(404, "No such user.")
+
+    return row
+
+
+def load_user_messages(user_id, fields, limit, before):
+    query = message_query(fields).filter(Message.user_id == user_id)
+    if before:
+        query = query.filter(db.tuple_(Message.timestamp, Message.id) < before)
+
+    return (query
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(limit + 1)
+            .all())
+
+
+def load_user_list(user_id, which, fields, limit, after):
+    """Page of the users in `user_id`'s USER_LISTS[`which`], by id."""
+
+    if not db.session.query(User.query.filter(User.id == user_id).exists()).scalar():
+        abort(404, "No such user.")
+
+    join_on, filter_on = USER_LISTS[which]
+    query = (user_query(set(fields) | {'id'})
+             .join(Follows, join_on == User.id)
+             .filter(filter_on == user_id))
+
+    # keyset on the follows column, so the page is one range scan of
+    # the follows index leading on `filter_on`
+    if after is not None:
+        query = query.filter(join_on > after)
+
+    return query.order_by(join_on).limit(limit + 1).all()
+
+
+def load_message(message_id, fields):
+    row = message_query(fields).filter(Message.id == message_id).first()
+
+    if row is None:
+        abort(404, "No such message.")
+
+    return row
+
+
+def load_timeline(user_id, fields, limit, before):
+    """The same merge as the home page: the materialized timeline plus the
+    messages of followed popular users, but over projected rows.
+    """
+
+    batch_size = min(MERGE_BATCH_SIZE, limit + 1)
+
+    delivered = (message_query(fields)
+                 .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+                 .filter(TimelineEntry.user_id == user_id))
+
+    streams = [iter_messages(delivered, TimelineEntry.timestamp, TimelineEntry.message_id,
+                             before=before, batch_size=limit + 1)]
+    streams.extend(iter_messages(message_query(fields).filter(Message.user_id == followed_id),
+                                 before=before, batch_size=batch_size)
+                   for followed_id in Follows.popular_followed_ids(user_id))
+
+    return merge_streams(streams, limit + 1)
+
+
+##############################################################################
+# Endpoints
+
+
+@api.route('/users/<int:user_id>')
+@replica_reads
+def user_show(user_id):
+    """A user's profile."""
+
+    fields = get_fields(request.args, USER_FIELDS, USER_DEFAULT_FIELDS)
+    return object_response(load_user(user_id, fields), fields)
+
+
+@api.route('/users/<int:user_id>/messages')
+@replica_reads
+def user_messages(user_id):
+    """A user's messages, newest first."""
+
+    fields = get_fields(request.args, MESSAGE_FIELDS, MESSAGE_DEFAULT_FIELDS)
+    limit = get_limit(request.args)
+    before = get_cursor(request.args, Message.parse_cursor)
+
+    rows = load_user_messages(user_id, fields, limit, before)
+    return page_response(rows, fields, limit, message_cursor)
+
+
+def user_list(user_id, which):
+    require_login(g.user)
+    fields = get_fields(request.args, USER_FIELDS, USER_DEFAULT_FIELDS)
+    limit = get_limit(request.args)
+    after = get_cursor(request.args, int)
+
+    rows = load_user_list(user_id, which, fields, limit, after)
+    return page_response(rows, fields, limit, user_cursor)
+
+
+@api.route('/users/<int:user_id>/following')
+@replica_reads
+def user_following(user_id):
+    """The users `user_id` follows."""
+
+    return user_list(user_id, 'following')
+
+
+@api.route('/users/<int:user_id>/followers')
+@replica_reads
+def user_followers(user_id):
+    """The users following `user_id`."""
+
+    return user_list(user_id, 'followers')
+
+
+@api.route('/messages/<int:message_id>')
+@replica_reads
+def message_show(message_id):
+    """A single message."""
+
+    fields = get_fields(request.args, MESSAGE_FIELDS, MESSAGE_DEFAULT_FIELDS)
+    return object_response(load_message(message_id, fields), fields)
+
+
+@api.route('/timeline')
+@replica_reads
+def timeline():
+    """The logged-in user's home timeline, newest first."""
+
+    require_login(g.user)
+    fields = get_fields(request.args, MESSAGE_FIELDS, MESSAGE_DEFAULT_FIELDS)
+    limit = get_limit(request.args)
+    before = get_cursor(request.args, Message.parse_cursor)
+
+    rows = load_timeline(g.user.id, fields, limit, before)
+    return page_response(rows, fields, limit, message_cursor)
+
+
+@api.route('/trending')
+def trending_tags():
+    """The top hashtags over a recent window, busiest first."""
+
+    windows = current_app.config['TRENDING_WINDOWS']
+    window = request.args.get('window')
+
+    if window and window not in windows:
+        abort(400, f"Unknown window: {window}. Choose from: {', '.join(windows)}.")
+
+    tags = trending.trending(window, get_limit(request.args))
+    return stream_json([encoder.encode({'data': [dict(tag=tag, count=count)
+                                                 for tag, count in tags]})])
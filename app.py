@@ -1,14 +1,36 @@
+import hashlib
 import os
+from datetime import datetime
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import click
+from flask import Flask, render_template, request, flash, redirect, session, g, abort, url_for
 # from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message
+from search import search_users, search_messages, MESSAGE_SEARCH_PAGE_SIZE
+from caching import (get_user_snapshot, forget_user, message_card, forget_message,
+                     liked_message_ids, forget_likes)
+from passwords import calibrate_rounds
+import assets
+from api import api
+import instrumentation
+import writebehind
+import followgraph
+import suggestions
+import trending
+import jobs
+from routing import replica_reads, pool_options
+from models import (db, connect_db, User, Message, Follows, Likes, MessageTerm, TimelineEntry,
+                    Suggestion, SuggestionRefresh, home_timeline, next_cursor,
+                    forget_following_ids, TIMELINE_PAGE_SIZE)
 
 CURR_USER_KEY = "curr_user"
 
+# "who to follow" suggestions and trending hashtags in the home page sidebar
+SUGGESTIONS_SHOWN = 5
+TRENDING_SHOWN = 5
+
 app = Flask(__name__)
 
 # Get DB_URI from environ variable (useful for production/testing) or,
@@ -16,14 +38,105 @@ app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
 
+# an optional read replica for the views marked @replica_reads
+if os.environ.get('DATABASE_REPLICA_URL'):
+    app.config['SQLALCHEMY_BINDS'] = {'replica': os.environ['DATABASE_REPLICA_URL']}
+
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = pool_options(
+    app.config['SQLALCHEMY_DATABASE_URI'],
+    pool_size=int(os.environ.get('DB_POOL_SIZE', 10)),
+    max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+    pool_recycle=int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+    pool_pre_ping=os.environ.get('DB_POOL_PRE_PING', '1') == '1')
+
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+# bcrypt work factor for new password hashes (see `flask calibrate-bcrypt`)
+# and how many hashes each process may compute at once, waiting at most
+# PASSWORD_HASH_TIMEOUT seconds for one
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+app.config['PASSWORD_HASH_TIMEOUT'] = float(os.environ.get('PASSWORD_HASH_TIMEOUT', 10))
+
+# count and time each request's SQL; see instrumentation.py
+app.config['SQL_INSTRUMENTATION'] = os.environ.get('SQL_INSTRUMENTATION') == '1'
+app.config['SLOW_REQUEST_MS'] = int(os.environ.get('SLOW_REQUEST_MS', 500))
+
+# queue like/follow toggles and write them in batches; see writebehind.py
+app.config['WRITE_BEHIND'] = os.environ.get('WRITE_BEHIND') == '1'
+
+# keep the follow graph in memory; see followgraph.py. It's reloaded every
+# FOLLOW_GRAPH_MAX_AGE seconds, which bounds how long follows made in other
+# processes take to show up in this one
+app.config['FOLLOW_GRAPH'] = os.environ.get('FOLLOW_GRAPH') == '1'
+app.config['FOLLOW_GRAPH_MAX_AGE'] = int(os.environ.get('FOLLOW_GRAPH_MAX_AGE', 300))
+
+# count hashtags as messages are posted; see trending.py. Each process
+# that has it on checkpoints its counts to the database, so it's off
+# unless asked for
+app.config['TRENDING'] = os.environ.get('TRENDING') == '1'
+
+# run deferred work in the request unless a `flask jobs-worker` is running;
+# see jobs.py
+app.config['JOBS_INLINE'] = os.environ.get('JOBS_INLINE', '1') == '1'
+
+# threads that run queries (and Flask) under asgi.py
+app.config['ASGI_DB_THREADS'] = int(os.environ.get('ASGI_DB_THREADS', 32))
 # toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
 
+app.jinja_env.globals['message_card'] = message_card
+assets.init_app(app)
+instrumentation.init_app(app)
+writebehind.init_app(app)
+followgraph.init_app(app, Follows.pairs)
+trending.init_app(app)
+jobs.init_app(app)
+app.register_blueprint(api)
+
+
+@app.cli.command('reconcile-counts')
+def reconcile_counts():
+    """Recompute the denormalized counters on every user."""
+
+    fixed = User.reconcile_counts()
+    db.session.commit()
+
+    print(f"Fixed counters for {fixed} users.")
+
+
+@app.cli.command('refresh-suggestions')
+@click.option('--full', is_flag=True, help="Recompute every user's, not just the stale ones.")
+def refresh_suggestions(full):
+    """Recompute "who to follow" suggestions for users whose follows changed."""
+
+    refreshed = suggestions.refresh(full=full)
+    db.session.commit()
+
+    print(f"Refreshed suggestions for {refreshed} users.")
+
+
+@app.cli.command('jobs-worker')
+@click.option('--processes', default=2, help="Worker processes to run.")
+def jobs_worker(processes):
+    """Run queued background jobs until interrupted."""
+
+    print(f"Running jobs in {processes} processes.")
+    jobs.start_workers(processes)
+
+
+@app.cli.command('calibrate-bcrypt')
+@click.option('--target-ms', default=250, help="Longest a login hash may take.")
+def calibrate_bcrypt(target_ms):
+    """Find the bcrypt work factor that fits a latency budget on this machine."""
+
+    rounds = calibrate_rounds(target_ms / 1000)
+    print(f"BCRYPT_LOG_ROUNDS={rounds}")
+
 
 ##############################################################################
 # User signup/login/logout
@@ -31,10 +144,15 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    g.user is a cached UserSnapshot; routes that change the user call
+    g.user.load() for the ORM entity.
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = get_user_snapshot(session[CURR_USER_KEY])
+        writebehind.load_pending()
 
     else:
         g.user = None
@@ -50,6 +168,7 @@ def do_logout():
     """Logout user."""
 
     if CURR_USER_KEY in session:
+        forget_user(session[CURR_USER_KEY])
         del session[CURR_USER_KEY]
 
 
@@ -100,6 +219,9 @@ def login():
                                  form.password.data)
 
         if user:
+            # authenticate may have upgraded the stored hash
+            db.session.commit()
+
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -120,14 +242,38 @@ def logout():
     return redirect("/")
 
 
+##############################################################################
+# Pagination
+
+
+def get_before_cursor():
+    """Read the keyset cursor from the `before` query string parameter.
+
+    Returns None for the first page and aborts with a 400 if the cursor
+    is malformed.
+    """
+
+    cursor = request.args.get('before')
+
+    if not cursor:
+        return None
+
+    try:
+        return Message.parse_cursor(cursor)
+    except ValueError:
+        abort(400)
+
+
 ##############################################################################
 # General user routes:
 
 @app.route('/users')
+@replica_reads
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search users by username,
+    bio or location; only the best-ranked matches are shown.
     """
 
     search = request.args.get('q')
@@ -135,29 +281,50 @@ def list_users():
     if not search:
         users = User.query.all()
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users = search_users(search)
 
     return render_template('users/index.html', users=users)
 
 
 @app.route('/users/<int:user_id>')
+@replica_reads
 def users_show(user_id):
     """Show user profile."""
 
     user = User.query.get_or_404(user_id)
+    before = get_before_cursor()
+
+    newest_id = (db.session
+                 .query(db.func.max(Message.id))
+                 .filter(Message.user_id == user_id)
+                 .scalar())
+
+    unchanged = not_modified(user.updated_at, user.messages_count,
+                             user.following_count, user.followers_count,
+                             user.likes_count, newest_id, before,
+                             g.user and g.user.is_following(user))
+    if unchanged:
+        return unchanged
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
+    query = Message.query.filter(Message.user_id == user_id)
+
+    if before:
+        query = query.filter(db.tuple_(Message.timestamp, Message.id) < before)
+
+    messages = (query
+                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .limit(TIMELINE_PAGE_SIZE + 1)
                 .all())
-    return render_template('users/show.html', user=user, messages=messages)
+
+    return render_template('users/show.html', user=user,
+                           messages=messages[:TIMELINE_PAGE_SIZE],
+                           next_cursor=next_cursor(messages, TIMELINE_PAGE_SIZE))
 
 
 @app.route('/users/<int:user_id>/following')
+@replica_reads
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -166,10 +333,16 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    following = user.following
+
+    if user.id == g.user.id:
+        following = writebehind.overlay_following(following)
+
+    return render_template('users/following.html', user=user, following=following)
 
 
 @app.route('/users/<int:user_id>/followers')
+@replica_reads
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -190,8 +363,21 @@ def add_follow(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+
+    if writebehind.enabled():
+        writebehind.queue.set_follow(g.user.id, followed_user.id, True)
+        return redirect(f"/users/{g.user.id}/following")
+
+    user = g.user.load()
+    user.following.append(followed_user)
+    User.adjust_counts(g.user.id, following=1)
+    User.adjust_counts(followed_user.id, followers=1)
+    forget_following_ids(g.user.id)
+    jobs.enqueue('sync_timeline', user_id=g.user.id, followed_id=followed_user.id)
+    SuggestionRefresh.request(g.user.id)
     db.session.commit()
+    forget_user(g.user.id, followed_user.id)
+    followgraph.record(g.user.id, followed_user.id, True)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -205,8 +391,21 @@ def stop_following(follow_id):
         return redirect("/")
 
     followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+
+    if writebehind.enabled():
+        writebehind.queue.set_follow(g.user.id, followed_user.id, False)
+        return redirect(f"/users/{g.user.id}/following")
+
+    user = g.user.load()
+    user.following.remove(followed_user)
+    User.adjust_counts(g.user.id, following=-1)
+    User.adjust_counts(followed_user.id, followers=-1)
+    forget_following_ids(g.user.id)
+    jobs.enqueue('sync_timeline', user_id=g.user.id, followed_id=followed_user.id)
+    SuggestionRefresh.request(g.user.id)
     db.session.commit()
+    forget_user(g.user.id, followed_user.id)
+    followgraph.record(g.user.id, followed_user.id, False)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -219,7 +418,18 @@ def show_likes(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
     
-    return render_template("likes/show.html", user=User.query.get_or_404(user_id))
+    user = User.query.get_or_404(user_id)
+    liked = (Message
+             .query
+             .join(Likes, Likes.message_id == Message.id)
+             .filter(Likes.user_id == user_id))
+
+    if user.id == g.user.id:
+        liked = writebehind.overlay_likes_query(liked)
+
+    messages = liked.options(db.joinedload(Message.user)).all()
+
+    return render_template("likes/show.html", user=user, messages=messages)
 
 
 @app.route("/users/add_like/<int:msg_id>", methods=["POST"])
@@ -230,13 +440,30 @@ def add_like(msg_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
     
-    liked_post = Message.query.get_or_404(msg_id)
-    
-    if liked_post in g.user.likes:
-        g.user.likes.remove(liked_post)
+    Message.query.get_or_404(msg_id)
+
+    if writebehind.enabled():
+        writebehind.queue.toggle_like(g.user.id, msg_id)
+        flash("Successfully liked the message!", "success")
+        return redirect(f"/users/{g.user.id}/likes")
+
+    unliked = (Likes.query
+               .filter_by(user_id=g.user.id, message_id=msg_id)
+               .delete(synchronize_session=False))
+
+    if unliked:
+        User.adjust_counts(g.user.id, likes=-1)
     else:
-        g.user.likes.append(liked_post)
+        try:
+            with db.session.begin_nested():
+                db.session.add(Likes(user_id=g.user.id, message_id=msg_id))
+            User.adjust_counts(g.user.id, likes=1)
+        except IntegrityError:
+            # a concurrent toggle of the same like inserted it first
+            pass
     db.session.commit()
+    forget_user(g.user.id)
+    forget_likes(g.user.id)
     
     flash("Successfully liked the message!", "success")
     return redirect(f"/users/{g.user.id}/likes")
@@ -254,15 +481,17 @@ def profile():
     user = User.query.get_or_404(g.user.id)
     
     if form.validate_on_submit():
-        if user.authenticate(user.username, form.password.data):
+        if user.check_password(form.password.data):
             user.username = form.username.data if form.username.data else user.username
             user.email = form.email.data if form.email.data else user.email
             user.image_url = form.image_url.data if form.image_url.data else user.image_url
             user.header_image_url = form.header_image_url.data if form.header_image_url.data else user.header_image_url
             user.bio = form.bio.data if form.bio.data else user.bio
+            user.updated_at = datetime.utcnow()
             
             db.session.add(user)
             db.session.commit()
+            forget_user(user.id)
             
             flash("successfully updated your account!", "success")
             return redirect(f"/users/{user.id}")
@@ -284,9 +513,17 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    # paths through this user disappear from their followers' suggestions
+    SuggestionRefresh.request(*Follows.follower_ids(g.user.id))
+    jobs.enqueue('delete_user', key=f"delete-user:{g.user.id}", user_id=g.user.id)
     db.session.commit()
 
+    # this process stops serving the user now; the job forgets them again
+    # once they're actually deleted
+    forget_user(g.user.id)
+    forget_likes(g.user.id)
+    followgraph.forget_user(g.user.id)
+
     return redirect("/signup")
 
 
@@ -307,20 +544,58 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        db.session.flush()
+        User.adjust_counts(g.user.id, messages=1)
+        MessageTerm.index_message(msg)
+        jobs.enqueue('fan_out', key=f"fan-out:{msg.id}", message_id=msg.id)
         db.session.commit()
+        forget_user(g.user.id)
+        trending.record(msg.text)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
+@app.route('/messages/search')
+@replica_reads
+def messages_search():
+    """Search messages.
+
+    Takes a 'q' param with the words to find and an optional 'before'
+    cursor for older results.
+    """
+
+    search = request.args.get('q', '')
+    messages = search_messages(search, before=get_before_cursor(),
+                               limit=MESSAGE_SEARCH_PAGE_SIZE + 1)
+    cursor = next_cursor(messages, MESSAGE_SEARCH_PAGE_SIZE)
+
+    return render_template('messages/search.html',
+                           search=search,
+                           messages=messages[:MESSAGE_SEARCH_PAGE_SIZE],
+                           next_url=cursor and url_for('messages_search',
+                                                       q=search, before=cursor))
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@replica_reads
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
+    msg = Message.query.get_or_404(message_id)
+    author = msg.user
+
+    # the follow button is the only part that depends on the viewer
+    unchanged = not_modified(msg.id, author.updated_at,
+                             g.user and g.user.is_following(author),
+                             last_modified=None if g.user else max(msg.timestamp,
+                                                                   author.updated_at))
+    if unchanged:
+        return unchanged
+
     return render_template('messages/show.html', message=msg)
 
 
@@ -333,8 +608,18 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get(message_id)
+    likers = (db.session
+              .query(Likes.user_id)
+              .filter(Likes.message_id == msg.id))
+
+    User.adjust_counts(likers.subquery(), likes=-1)
+    User.adjust_counts(msg.user_id, messages=-1)
+    TimelineEntry.remove_message(msg.id)
+    MessageTerm.unindex_message(msg)
     db.session.delete(msg)
     db.session.commit()
+    forget_user(msg.user_id)
+    forget_message(message_id)
 
     return redirect(f"/users/{g.user.id}")
 
@@ -352,31 +637,115 @@ def homepage():
     """
 
     if g.user:
-        messages = []
-        users = g.user.following
-        for user in users:
-            for msg in user.messages:
-                messages.append(msg)
-
-        return render_template('home.html', messages=messages, likes=g.user.likes)
+        messages = home_timeline(g.user.id, TIMELINE_PAGE_SIZE + 1,
+                                 before=get_before_cursor())
+
+        like_version = Likes.version(g.user.id)
+
+        suggested = Suggestion.for_user(g.user.id, SUGGESTIONS_SHOWN)
+        tags = [tag for tag, _ in trending.trending(limit=TRENDING_SHOWN)]
+
+        # the page's message ids cover new and deleted messages alike,
+        # their authors' updated_at renamed authors and new avatars;
+        # the like version covers every like toggle, whichever process
+        # made it
+        unchanged = not_modified([(msg.id, msg.user.updated_at) for msg in messages],
+                                 g.user.messages_count, g.user.following_count,
+                                 g.user.followers_count, g.user.likes_count,
+                                 like_version,
+                                 [(user.id, user.updated_at) for user in suggested],
+                                 tags)
+        if unchanged:
+            return unchanged
+
+        page = messages[:TIMELINE_PAGE_SIZE]
+        page_ids = [msg.id for msg in page]
+        liked = liked_message_ids(g.user.id, page_ids, like_version)
+        liked = writebehind.overlay_liked(liked, page_ids)
+
+        return render_template('home.html',
+                               messages=page,
+                               next_cursor=next_cursor(messages, TIMELINE_PAGE_SIZE),
+                               liked=liked,
+                               suggested=suggested,
+                               trending=tags)
 
     else:
+        unchanged = not_modified('anon')
+        if unchanged:
+            return unchanged
+
         return render_template('home-anon.html')
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
+# HTTP caching
 #
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Pages are never served from a cache without asking us first, but a page
+# that hasn't changed since the browser last saw it is answered with a
+# bodiless 304 before any template is rendered. Each route builds its
+# validator from cheap version stamps via `not_modified`.
+
+
+def not_modified(*stamps, last_modified=None):
+    """A 304 response if the client's copy of this page is still current.
+
+    `stamps` are values that change whenever the page would; the current
+    user (and their updated_at, for the navbar), their queued
+    write-behind toggles, the query string and the static asset build
+    are always mixed in. `last_modified` is only worth passing when it really
+    covers everything on the page.
+
+    Returns None if the page has to be rendered; the validators are
+    added to that response by `add_header`.
+    """
+
+    if '_flashes' in session:
+        # the page would show (and consume) a flashed message
+        return None
+
+    viewer = (g.user.id, g.user.updated_at) if g.user else None
+    version = repr((viewer, writebehind.pending_stamp(), request.query_string,
+                    assets.version()) + stamps)
+
+    g.etag = hashlib.sha1(version.encode()).hexdigest()
+    g.last_modified = last_modified
+
+    if request.if_none_match:
+        fresh = request.if_none_match.contains(g.etag)
+    else:
+        fresh = (last_modified is not None
+                 and request.if_modified_since is not None
+                 and last_modified.replace(microsecond=0)
+                 <= request.if_modified_since.replace(tzinfo=None))
+
+    if fresh:
+        return app.response_class(status=304)
+
+    return None
+
 
 @app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+def add_header(response):
+    """Add caching headers to every response.
+
+    Pages may depend on who's logged in, so they vary by cookie, and
+    logged-in pages are private to the browser. Fingerprinted assets
+    keep the far-future headers they were served with.
+    """
+
+    if assets.is_immutable(response):
+        return response
+
+    if 'etag' in g and response.status_code in (200, 304):
+        response.set_etag(g.etag)
+        if g.last_modified:
+            response.last_modified = g.last_modified
+
+    if g.get('user'):
+        response.headers['Cache-Control'] = 'private, no-cache'
+    else:
+        response.headers['Cache-Control'] = 'public, no-cache'
+
+    response.vary.add('Cookie')
+    return response
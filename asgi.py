@@ -0,0 +1,346 @@
+"""ASGI entry point for Warbler.
+
+Serve it with any ASGI server, e.g.:
+
+    uvicorn asgi:application --workers 2
+
+The read-only JSON endpoints in ROUTES (profiles, users' messages,
+follower lists, message permalinks and the home timeline) are served
+here natively. Each request is parsed and answered on the event loop,
+and only its queries are awaited on a pool of ASGI_DB_THREADS threads.
+A worker process so keeps that many requests waiting on the database at
+once, and cheaply queues any more, where a synchronous worker holds
+one. Responses are byte for byte what api.py sends.
+
+Their queries go to the read replica, if one is configured, just as
+Flask's `@replica_reads` views' do (see routing.py).
+
+Every other request (the HTML pages, logins, writes, the rest of the
+API) goes to the Flask app unchanged, run on the same pool. There are
+no websocket endpoints; websocket connections are refused.
+
+SQLAlchemy 1.x only speaks blocking DB-API, so the queries themselves
+still block a pool thread each. Size the engine's pool (DB_POOL_SIZE
+plus DB_MAX_OVERFLOW) to cover ASGI_DB_THREADS.
+"""
+
+import asyncio
+import io
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import parse_qsl
+
+from flask import g
+from itsdangerous import BadSignature
+from werkzeug.exceptions import HTTPException, InternalServerError
+from werkzeug.http import parse_cookie
+
+import api
+from api import (USER_FIELDS, USER_DEFAULT_FIELDS, MESSAGE_FIELDS, MESSAGE_DEFAULT_FIELDS,
+                 get_fields, get_limit, get_cursor, require_login, encoder)
+from app import app, CURR_USER_KEY
+from caching import get_user_snapshot
+from models import db, Message
+from routing import replica_allowed
+
+
+class _State:
+    pool = None
+
+
+_state = _State()
+
+
+def _pool():
+    if _state.pool is None:
+        _state.pool = ThreadPoolExecutor(app.config['ASGI_DB_THREADS'],
+                                         thread_name_prefix='asgi-db')
+    return _state.pool
+
+
+def _in_app(read_replica, fn, *args):
+    with app.app_context():
+        g.read_replica = read_replica
+        try:
+            return fn(*args)
+        finally:
+            db.session.remove()
+
+
+async def run_db(fn, *args, read_replica=False):
+    """Await `fn(*args)`, run in an app context on the database pool.
+
+    With `read_replica`, its queries go to the replica if there is one.
+    """
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_pool(), partial(_in_app, read_replica, fn, *args))
+
+
+class Request:
+    """The parts of an ASGI HTTP scope the endpoints read."""
+
+    def __init__(self, scope):
+        self.args = {}
+        for name, value in parse_qsl(scope['query_string'].decode('latin-1'),
+                                     keep_blank_values=True):
+            self.args.setdefault(name, value)
+
+        cookies = b'; '.join(value for name, value in scope['headers'] if name == b'cookie')
+        session = _session(parse_cookie(cookies.decode('latin-1')))
+
+        self.user_id = session.get(CURR_USER_KEY)
+        self.read_replica = replica_allowed(session)
+
+    async def run_db(self, fn, *args):
+        """`run_db` for this request's reads."""
+
+        return await run_db(fn, *args, read_replica=self.read_replica)
+
+    async def user(self):
+        """Snapshot of the logged-in user, or None."""
+
+        if self.user_id is None:
+            return None
+
+        # loaded from the primary, as Flask's add_user_to_g does
+        return await run_db(get_user_snapshot, self.user_id)
+
+
+def _session(cookies):
+    """Flask's signed session cookie, decoded; empty if missing or invalid."""
+
+    cookie = cookies.get(app.config['SESSION_COOKIE_NAME'])
+    if not cookie:
+        return {}
+
+    serializer = app.session_interface.get_signing_serializer(app)
+    try:
+        return serializer.loads(cookie,
+                                max_age=int(app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return {}
+
+
+##############################################################################
+# Endpoints
+#
+# Each takes the request and the ids in its path, and returns the
+# response body's chunks; errors are raised as HTTPExceptions.
+
+
+async def user_show(request, user_id):
+    fields = get_fields(request.args, USER_FIELDS, USER_DEFAULT_FIELDS)
+    row = await request.run_db(api.load_user, user_id, fields)
+
+    return [api.encode_row(row, fields)]
+
+
+async def user_messages(request, user_id):
+    fields = get_fields(request.args, MESSAGE_FIELDS, MESSAGE_DEFAULT_FIELDS)
+    limit = get_limit(request.args)
+    before = get_cursor(request.args, Message.parse_cursor)
+
+    rows = await request.run_db(api.load_user_messages, user_id, fields, limit, before)
+    return api.page_chunks(rows, fields, limit, api.message_cursor)
+
+
+async def user_list(request, user_id, which):
+    require_login(await request.user())
+    fields = get_fields(request.args, USER_FIELDS, USER_DEFAULT_FIELDS)
+    limit = get_limit(request.args)
+    after = get_cursor(request.args, int)
+
+    rows = await request.run_db(api.load_user_list, user_id, which, fields, limit, after)
+    return api.page_chunks(rows, fields, limit, api.user_cursor)
+
+
+async def message_show(request, message_id):
+    fields = get_fields(request.args, MESSAGE_FIELDS, MESSAGE_DEFAULT_FIELDS)
+    row = await request.run_db(api.load_message, message_id, fields)
+
+    return [api.encode_row(row, fields)]
+
+
+async def timeline(request):
+    user = await request.user()
+    require_login(user)
+    fields = get_fields(request.args, MESSAGE_FIELDS, MESSAGE_DEFAULT_FIELDS)
+    limit = get_limit(request.args)
+    before = get_cursor(request.args, Message.parse_cursor)
+
+    rows = await request.run_db(api.load_timeline, user.id, fields, limit, before)
+    return api.page_chunks(rows, fields, limit, api.message_cursor)
+
+
+PREFIX = re.escape(api.api.url_prefix)
+
+# GET paths served here rather than by Flask
+ROUTES = [
+    (re.compile(PREFIX + r'/users/(\d+)'), user_show),
+    (re.compile(PREFIX + r'/users/(\d+)/messages'), user_messages),
+    (re.compile(PREFIX + r'/users/(\d+)/following'), partial(user_list, which='following')),
+    (re.compile(PREFIX + r'/users/(\d+)/followers'), partial(user_list, which='followers')),
+    (re.compile(PREFIX + r'/messages/(\d+)'), message_show),
+    (re.compile(PREFIX + r'/timeline'), timeline),
+]
+
+
+async def serve(endpoint, ids, scope, send):
+    request = Request(scope)
+
+    try:
+        chunks = await endpoint(request, *ids)
+        status = 200
+    except HTTPException as error:
+        chunks = [encoder.encode({'error': error.description})]
+        status = error.code
+    except Exception:
+        app.logger.exception(f"Exception on {scope['path']} [GET]")
+        chunks = [encoder.encode({'error': InternalServerError.description})]
+        status = 500
+
+    body = ''.join(chunks).encode()
+    cache_control = b'private, no-cache' if request.user_id else b'public, no-cache'
+
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'),
+                            (b'content-length', str(len(body)).encode()),
+                            (b'cache-control', cache_control),
+                            (b'vary', b'Cookie')]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+##############################################################################
+# Everything else, through Flask
+
+
+def wsgi_environ(scope, body):
+    """A WSGI environ for an ASGI HTTP `scope` with request `body`."""
+
+    server = scope.get('server') or ('localhost', 80)
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+
+    for name, value in scope['headers']:
+        key = name.decode('latin-1').upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+
+        value = value.decode('latin-1')
+        if key in environ:
+            value = environ[key] + ('; ' if key == 'HTTP_COOKIE' else ',') + value
+        environ[key] = value
+
+    # the body has been read in full, chunked or not
+    environ['CONTENT_LENGTH'] = str(len(body))
+
+    return environ
+
+
+def run_wsgi(environ):
+    """Run the Flask app on `environ`; returns (status, headers, body)."""
+
+    response = {}
+    chunks = []
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                               for name, value in headers]
+        return chunks.append
+
+    result = app(environ, start_response)
+    try:
+        chunks.extend(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+
+    return response['status'], response['headers'], b''.join(chunks)
+
+
+async def call_flask(scope, receive, send):
+    body = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+        body.append(message.get('body', b''))
+        more_body = message.get('more_body', False)
+
+    loop = asyncio.get_running_loop()
+    status, headers, content = await loop.run_in_executor(
+        _pool(), run_wsgi, wsgi_environ(scope, b''.join(body)))
+
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': content})
+
+
+##############################################################################
+# The application
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+
+        if message['type'] == 'lifespan.startup':
+            _pool()
+            await send({'type': 'lifespan.startup.complete'})
+
+        elif message['type'] == 'lifespan.shutdown':
+            if _state.pool is not None:
+                _state.pool.shutdown()
+                _state.pool = None
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def reject_websocket(receive, send):
+    """Refuse a websocket connection; the server answers the handshake with a 403."""
+
+    message = await receive()
+    if message['type'] == 'websocket.connect':
+        await send({'type': 'websocket.close', 'code': 1008})
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    if scope['type'] == 'websocket':
+        return await reject_websocket(receive, send)
+
+    if scope['type'] != 'http':
+        return
+
+    if scope['method'] == 'GET':
+        for pattern, endpoint in ROUTES:
+            match = pattern.fullmatch(scope['path'])
+            if match:
+                ids = [int(group) for group in match.groups()]
+                return await serve(endpoint, ids, scope, send)
+
+    await call_flask(scope, receive, send)
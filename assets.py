@@ -0,0 +1,221 @@
+"""Fingerprinted static assets for Warbler.
+
+`flask build-assets` copies everything under static/ into static/dist/
+with a content hash in each file name, plus gzip (and, if the `brotli`
+package is installed, brotli) variants of compressible files, and
+writes a manifest mapping original paths to hashed ones.
+
+Templates link to assets with `static_url('stylesheets/style.css')`.
+Once a build exists, that points at /assets/<hashed name>, which is
+served with a far-future immutable Cache-Control, so repeat visits
+never refetch it; change the file and its URL changes with it. Without
+a build, `static_url` falls back to the plain /static/ URL. Stored
+links such as users' default avatars (/static/images/...) go through
+`asset_url`, which does the same for /static/ paths and leaves other
+URLs alone.
+
+A rebuild keeps the hashed files of earlier builds, so pages rendered
+before it (in browsers, or in the message card cache) still load
+theirs. Pages' ETags include the manifest's `version`, so a browser
+revalidating after a deploy gets the new asset URLs rather than a 304.
+Old builds' files can be deleted once no page that links them is
+likely to still be open.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+from flask import current_app, request, send_from_directory, url_for, abort
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+ASSETS_URL = '/assets'
+
+# the prefix of stored links to static files, like users' default avatars
+STATIC_URL = '/static/'
+
+# a year: hashed files never change, so they can be cached for good
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# formats worth compressing; images are compressed already
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.txt', '.json', '.map'}
+
+# absolute references to other static files inside stylesheets
+CSS_URL_RE = re.compile(r'''url\((["']?)/static/([^"')]+)\1\)''')
+
+# encodings in order of preference, with the suffix of their variant
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+def hashed_name(path, content):
+    """`path` with a short hash of `content` before its extension."""
+
+    digest = hashlib.sha256(content).hexdigest()[:12]
+    base, ext = os.path.splitext(path)
+
+    return f"{base}.{digest}{ext}"
+
+
+def build_assets(static_folder):
+    """Fingerprint and precompress every file under `static_folder`.
+
+    Stylesheets are built last, with their url(/static/...) references
+    rewritten to the hashed names. Files from earlier builds are left in
+    place. Returns the manifest.
+    """
+
+    dist = os.path.join(static_folder, DIST_DIR)
+
+    sources = []
+    for root, dirs, files in os.walk(static_folder):
+        if os.path.abspath(root) == os.path.abspath(static_folder):
+            dirs[:] = [d for d in dirs if d != DIST_DIR]
+
+        for name in files:
+            path = os.path.relpath(os.path.join(root, name), static_folder)
+            sources.append(path.replace(os.sep, '/'))
+
+    sources.sort(key=lambda path: (path.endswith('.css'), path))
+    manifest = {}
+
+    for path in sources:
+        with open(os.path.join(static_folder, path), 'rb') as f:
+            content = f.read()
+
+        if path.endswith('.css'):
+            content = CSS_URL_RE.sub(
+                lambda m: f'url("{ASSETS_URL}/{manifest.get(m.group(2), m.group(2))}")',
+                content.decode('UTF-8')).encode('UTF-8')
+
+        hashed = hashed_name(path, content)
+        manifest[path] = hashed
+        _write(dist, hashed, content)
+
+        if os.path.splitext(path)[1] in COMPRESSIBLE:
+            _write(dist, hashed + '.gz', gzip.compress(content, 9, mtime=0))
+            if brotli is not None:
+                _write(dist, hashed + '.br', brotli.compress(content))
+
+    _write(dist, MANIFEST, json.dumps(manifest, indent=2, sort_keys=True).encode())
+
+    return manifest
+
+
+def _write(folder, path, content):
+    target = os.path.join(folder, path)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+
+    with open(target, 'wb') as f:
+        f.write(content)
+
+
+def load_manifest(static_folder):
+    """The manifest of the last build, or {} if there hasn't been one."""
+
+    try:
+        with open(os.path.join(static_folder, DIST_DIR, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def manifest_version(manifest):
+    """Short hash identifying a build's `manifest`."""
+
+    content = json.dumps(manifest, sort_keys=True).encode()
+    return hashlib.sha256(content).hexdigest()[:12]
+
+
+def version():
+    """The current build's manifest_version, for mixing into validators."""
+
+    return current_app.extensions['assets_version']
+
+
+def static_url(path):
+    """URL for the static file at `path` (relative to static/)."""
+
+    hashed = current_app.extensions['assets'].get(path)
+
+    if hashed is None:
+        return url_for('static', filename=path)
+
+    return f"{ASSETS_URL}/{hashed}"
+
+
+def asset_url(url):
+    """`url`, through static_url if it's a /static/ path."""
+
+    if url and url.startswith(STATIC_URL):
+        return static_url(url[len(STATIC_URL):])
+
+    return url
+
+
+def serve_asset(filename):
+    """Serve a fingerprinted file, precompressed if the client allows."""
+
+    dist = os.path.join(current_app.static_folder, DIST_DIR)
+
+    if filename == MANIFEST or filename.endswith(('.gz', '.br')):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    encoding = None
+
+    for name, suffix in ENCODINGS:
+        if (request.accept_encodings[name]
+                and os.path.isfile(os.path.join(dist, filename + suffix))):
+            encoding = name
+            filename += suffix
+            break
+
+    response = send_from_directory(dist, filename, mimetype=mimetype)
+
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+
+    response.headers['Cache-Control'] = (
+        f"public, max-age={IMMUTABLE_MAX_AGE}, immutable")
+
+    return response
+
+
+def is_immutable(response):
+    """Was `response` marked as cacheable forever by `serve_asset`?"""
+
+    return 'immutable' in response.headers.get('Cache-Control', '')
+
+
+def _use_manifest(app, manifest):
+    app.extensions['assets'] = manifest
+    app.extensions['assets_version'] = manifest_version(manifest)
+
+
+def init_app(app):
+    """Load the asset manifest and register the helpers with `app`."""
+
+    _use_manifest(app, load_manifest(app.static_folder))
+    app.jinja_env.globals['static_url'] = static_url
+    app.jinja_env.globals['asset_url'] = asset_url
+    app.add_url_rule(f"{ASSETS_URL}/<path:filename>", 'assets', serve_asset)
+
+    @app.cli.command('build-assets')
+    def build_assets_command():
+        """Fingerprint and precompress the files in static/."""
+
+        manifest = build_assets(app.static_folder)
+        _use_manifest(app, manifest)
+
+        print(f"Built {len(manifest)} assets into "
+              f"{os.path.join(app.static_folder, DIST_DIR)}.")
@@ -0,0 +1,483 @@
+"""Benchmark Warbler's hot routes at several data scales.
+
+Run it from the project root like:
+
+    python benchmark.py --scales 1k,10k
+    python benchmark.py --scales 100k --database-url postgresql:///warbler-bench-{scale}
+    python benchmark.py --scales 1k --compare benchmark-results/20240101T000000.json
+    python benchmark.py --scales 10k --follow-graph
+    python benchmark.py --scales 1k --asgi --db-latency 5
+
+For each scale a skewed dataset is generated (generator/create_csvs.py)
+and loaded (seed.py), then every route in ROUTES is driven through the
+Flask test client as a heavy user would. Each route reports p50/p95/p99
+latency, SQL statements per request and peak Python memory per request.
+Results are written as JSON so runs can be compared with --compare.
+
+With --follow-graph, the in-memory follow graph (followgraph.py) is also
+built from the loaded data: its size, build time and lookup times are
+reported next to the same lookups through the ORM, and the follower
+pages are timed again with it on.
+
+With --asgi, every query is made to wait --db-latency milliseconds, as
+if the database were across a network. Read-only API requests are then
+served by one synchronous worker (the Flask app, one request at a time)
+and by asgi.py at each level of ASGI_CONCURRENCY. Throughput and
+latency are reported for each.
+
+Each scale runs in its own process, since the app binds to its database
+at import time.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+# users at each scale; messages and follows grow with them
+SCALES = {'1k': 1000, '10k': 10000, '100k': 100000, '1m': 1000000}
+MESSAGES_PER_USER = 10
+FOLLOWS_PER_USER = 20
+
+SEED = 'benchmark'
+UNTIL = '2024-01-01'
+
+REQUESTS = 200
+WARMUP = 5
+
+# how much slower a route may get before --compare calls it a regression
+REGRESSION_THRESHOLD = 1.2
+
+
+##############################################################################
+# Routes under test
+#
+# Each takes the test client and the ids picked out of the dataset, and
+# makes one request.
+
+def homepage(client, ids):
+    return client.get("/")
+
+
+def users_show(client, ids):
+    return client.get(f"/users/{ids['popular']}")
+
+
+def list_users(client, ids):
+    return client.get("/users?q=an")
+
+
+def show_following(client, ids):
+    return client.get(f"/users/{ids['viewer']}/following")
+
+
+def users_followers(client, ids):
+    return client.get(f"/users/{ids['popular']}/followers")
+
+
+def add_like(client, ids):
+    return client.post(f"/users/add_like/{ids['message']}")
+
+
+def messages_add(client, ids):
+    return client.post("/messages/new", data={"text": "Benchmarking!"})
+
+
+ROUTES = [homepage, users_show, list_users, show_following, users_followers,
+          add_like, messages_add]
+
+# routes rerun with the in-memory follow graph on (--follow-graph)
+FOLLOW_GRAPH_ROUTES = [show_following, users_followers]
+
+# users sampled for the follow graph lookup comparison
+GRAPH_SAMPLE = 200
+
+# requests in flight at once against asgi.py (--asgi)
+ASGI_CONCURRENCY = [1, 8, 32, 128]
+DB_LATENCY_MS = 5
+
+
+def api_paths(ids):
+    """The read-only API requests --asgi cycles through."""
+
+    return [f"/api/v1/users/{ids['popular']}",
+            f"/api/v1/users/{ids['popular']}/messages",
+            f"/api/v1/users/{ids['popular']}/followers",
+            f"/api/v1/messages/{ids['message']}",
+            "/api/v1/timeline"]
+
+
+##############################################################################
+# Measuring one scale (runs in a child process)
+
+
+def build_dataset(users, work_dir, processes):
+    """Generate CSVs for `users` users and load them into the database."""
+
+    import seed
+
+    subprocess.run([sys.executable, 'generator/create_csvs.py',
+                    '--users', str(users),
+                    '--messages', str(users * MESSAGES_PER_USER),
+                    '--follows', str(users * FOLLOWS_PER_USER),
+                    '--seed', SEED, '--until', UNTIL,
+                    '--processes', str(processes),
+                    '--out-dir', work_dir],
+                   check=True)
+
+    seed.seed(users=[os.path.join(work_dir, 'users.csv')],
+              messages=[os.path.join(work_dir, 'messages.csv')],
+              follows=[os.path.join(work_dir, 'follows.csv')])
+
+
+def pick_ids():
+    """The users and message the benchmark requests are about."""
+
+    from models import User, Message
+
+    viewer = User.query.order_by(User.following_count.desc()).first()
+    popular = User.query.order_by(User.followers_count.desc()).first()
+    message = Message.query.order_by(Message.id.desc()).first()
+
+    return dict(viewer=viewer.id, popular=popular.id, message=message.id)
+
+
+def percentile(samples, pct):
+    return statistics.quantiles(samples, n=100, method='inclusive')[pct - 1]
+
+
+def measure_route(route, client, ids, requests, statements):
+    """Latency, statement count and memory of `requests` calls to `route`."""
+
+    for _ in range(WARMUP):
+        route(client, ids)
+
+    latencies = []
+    counts = []
+
+    for _ in range(requests):
+        statements.clear()
+        start = time.perf_counter()
+        resp = route(client, ids)
+        latencies.append((time.perf_counter() - start) * 1000)
+        counts.append(len(statements))
+
+        assert resp.status_code < 400, f"{route.__name__}: {resp.status_code}"
+
+    # memory is traced on a separate pass, since tracing slows everything
+    tracemalloc.start()
+    peaks = []
+    for _ in range(min(requests, 20)):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        route(client, ids)
+        peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+
+    return dict(
+        requests=requests,
+        p50_ms=round(percentile(latencies, 50), 3),
+        p95_ms=round(percentile(latencies, 95), 3),
+        p99_ms=round(percentile(latencies, 99), 3),
+        queries=statistics.median(counts),
+        peak_kb=round(max(peaks) / 1024, 1),
+    )
+
+
+def time_calls(fn, calls):
+    """Mean microseconds per `fn(*args)` over `calls`."""
+
+    start = time.perf_counter()
+    for args in calls:
+        fn(*args)
+
+    return round((time.perf_counter() - start) / len(calls) * 1e6, 2)
+
+
+def measure_follow_graph(users):
+    """Build the follow graph, and time its lookups against the ORM's."""
+
+    import followgraph
+    from models import db, User, Follows, _follows_exists
+
+    start = time.perf_counter()
+    graph = followgraph.FollowGraph.build(Follows.pairs())
+    build_s = time.perf_counter() - start
+
+    sample = random.Random(SEED).sample(range(1, users + 1), min(GRAPH_SAMPLE, users))
+    pairs = list(zip(sample, reversed(sample)))
+
+    def orm_following(user_id):
+        db.session.expunge_all()
+        return [u.id for u in User.query.get(user_id).following]
+
+    def orm_followers(user_id):
+        db.session.expunge_all()
+        return [u.id for u in User.query.get(user_id).followers]
+
+    lookups = {
+        'following': (orm_following, graph.following, [(u,) for u in sample]),
+        'followers': (orm_followers, graph.followers, [(u,) for u in sample]),
+        'is_following': (_follows_exists, graph.is_following, pairs),
+    }
+
+    result = dict(edges=graph.edges, build_s=round(build_s, 3),
+                  mb=round(graph.nbytes / 2**20, 2),
+                  mb_per_million_edges=round(graph.nbytes / 2**20 / max(graph.edges, 1) * 1e6, 2),
+                  lookups={})
+
+    for name, (orm, in_memory, calls) in lookups.items():
+        result['lookups'][name] = dict(orm_us=time_calls(orm, calls),
+                                       graph_us=time_calls(in_memory, calls))
+
+    db.session.remove()
+    return result
+
+
+def throughput(latencies, elapsed):
+    return dict(requests=len(latencies),
+                per_second=round(len(latencies) / elapsed, 1),
+                p50_ms=round(percentile(latencies, 50), 3),
+                p95_ms=round(percentile(latencies, 95), 3))
+
+
+async def drive_asgi(application, paths, cookie, requests, concurrency):
+    """Make `requests` requests to `application`, `concurrency` at a time."""
+
+    latencies = []
+    queue = iter(range(requests))
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def worker():
+        for i in queue:
+            scope = dict(type='http', http_version='1.1', method='GET', scheme='http',
+                         path=paths[i % len(paths)], root_path='', query_string=b'',
+                         headers=[(b'cookie', cookie)], server=('bench', 80))
+            sent = []
+
+            async def send(message):
+                sent.append(message)
+
+            start = time.perf_counter()
+            await application(scope, receive, send)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+            assert sent[0]['status'] < 400, f"{scope['path']}: {sent[0]['status']}"
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return throughput(latencies, time.perf_counter() - start)
+
+
+def measure_asgi(app, client, ids, requests, latency_ms):
+    """Throughput of a synchronous worker against asgi.py, with slow queries."""
+
+    from sqlalchemy import event
+
+    import asgi
+    from app import CURR_USER_KEY
+    from models import db
+
+    def wait(*args):
+        time.sleep(latency_ms / 1000)
+
+    event.listen(db.engine, 'before_cursor_execute', wait)
+
+    paths = api_paths(ids)
+    serializer = app.session_interface.get_signing_serializer(app)
+    cookie = (f"{app.config['SESSION_COOKIE_NAME']}="
+              f"{serializer.dumps({CURR_USER_KEY: ids['viewer']})}").encode()
+
+    try:
+        latencies = []
+        start = time.perf_counter()
+        for i in range(requests):
+            before = time.perf_counter()
+            resp = client.get(paths[i % len(paths)])
+            latencies.append((time.perf_counter() - before) * 1000)
+            assert resp.status_code < 400, f"{paths[i % len(paths)]}: {resp.status_code}"
+
+        result = dict(db_latency_ms=latency_ms,
+                      wsgi=throughput(latencies, time.perf_counter() - start),
+                      asgi={})
+
+        app.config['ASGI_DB_THREADS'] = max(ASGI_CONCURRENCY)
+        for concurrency in ASGI_CONCURRENCY:
+            result['asgi'][concurrency] = asyncio.run(
+                drive_asgi(asgi.application, paths, cookie, max(requests, concurrency * 4),
+                           concurrency))
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', wait)
+
+    return result
+
+
+def run_scale(scale, requests, work_dir, processes, reuse, follow_graph=False,
+              asgi=False, db_latency=DB_LATENCY_MS):
+    """Benchmark every route at one scale. DATABASE_URL must already be set."""
+
+    from sqlalchemy import event
+
+    import followgraph
+    from app import app, CURR_USER_KEY
+    from models import db, User
+
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    if not (reuse and db.engine.has_table('users')):
+        build_dataset(SCALES[scale], work_dir, processes)
+
+    statements = []
+    event.listen(db.engine, 'before_cursor_execute',
+                 lambda *args: statements.append(args[2]))
+
+    ids = pick_ids()
+    dataset = dict(users=User.query.count(), **ids)
+    db.session.remove()
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = ids['viewer']
+
+    routes = {}
+    for route in ROUTES:
+        routes[route.__name__] = measure_route(route, client, ids, requests, statements)
+        print(f"  {route.__name__}: {routes[route.__name__]}", flush=True)
+
+    result = dict(dataset=dataset, routes=routes)
+
+    if follow_graph:
+        result['follow_graph'] = measure_follow_graph(dataset['users'])
+        print(f"  follow graph: {result['follow_graph']}", flush=True)
+
+        app.config['FOLLOW_GRAPH'] = True
+        with app.app_context():
+            followgraph.build_now()
+        result['routes_follow_graph'] = {}
+        for route in FOLLOW_GRAPH_ROUTES:
+            timing = measure_route(route, client, ids, requests, statements)
+            result['routes_follow_graph'][route.__name__] = timing
+            print(f"  {route.__name__} (follow graph): {timing}", flush=True)
+
+    if asgi:
+        result['asgi'] = measure_asgi(app, client, ids, requests, db_latency)
+        print(f"  synchronous worker: {result['asgi']['wsgi']}", flush=True)
+        for concurrency, timing in result['asgi']['asgi'].items():
+            print(f"  asgi x{concurrency}: {timing}", flush=True)
+
+    return result
+
+
+##############################################################################
+# Running and comparing
+
+
+def compare(results, baseline):
+    """Print how each route's p95 moved against `baseline`; True if none regressed."""
+
+    ok = True
+
+    for scale, result in results['scales'].items():
+        before_routes = baseline['scales'].get(scale, {}).get('routes', {})
+
+        for name, after in result['routes'].items():
+            before = before_routes.get(name)
+            if not before:
+                continue
+
+            ratio = after['p95_ms'] / before['p95_ms'] if before['p95_ms'] else 1
+            regressed = ratio > REGRESSION_THRESHOLD
+            ok = ok and not regressed
+
+            print(f"{scale:>5} {name:<16} p95 {before['p95_ms']:>9.2f} -> "
+                  f"{after['p95_ms']:>9.2f} ms ({ratio:.2f}x)  queries "
+                  f"{before['queries']} -> {after['queries']}"
+                  f"{'  REGRESSION' if regressed else ''}")
+
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scales', default='1k,10k',
+                        help=f"comma separated, from {', '.join(SCALES)}")
+    parser.add_argument('--requests', type=int, default=REQUESTS,
+                        help="timed requests per route")
+    parser.add_argument('--database-url',
+                        help="database per scale, with {scale} in it "
+                             "(default: SQLite files in --work-dir)")
+    parser.add_argument('--work-dir', default=os.path.join(tempfile.gettempdir(),
+                                                           'warbler-benchmark'))
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help="processes for generating data")
+    parser.add_argument('--reuse', action='store_true',
+                        help="reuse an already loaded database")
+    parser.add_argument('--follow-graph', action='store_true',
+                        help="also compare the in-memory follow graph with the ORM")
+    parser.add_argument('--asgi', action='store_true',
+                        help="also compare asgi.py with a synchronous worker")
+    parser.add_argument('--db-latency', type=float, default=DB_LATENCY_MS,
+                        help="milliseconds added to every query under --asgi")
+    parser.add_argument('--out', help="results file (default: benchmark-results/<time>.json)")
+    parser.add_argument('--compare', help="earlier results file to compare with")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        result = run_scale(args.child, args.requests, args.work_dir,
+                           args.processes, args.reuse, args.follow_graph,
+                           args.asgi, args.db_latency)
+        with open(args.out, 'w') as f:
+            json.dump(result, f)
+        return
+
+    started = datetime.utcnow()
+    results = dict(started=started.isoformat(), requests=args.requests, scales={})
+
+    for scale in args.scales.split(','):
+        work_dir = os.path.join(args.work_dir, scale)
+        os.makedirs(work_dir, exist_ok=True)
+
+        url = (args.database_url or f"sqlite:///{work_dir}/warbler.db").format(scale=scale)
+        env = dict(os.environ, DATABASE_URL=url)
+
+        part = os.path.join(work_dir, 'result.json')
+
+        print(f"{scale}: {url}", flush=True)
+        subprocess.run(
+            [sys.executable, __file__, '--child', scale, '--out', part,
+             '--requests', str(args.requests), '--work-dir', work_dir,
+             '--processes', str(args.processes)]
+            + (['--reuse'] if args.reuse else [])
+            + (['--follow-graph'] if args.follow_graph else [])
+            + (['--asgi', '--db-latency', str(args.db_latency)] if args.asgi else []),
+            env=env, check=True)
+
+        with open(part) as f:
+            results['scales'][scale] = json.load(f)
+
+    out = args.out or os.path.join('benchmark-results',
+                                   f"{started:%Y%m%dT%H%M%S}.json")
+    os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {out}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            if not compare(results, json.load(f)):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+"""In-process caches for Warbler."""
+
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from flask import render_template
+from markupsafe import Markup
+
+from models import User, Likes
+
+# how many current-user snapshots each process keeps, and for how long
+# (in seconds) one is trusted before it's reloaded from the database
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 30
+
+# rendered message cards kept per process; entries are also checked
+# against their author's updated_at, so the TTL only bounds memory churn
+FRAGMENT_CACHE_SIZE = 5000
+FRAGMENT_CACHE_TTL = 3600
+
+# users whose known like states are kept per process, and for how long;
+# entries are also checked against the user's Likes.version, so a toggle
+# handled by another process invalidates them too
+LIKE_CACHE_SIZE = 10000
+LIKE_CACHE_TTL = 300
+
+
+class TTLCache:
+    """Bounded least-recently-used cache whose entries expire.
+
+    Safe to share between the threads of a process.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        """Value cached under `key`, or `default` if missing or expired."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                return default
+
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Cache `value` under `key`, evicting the least recently used entry if full."""
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Forget `key`, if it's cached."""
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Forget everything."""
+
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class UserSnapshot:
+    """Read-only copy of a user's columns, shared between requests.
+
+    Stands in for the logged-in user on g.user, so templates and access
+    checks don't need a database round trip. Routes that change the user
+    call `load` to get the real ORM entity.
+    """
+
+    FIELDS = (
+        'id', 'username', 'email', 'image_url', 'header_image_url', 'bio',
+        'location', 'updated_at', 'messages_count', 'following_count',
+        'followers_count', 'likes_count',
+    )
+
+    def __init__(self, user):
+        for field in self.FIELDS:
+            setattr(self, field, getattr(user, field))
+
+    def __repr__(self):
+        return f"<UserSnapshot #{self.id}: {self.username}>"
+
+    def load(self):
+        """The User this is a snapshot of, from the current session."""
+
+        return User.query.get(self.id)
+
+    def is_followed_by(self, other_user):
+        """Is this user followed by `other_user`?"""
+
+        return User.is_followed_by(self, other_user)
+
+    def is_following(self, other_user):
+        """Is this user following `other_user`?"""
+
+        return User.is_following(self, other_user)
+
+
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+
+def get_user_snapshot(user_id):
+    """Snapshot of user `user_id`, or None if there's no such user."""
+
+    snapshot = user_cache.get(user_id)
+
+    if snapshot is None:
+        user = User.query.get(user_id)
+        if user is None:
+            return None
+
+        snapshot = UserSnapshot(user)
+        user_cache.set(user_id, snapshot)
+
+    return snapshot
+
+
+def forget_user(*user_ids):
+    """Drop the cached snapshots of users that have changed."""
+
+    for user_id in user_ids:
+        user_cache.delete(user_id)
+
+
+fragment_cache = TTLCache(FRAGMENT_CACHE_SIZE, FRAGMENT_CACHE_TTL)
+
+
+def message_card(message, author=None):
+    """The rendered messages/card.html fragment for `message`.
+
+    Cached by message id and stamped with the author's updated_at, so a
+    new username or avatar re-renders the card. Message text never
+    changes. Pass `author` when it's already at hand to save the
+    message.user lookup. Anything that depends on who's viewing (like
+    buttons, say) belongs outside the card.
+    """
+
+    author = author or message.user
+    cached = fragment_cache.get(message.id)
+
+    if cached is not None and cached[0] == author.updated_at:
+        return cached[1]
+
+    html = Markup(render_template('messages/card.html',
+                                  message=message, author=author))
+    fragment_cache.set(message.id, (author.updated_at, html))
+
+    return html
+
+
+def forget_message(message_id):
+    """Drop the cached card of a deleted message."""
+
+    fragment_cache.delete(message_id)
+
+
+like_cache = TTLCache(LIKE_CACHE_SIZE, LIKE_CACHE_TTL)
+
+
+def liked_message_ids(user_id, message_ids, version):
+    """The subset of `message_ids` that `user_id` has liked.
+
+    Each user's cache entry maps the message ids looked up so far to
+    whether they're liked, so a page only queries for ids it hasn't
+    seen, and never loads the user's whole like history. The entry is
+    stamped with the user's Likes.version, passed in as `version`, and
+    dropped once that changes.
+    """
+
+    cached_version, known = like_cache.get(user_id) or (version, {})
+    if cached_version != version:
+        known = {}
+
+    missing = [msg_id for msg_id in message_ids if msg_id not in known]
+
+    if missing:
+        liked = Likes.liked_ids(user_id, missing)
+        known = dict(known)
+        known.update((msg_id, msg_id in liked) for msg_id in missing)
+        like_cache.set(user_id, (version, known))
+
+    return {msg_id for msg_id in message_ids if known[msg_id]}
+
+
+def forget_likes(user_id):
+    """Drop the cached like states of a user who has toggled a like."""
+
+    like_cache.delete(user_id)
@@ -0,0 +1,382 @@
+"""In-memory follow graph for Warbler.
+
+With FOLLOW_GRAPH on, each process keeps the whole follows table in
+memory as two compressed sparse row (CSR) indexes, one per direction:
+an offsets array indexed by user id, and one flat array holding every
+user's neighbor ids, sorted, back to back. `following(user_id)` is then
+a slice and `is_following` a binary search, with no database round
+trip at all.
+
+Memory: neighbor ids are int32, stored once per direction, so the graph
+costs 8 bytes per follow plus 8 bytes per user for the offsets, i.e.
+about 8 MB per million follows (and 8 MB per million users). The same
+edges as Python tuples in a set would take well over 100 MB.
+
+Each process starts loading the graph in the background when the app
+is set up, and again every FOLLOW_GRAPH_MAX_AGE seconds; lookups fall
+back to SQL until the first load is done, so no request waits for it.
+With numpy installed the arrays are built with vectorized counting and
+sorting (bincount, cumsum and a stable argsort), leaving reading the
+rows as the main cost; without it, a pure Python build does the same.
+
+Follows made since a load are kept in a small overlay of added and
+removed edges, which the routes update through `record`. A process only
+sees its own processes' writes that way: a follow handled by another
+process shows up here at the next rebuild, so FOLLOW_GRAPH_MAX_AGE is
+also the longest that is_following and the follow lists can lag behind
+the database. Lower it where that matters more than the reload cost.
+"""
+
+import itertools
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+
+from flask import current_app, has_app_context
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# seconds between rebuilds from the database
+FOLLOW_GRAPH_MAX_AGE = 300
+
+
+def _prefix_sums(counts):
+    offsets = array('i', [0]) * (len(counts) + 1)
+    total = 0
+
+    for i, count in enumerate(counts):
+        offsets[i] = total
+        total += count
+
+    offsets[len(counts)] = total
+    return offsets
+
+
+def _offsets(ids, size):
+    """CSR offsets of edges grouped by `ids`, as an array('i')."""
+
+    offsets = numpy.zeros(size + 1, dtype=numpy.int32)
+    numpy.cumsum(numpy.bincount(ids, minlength=size), out=offsets[1:])
+    return _to_array(offsets)
+
+
+def _to_array(values):
+    result = array('i')
+    result.frombytes(numpy.ascontiguousarray(values, dtype=numpy.int32).tobytes())
+    return result
+
+
+class FollowGraph:
+    """Follows in both directions as CSR arrays, plus an overlay of recent changes."""
+
+    def __init__(self, out_offsets, out_ids, in_offsets, in_ids):
+        self._out_offsets = out_offsets
+        self._out_ids = out_ids
+        self._in_offsets = in_offsets
+        self._in_ids = in_ids
+
+        # follower -> followed ids (and back) added or removed since the build
+        self._added_out = defaultdict(set)
+        self._removed_out = defaultdict(set)
+        self._added_in = defaultdict(set)
+        self._removed_in = defaultdict(set)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def build(cls, pairs):
+        """Graph of (follower_id, followed_id) `pairs`, sorted by follower then followed."""
+
+        if numpy is not None:
+            return cls._build_numpy(pairs)
+
+        out_offsets = array('i', [0])
+        out_ids = array('i')
+
+        for follower_id, followed_id in pairs:
+            while len(out_offsets) <= follower_id:
+                out_offsets.append(len(out_ids))
+            out_ids.append(followed_id)
+
+        size = max(len(out_offsets), max(out_ids, default=0) + 1)
+        while len(out_offsets) <= size:
+            out_offsets.append(len(out_ids))
+
+        # counting sort of the same edges by followed user; followers come
+        # out sorted because we walk them in order
+        counts = array('i', [0]) * size
+        for followed_id in out_ids:
+            counts[followed_id] += 1
+
+        in_offsets = _prefix_sums(counts)
+        in_ids = array('i', [0]) * len(out_ids)
+        cursor = array('i', in_offsets)
+
+        for follower_id in range(size):
+            for i in range(out_offsets[follower_id], out_offsets[follower_id + 1]):
+                followed_id = out_ids[i]
+                in_ids[cursor[followed_id]] = follower_id
+                cursor[followed_id] += 1
+
+        return cls(out_offsets, out_ids, in_offsets, in_ids)
+
+    @classmethod
+    def _build_numpy(cls, pairs):
+        edges = numpy.fromiter(itertools.chain.from_iterable(pairs), dtype=numpy.int32)
+        followers, followed = edges[0::2], edges[1::2]
+        size = int(edges.max()) + 1 if len(edges) else 1
+
+        # followers come out sorted within each followed user, since the
+        # sort is stable and the pairs are sorted by follower
+        by_followed = numpy.argsort(followed, kind='stable')
+
+        return cls(_offsets(followers, size), _to_array(followed),
+                   _offsets(followed, size), _to_array(followers[by_followed]))
+
+    @property
+    def size(self):
+        """One more than the highest user id in the arrays."""
+
+        return len(self._out_offsets) - 1
+
+    @property
+    def edges(self):
+        return len(self._out_ids)
+
+    @property
+    def nbytes(self):
+        """Memory held by the arrays (not the overlay)."""
+
+        return sum(a.itemsize * len(a) for a in (self._out_offsets, self._out_ids,
+                                                 self._in_offsets, self._in_ids))
+
+    def following_arrays(self):
+        """The (offsets, ids) arrays of who follows whom, without the overlay."""
+
+        return self._out_offsets, self._out_ids
+
+    def _span(self, offsets, user_id):
+        if 0 <= user_id < self.size:
+            return offsets[user_id], offsets[user_id + 1]
+        return 0, 0
+
+    def _in_base(self, follower_id, followed_id):
+        lo, hi = self._span(self._out_offsets, follower_id)
+        i = bisect_left(self._out_ids, followed_id, lo, hi)
+        return i < hi and self._out_ids[i] == followed_id
+
+    def _neighbors(self, offsets, ids, added, removed, user_id):
+        lo, hi = self._span(offsets, user_id)
+        base = ids[lo:hi]
+
+        with self._lock:
+            plus = added.get(user_id)
+            minus = removed.get(user_id)
+            if not (plus or minus):
+                return base
+            plus, minus = set(plus or ()), set(minus or ())
+
+        return array('i', sorted(plus.union(n for n in base if n not in minus)))
+
+    ##########################################################################
+    # Lookups
+
+    def following(self, user_id):
+        """Sorted ids of the users `user_id` follows."""
+
+        return self._neighbors(self._out_offsets, self._out_ids,
+                               self._added_out, self._removed_out, user_id)
+
+    def followers(self, user_id):
+        """Sorted ids of the users following `user_id`."""
+
+        return self._neighbors(self._in_offsets, self._in_ids,
+                               self._added_in, self._removed_in, user_id)
+
+    def is_following(self, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`?"""
+
+        with self._lock:
+            if followed_id in self._added_out.get(follower_id, ()):
+                return True
+            if followed_id in self._removed_out.get(follower_id, ()):
+                return False
+
+        return self._in_base(follower_id, followed_id)
+
+    def mutuals(self, user_id):
+        """Sorted ids of the users who follow `user_id` back."""
+
+        return sorted(set(self.following(user_id)).intersection(self.followers(user_id)))
+
+    def following_count(self, user_id):
+        return len(self.following(user_id))
+
+    def followers_count(self, user_id):
+        return len(self.followers(user_id))
+
+    ##########################################################################
+    # Changes
+
+    def follow(self, follower_id, followed_id):
+        in_base = self._in_base(follower_id, followed_id)
+
+        with self._lock:
+            if in_base:
+                self._removed_out[follower_id].discard(followed_id)
+                self._removed_in[followed_id].discard(follower_id)
+            else:
+                self._added_out[follower_id].add(followed_id)
+                self._added_in[followed_id].add(follower_id)
+
+    def unfollow(self, follower_id, followed_id):
+        in_base = self._in_base(follower_id, followed_id)
+
+        with self._lock:
+            if in_base:
+                self._removed_out[follower_id].add(followed_id)
+                self._removed_in[followed_id].add(follower_id)
+            else:
+                self._added_out[follower_id].discard(followed_id)
+                self._added_in[followed_id].discard(follower_id)
+
+
+##############################################################################
+# The process's graph
+
+
+class _State:
+    graph = None
+    built_at = 0
+    load = None
+    # changes recorded while a rebuild is reading the database; None
+    # when no rebuild is running
+    replay = None
+    # the process that started the running rebuild
+    pid = None
+
+
+_state = _State()
+_lock = threading.Lock()
+
+
+def _apply(graph, changes):
+    for follower_id, followed_id, following in changes:
+        if following:
+            graph.follow(follower_id, followed_id)
+        else:
+            graph.unfollow(follower_id, followed_id)
+
+
+def _rebuild(app, replay):
+    """Load a fresh graph, then swap it in, with the changes in `replay`."""
+
+    with app.app_context():
+        try:
+            graph = FollowGraph.build(_state.load())
+        except Exception:
+            app.logger.exception("Building the follow graph failed.")
+            graph = None
+
+    with _lock:
+        if _state.replay is not replay:
+            # reset while loading
+            return
+
+        if graph is not None:
+            _apply(graph, replay)
+            _state.graph = graph
+        _state.built_at = time.monotonic()
+        _state.replay = None
+
+
+def _start_rebuild(app):
+    """Start a background rebuild, unless one is already running."""
+
+    with _lock:
+        # a rebuild started before a fork has no thread in this process
+        if _state.replay is not None and _state.pid == os.getpid():
+            return
+        _state.replay = replay = []
+        _state.pid = os.getpid()
+
+    threading.Thread(target=_rebuild, args=(app, replay),
+                     name='follow-graph', daemon=True).start()
+
+
+def build_now():
+    """Build this process's graph in the calling thread. Needs an app context."""
+
+    with _lock:
+        _state.replay = replay = []
+        _state.pid = os.getpid()
+
+    _rebuild(current_app._get_current_object(), replay)
+
+
+def get_graph():
+    """This process's follow graph, or None if FOLLOW_GRAPH is off or it isn't loaded yet.
+
+    Rebuilt in the background once it's older than FOLLOW_GRAPH_MAX_AGE.
+    """
+
+    if not (has_app_context() and current_app.config.get('FOLLOW_GRAPH')):
+        return None
+
+    if (_state.built_at == 0
+            or time.monotonic() - _state.built_at > current_app.config['FOLLOW_GRAPH_MAX_AGE']):
+        _start_rebuild(current_app._get_current_object())
+
+    return _state.graph
+
+
+def record(follower_id, followed_id, following):
+    """Apply a committed follow (or, with `following` False, an unfollow)."""
+
+    with _lock:
+        if _state.graph is not None:
+            _apply(_state.graph, [(follower_id, followed_id, following)])
+        if _state.replay is not None:
+            _state.replay.append((follower_id, followed_id, following))
+
+
+def forget_user(user_id):
+    """Drop every follow of a deleted user."""
+
+    graph = get_graph()
+    if graph is None:
+        return
+
+    for followed_id in graph.following(user_id):
+        record(user_id, followed_id, False)
+    for follower_id in graph.followers(user_id):
+        record(follower_id, user_id, False)
+
+
+def reset():
+    """Forget the graph; the next `get_graph` starts loading it again."""
+
+    with _lock:
+        _state.graph = None
+        _state.built_at = 0
+        _state.replay = None
+
+
+def init_app(app, load):
+    """Use `load()`, yielding (follower_id, followed_id) in order, to build the graph.
+
+    With FOLLOW_GRAPH on, the first build starts straight away.
+    """
+
+    app.config.setdefault('FOLLOW_GRAPH', False)
+    app.config.setdefault('FOLLOW_GRAPH_MAX_AGE', FOLLOW_GRAPH_MAX_AGE)
+
+    _state.load = load
+
+    if app.config['FOLLOW_GRAPH']:
+        _start_rebuild(app)
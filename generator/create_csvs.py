@@ -3,14 +3,31 @@
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
 tweak the CSV formats or generate fewer/more rows.
+
+Run it from the project root like:
+
+    python generator/create_csvs.py
+    python generator/create_csvs.py --users 10000000 --messages 100000000 \\
+        --follows 500000000 --processes 16 --keep-shards
+
+Output is deterministic for a given --seed and --until. Rows are written
+as they're made, so memory stays flat however many are asked for; with
+--processes, shards of each file are written in parallel. Follow targets
+and message authors are drawn from power-law distributions, giving a few
+very popular and very active users and a long tail, like the real thing.
+No network access is needed.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+import shutil
+from datetime import datetime
+from multiprocessing import Pool
+from random import Random
+
 from faker import Faker
-from helpers import get_random_datetime
+from helpers import get_random_datetime, PowerLawSampler
 
 MAX_WARBLER_LENGTH = 140
 
@@ -22,56 +39,191 @@ NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
 
-fake = Faker()
+# skew of follower counts and of how much each user posts
+FOLLOW_ALPHA = 1.2
+MESSAGE_ALPHA = 1.1
+
+# every generated user's password is "password"
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-# Generate random profile image URLs to use for users
+# Random profile image URLs to use for users
 
-image_urls = [
+IMAGE_URLS = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
     for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+# Header images shipped with the app
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
+HEADER_IMAGE_URLS = [
+    "/static/images/warbler-hero.jpg",
+    "/static/images/signed-out-home.jpg",
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
 
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
+def shard_ranges(total, shards):
+    """Split 0..total into `shards` contiguous (start, end) ranges."""
+
+    size, extra = divmod(total, shards)
+    ranges = []
+    start = 0
+
+    for shard in range(shards):
+        end = start + size + (1 if shard < extra else 0)
+        ranges.append((start, end))
+        start = end
+
+    return ranges
+
+
+def shard_rng(options, kind, shard):
+    """Random and Faker instances seeded for one shard of one file."""
+
+    seed = f"{options['seed']}-{kind}-{shard}"
+    fake = Faker()
+    fake.seed_instance(seed)
+
+    return Random(seed), fake
+
+
+def write_users(writer, rng, fake, start, end, options):
+    """Users start+1..end. Usernames and emails embed the id to stay unique."""
+
+    for user_id in range(start + 1, end + 1):
+        writer.writerow(dict(
+            email=f"{user_id}.{fake.email()}",
+            username=f"{fake.user_name()}_{user_id}",
+            image_url=rng.choice(IMAGE_URLS),
+            password=PASSWORD_HASH,
             bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
+            header_image_url=rng.choice(HEADER_IMAGE_URLS),
             location=fake.city()
         ))
 
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
 
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
+def write_messages(writer, rng, fake, start, end, options):
+    """`end - start` messages, by authors drawn from a power law."""
+
+    authors = PowerLawSampler(options['users'], MESSAGE_ALPHA, stride=104729)
+
+    for _ in range(start, end):
+        writer.writerow(dict(
             text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
+            timestamp=get_random_datetime(rng=rng, now=options['until']),
+            user_id=authors.sample(rng)
         ))
 
-# Generate follows.csv from random pairings of users
 
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
+def write_follows(writer, rng, fake, start, end, options):
+    """Follows made by users start+1..end.
+
+    Each follower gets an exponentially distributed number of follows
+    (averaging to the requested total), to distinct users drawn from a
+    power law. Only one follower's picks are held in memory at a time.
+    """
+
+    num_users = options['users']
+    followed = PowerLawSampler(num_users, FOLLOW_ALPHA)
+    mean_follows = options['follows'] / num_users
+    most_follows = (num_users - 1) // 2
+
+    for follower in range(start + 1, end + 1):
+        count = min(int(rng.expovariate(1 / mean_follows)), most_follows) if mean_follows else 0
+        picks = set()
+
+        while len(picks) < count:
+            user_id = followed.sample(rng)
+            if user_id != follower:
+                picks.add(user_id)
+
+        for user_id in sorted(picks):
+            writer.writerow(dict(user_being_followed_id=user_id, user_following_id=follower))
+
+
+FILES = {
+    'users': (USERS_CSV_HEADERS, write_users),
+    'messages': (MESSAGES_CSV_HEADERS, write_messages),
+    'follows': (FOLLOWS_CSV_HEADERS, write_follows),
+}
+
+
+def shard_path(options, kind, shard):
+    return os.path.join(options['out_dir'], f"{kind}.part{shard:04d}.csv")
+
+
+def write_shard(kind, shard, start, end, options):
+    """Write one shard of one CSV file."""
+
+    headers, write_rows = FILES[kind]
+    rng, fake = shard_rng(options, kind, shard)
+
+    with open(shard_path(options, kind, shard), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=headers)
+        writer.writeheader()
+        write_rows(writer, rng, fake, start, end, options)
+
+
+def join_shards(options, kind, shards):
+    """Concatenate the shards of a file, in order, into <kind>.csv."""
+
+    with open(os.path.join(options['out_dir'], f"{kind}.csv"), 'w', newline='') as out:
+        for shard in range(shards):
+            path = shard_path(options, kind, shard)
+
+            with open(path, newline='') as f:
+                header = f.readline()
+                if shard == 0:
+                    out.write(header)
+                shutil.copyfileobj(f, out)
+
+            os.remove(path)
+
+
+def generate(options):
+    """Write users, messages and follows CSVs as described by `options`."""
+
+    shards = options['shards']
+    # follows are sharded by follower, everything else by row
+    totals = {'users': options['users'], 'messages': options['messages'],
+              'follows': options['users']}
+
+    tasks = [(kind, shard, start, end, options)
+             for kind in FILES
+             for shard, (start, end) in enumerate(shard_ranges(totals[kind], shards))]
+
+    if options['processes'] > 1:
+        with Pool(options['processes']) as pool:
+            pool.starmap(write_shard, tasks)
+    else:
+        for task in tasks:
+            write_shard(*task)
+
+    if not options['keep_shards']:
+        for kind in FILES:
+            join_shards(options, kind, shards)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLWERS,
+                        help="roughly how many follows to generate")
+    parser.add_argument('--seed', default='warbler')
+    parser.add_argument('--until', type=datetime.fromisoformat,
+                        default=datetime.now().replace(hour=0, minute=0, second=0,
+                                                       microsecond=0),
+                        help="newest possible message timestamp (default: today)")
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--shards', type=int,
+                        help="pieces to write each file in (default: --processes)")
+    parser.add_argument('--keep-shards', action='store_true',
+                        help="leave <kind>.partNNNN.csv files instead of joining them")
+    parser.add_argument('--out-dir', default='generator')
+    args = parser.parse_args()
 
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
+    options = vars(args)
+    options['shards'] = args.shards or args.processes
 
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+    generate(options)
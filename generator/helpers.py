@@ -1,14 +1,58 @@
 """Support functions for CSV generation."""
 
 from datetime import datetime
+from math import gcd
 from random import uniform
 
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+def get_random_datetime(year_gap=2, rng=None, now=None):
+    """Get a random datetime within the last few years.
 
-    now = datetime.now()
+    Pass a seeded `rng` and a fixed `now` for repeatable output.
+    """
+
+    rand = rng.uniform if rng else uniform
+    now = now or datetime.now()
     then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    random_timestamp = rand(then.timestamp(), now.timestamp())
 
     return datetime.fromtimestamp(random_timestamp)
+
+
+class PowerLawSampler:
+    """Draw ids 1..n where the id of rank r comes up with weight r ** -alpha.
+
+    Uses the inverse CDF of a bounded Pareto distribution, so a draw is
+    O(1) time and memory no matter how large n is. Ranks are spread over
+    the id space by multiplying with a stride coprime to n, so the
+    popular ids aren't simply the lowest ones; different strides give
+    unrelated popularity orders.
+    """
+
+    def __init__(self, n, alpha=1.2, stride=7919):
+        self.n = n
+        self.alpha = alpha
+        self.stride = coprime_stride(n, stride)
+        self._low = 1.0
+        self._span = (n + 1) ** (1 - alpha) - 1
+
+    def rank(self, rng):
+        """Popularity rank (0 is the most popular) of a random draw."""
+
+        u = rng.random()
+        rank = (self._low + u * self._span) ** (1 / (1 - self.alpha))
+        return min(int(rank) - 1, self.n - 1)
+
+    def sample(self, rng):
+        """A random id in 1..n."""
+
+        return (self.rank(rng) * self.stride) % self.n + 1
+
+
+def coprime_stride(n, stride):
+    """Smallest number >= `stride` that shares no factor with `n`."""
+
+    while gcd(stride, n) != 1:
+        stride += 1
+
+    return stride
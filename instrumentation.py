@@ -0,0 +1,159 @@
+"""Per-request SQL instrumentation for Warbler.
+
+With SQL_INSTRUMENTATION on, every statement a request runs is counted
+and timed through SQLAlchemy's cursor events. Each response then gets a
+`Server-Timing` header (visible in the browser's network tab) like:
+
+    Server-Timing: db;dur=12.4;desc="9 queries", app;dur=31.0, nplus1;desc="1 repeated"
+
+Statements are grouped by shape (the SQL with literals and IN lists
+collapsed); a shape run N_PLUS_ONE_THRESHOLD or more times in one
+request is almost always a lazy load in a loop, and is reported as a
+probable N+1. Requests slower than SLOW_REQUEST_MS, or with a probable
+N+1, are logged through `app.logger` along with the offending SQL.
+
+With it off, the only cost is one config lookup per request: the
+engine hooks aren't installed until the first instrumented request.
+"""
+
+import re
+import time
+from collections import Counter
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# a statement shape repeated this often in one request is flagged
+N_PLUS_ONE_THRESHOLD = 5
+
+# longest request, in ms, that isn't logged as slow
+SLOW_REQUEST_MS = 500
+
+# how many of a slow request's statements to log
+LOGGED_STATEMENTS = 5
+
+_listening = False
+
+WHITESPACE = re.compile(r'\s+')
+IN_LIST = re.compile(r'\(\s*(?:\?|%\(\w+\)s|:\w+)(?:\s*,\s*(?:\?|%\(\w+\)s|:\w+))*\s*\)')
+LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def statement_shape(statement):
+    """`statement` with whitespace, literals and IN lists normalized."""
+
+    shape = WHITESPACE.sub(' ', statement).strip()
+    shape = LITERAL.sub('?', shape)
+    return IN_LIST.sub('(?)', shape)
+
+
+class RequestStats:
+    """The statements one request has run so far."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.count = 0
+        self.sql_time = 0.0
+        self.shapes = Counter()
+        self.slowest = []
+
+    def record(self, statement, elapsed):
+        self.count += 1
+        self.sql_time += elapsed
+        self.shapes[statement_shape(statement)] += 1
+        self.slowest.append((elapsed, statement))
+
+        if len(self.slowest) > LOGGED_STATEMENTS * 2:
+            self.slowest.sort(reverse=True)
+            del self.slowest[LOGGED_STATEMENTS:]
+
+    def repeated(self, threshold):
+        """(shape, times) of statements run at least `threshold` times."""
+
+        return [(shape, n) for shape, n in self.shapes.most_common() if n >= threshold]
+
+
+##############################################################################
+# Engine hooks
+
+
+def _current_stats():
+    return g.get('sql_stats') if has_request_context() else None
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # kept on the statement's own context, so one that raises (and never
+    # reaches after_cursor_execute) leaves nothing behind on the connection
+    if context is not None:
+        context.query_started = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, 'query_started', None)
+    stats = _current_stats()
+
+    if started is not None and stats is not None:
+        stats.record(statement, time.perf_counter() - started)
+
+
+def _listen():
+    """Hook every engine, once; later requests pay for this only when on."""
+
+    global _listening
+
+    if not _listening:
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+        _listening = True
+
+
+##############################################################################
+# Request hooks
+
+
+def start_request():
+    if current_app.config['SQL_INSTRUMENTATION']:
+        _listen()
+        g.sql_stats = RequestStats()
+
+
+def finish_request(response):
+    stats = g.pop('sql_stats', None)
+    if stats is None:
+        return response
+
+    config = current_app.config
+    total = (time.perf_counter() - stats.started) * 1000
+    sql_time = stats.sql_time * 1000
+    repeated = stats.repeated(config['N_PLUS_ONE_THRESHOLD'])
+
+    timing = [f'db;dur={sql_time:.1f};desc="{stats.count} queries"', f'app;dur={total:.1f}']
+    if repeated:
+        timing.append(f'nplus1;desc="{len(repeated)} repeated"')
+    response.headers.add('Server-Timing', ', '.join(timing))
+
+    if repeated or total > config['SLOW_REQUEST_MS']:
+        lines = [f"{request.method} {request.full_path.rstrip('?')}: {total:.1f} ms, "
+                 f"{stats.count} queries ({sql_time:.1f} ms in SQL)"]
+
+        for shape, n in repeated:
+            lines.append(f"  probable N+1, run {n} times: {shape}")
+
+        for elapsed, statement in sorted(stats.slowest, reverse=True)[:LOGGED_STATEMENTS]:
+            lines.append(f"  {elapsed * 1000:.1f} ms: {WHITESPACE.sub(' ', statement)}")
+
+        current_app.logger.warning('\n'.join(lines))
+
+    return response
+
+
+def init_app(app):
+    """Register the request hooks; they stay idle unless SQL_INSTRUMENTATION is on."""
+
+    app.config.setdefault('SQL_INSTRUMENTATION', False)
+    app.config.setdefault('N_PLUS_ONE_THRESHOLD', N_PLUS_ONE_THRESHOLD)
+    app.config.setdefault('SLOW_REQUEST_MS', SLOW_REQUEST_MS)
+
+    app.before_request(start_request)
+    app.after_request(finish_request)
@@ -0,0 +1,348 @@
+"""Background jobs for Warbler, queued in the database.
+
+Routes hand slow side effects to `enqueue` and return. The job is a row
+in the jobs table, written in the route's own transaction, so it exists
+exactly when the change that asked for it was committed. There's no
+broker: `flask jobs-worker` starts a pool of processes that poll the
+table on the same database.
+
+A worker claims the oldest job that's due and runs its task. The task's
+writes and the job's completion are committed together. If the task
+raises, the job is retried after JOBS_BACKOFF_SECONDS, then twice that,
+and so on, capped at JOBS_BACKOFF_MAX_SECONDS. After the task's
+max_attempts it's left as failed, with the traceback. A job left
+running longer than JOBS_LOCK_TIMEOUT (its worker died) is claimed
+again.
+
+Jobs enqueued with an idempotency `key` are only queued once. Enqueueing
+the same key again returns the existing job, whatever its state. A task
+may run more than once (a retry after a failure, or after its worker
+died), so tasks must be safe to re-run. Work that has to wait until the
+task's writes are visible, like dropping cached copies of what it
+deleted, goes through `after_commit`.
+
+With JOBS_INLINE on (the default, and what the tests use) `enqueue` runs
+the task straight away in the caller's transaction, with no job row and
+no key check, so nothing needs a worker.
+"""
+
+import json
+import multiprocessing
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+
+from caching import forget_user, forget_likes
+import followgraph
+from models import db, User, Message, Follows, TimelineEntry, Job
+from routing import RoutingSession
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+JOBS_INLINE = True
+JOBS_POLL_SECONDS = 1.0
+JOBS_BACKOFF_SECONDS = 5
+JOBS_BACKOFF_MAX_SECONDS = 3600
+JOBS_LOCK_TIMEOUT = 600
+
+# finished jobs (and their keys) are deleted after this many days
+JOBS_KEEP_DAYS = 7
+
+# how much of a failed attempt's traceback is kept
+MAX_ERROR_LENGTH = 4000
+
+
+class Task:
+    def __init__(self, fn, max_attempts):
+        self.fn = fn
+        self.max_attempts = max_attempts
+
+
+TASKS = {}
+
+
+def task(name, max_attempts=5):
+    """Register the decorated function as the task `name`."""
+
+    def register(fn):
+        TASKS[name] = Task(fn, max_attempts)
+        return fn
+
+    return register
+
+
+def enqueue(name, key=None, delay=0, **payload):
+    """Queue task `name` to run with `payload` in `delay` seconds.
+
+    The job is added to the current session; the caller commits. Returns
+    the Job, or None when run inline.
+    """
+
+    if current_app.config['JOBS_INLINE']:
+        TASKS[name].fn(**payload)
+        return None
+
+    if key is not None:
+        existing = Job.query.filter_by(key=key).first()
+        if existing is not None:
+            return existing
+
+    job = Job(kind=name, key=key, payload=json.dumps(payload),
+              max_attempts=TASKS[name].max_attempts,
+              run_at=datetime.utcnow() + timedelta(seconds=delay))
+
+    # a concurrent request may queue the same key between the check and
+    # the insert; the savepoint keeps the caller's transaction usable
+    try:
+        with db.session.begin_nested():
+            db.session.add(job)
+    except IntegrityError:
+        if key is None:
+            raise
+        return Job.query.filter_by(key=key).one()
+
+    return job
+
+
+def after_commit(fn, *args):
+    """Call `fn(*args)` once the current transaction commits.
+
+    Dropped if it rolls back instead. Inline, that's the caller's
+    commit; in a worker, the commit that marks the job done.
+    """
+
+    db.session.info.setdefault('after_commit', []).append((fn, args))
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _run_after_commit(session):
+    # savepoints fire this too; wait for the outermost commit
+    if session.transaction is not None and session.transaction.nested:
+        return
+
+    for fn, args in session.info.pop('after_commit', []):
+        fn(*args)
+
+
+@event.listens_for(RoutingSession, 'after_soft_rollback')
+def _drop_after_commit(session, previous_transaction):
+    # a savepoint rolling back leaves the outer transaction going
+    if previous_transaction.parent is None:
+        session.info.pop('after_commit', None)
+
+
+##############################################################################
+# Working
+
+
+def backoff(attempts):
+    """Seconds to wait before retrying a job that has failed `attempts` times."""
+
+    config = current_app.config
+    return min(config['JOBS_BACKOFF_SECONDS'] * 2 ** (attempts - 1),
+               config['JOBS_BACKOFF_MAX_SECONDS'])
+
+
+def _claimable(now):
+    stale = now - timedelta(seconds=current_app.config['JOBS_LOCK_TIMEOUT'])
+
+    return db.or_(db.and_(Job.status == QUEUED, Job.run_at <= now),
+                  db.and_(Job.status == RUNNING, Job.locked_at < stale))
+
+
+def claim(batch_size=10):
+    """Mark the oldest due job as running and return it, or None if none are due.
+
+    Several workers may race for the same jobs; the conditional update
+    lets only one of them win each.
+    """
+
+    now = datetime.utcnow()
+
+    candidates = (db.session
+                  .query(Job.id)
+                  .filter(_claimable(now))
+                  .order_by(Job.run_at, Job.id)
+                  .limit(batch_size)
+                  .with_for_update(skip_locked=True)
+                  .all())
+
+    for (job_id,) in candidates:
+        claimed = (Job.query
+                   .filter(Job.id == job_id, _claimable(now))
+                   .update({Job.status: RUNNING, Job.locked_at: now,
+                            Job.attempts: Job.attempts + 1},
+                           synchronize_session=False))
+        db.session.commit()
+
+        if claimed:
+            return Job.query.get(job_id)
+
+    db.session.commit()
+    return None
+
+
+def run(job):
+    """Run a claimed job; its task's writes are committed with its new status."""
+
+    try:
+        if job.attempts > job.max_attempts:
+            raise RuntimeError(f"Gave up after {job.max_attempts} attempts.")
+
+        TASKS[job.kind].fn(**json.loads(job.payload))
+
+        job.status = DONE
+        job.finished_at = datetime.utcnow()
+        job.last_error = None
+        db.session.commit()
+
+    except Exception:
+        error = traceback.format_exc()[-MAX_ERROR_LENGTH:]
+        db.session.rollback()
+
+        job.last_error = error
+        if job.attempts < job.max_attempts:
+            job.status = QUEUED
+            job.run_at = datetime.utcnow() + timedelta(seconds=backoff(job.attempts))
+        else:
+            job.status = FAILED
+            job.finished_at = datetime.utcnow()
+
+        db.session.commit()
+        current_app.logger.warning(f"Job {job.id} ({job.kind}) failed, attempt "
+                                   f"{job.attempts} of {job.max_attempts}:\n{error}")
+
+
+def work_pending():
+    """Run jobs until none are due; returns how many were run."""
+
+    count = 0
+
+    while True:
+        job = claim()
+        if job is None:
+            return count
+
+        run(job)
+        count += 1
+
+
+def prune():
+    """Delete jobs that finished more than JOBS_KEEP_DAYS ago."""
+
+    cutoff = datetime.utcnow() - timedelta(days=current_app.config['JOBS_KEEP_DAYS'])
+
+    (Job.query
+        .filter(Job.status.in_([DONE, FAILED]), Job.finished_at < cutoff)
+        .delete(synchronize_session=False))
+    db.session.commit()
+
+
+def work():
+    """Run jobs as they come due, forever. Needs an app context."""
+
+    pruned = 0
+
+    while True:
+        if not work_pending():
+            if time.monotonic() - pruned > 3600:
+                prune()
+                pruned = time.monotonic()
+
+            db.session.remove()
+            time.sleep(current_app.config['JOBS_POLL_SECONDS'])
+
+
+def _worker_main():
+    from app import app
+
+    with app.app_context():
+        # don't share the parent's connections
+        db.engine.dispose()
+        work()
+
+
+def start_workers(processes):
+    """Run `work` in `processes` worker processes until interrupted."""
+
+    workers = [multiprocessing.Process(target=_worker_main, name=f'jobs-worker-{i}')
+               for i in range(processes)]
+
+    for worker in workers:
+        worker.start()
+
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+
+
+def init_app(app):
+    """Set the job queue defaults."""
+
+    app.config.setdefault('JOBS_INLINE', JOBS_INLINE)
+    app.config.setdefault('JOBS_POLL_SECONDS', JOBS_POLL_SECONDS)
+    app.config.setdefault('JOBS_BACKOFF_SECONDS', JOBS_BACKOFF_SECONDS)
+    app.config.setdefault('JOBS_BACKOFF_MAX_SECONDS', JOBS_BACKOFF_MAX_SECONDS)
+    app.config.setdefault('JOBS_LOCK_TIMEOUT', JOBS_LOCK_TIMEOUT)
+    app.config.setdefault('JOBS_KEEP_DAYS', JOBS_KEEP_DAYS)
+
+
+##############################################################################
+# Tasks
+
+
+@task('fan_out')
+def fan_out(message_id):
+    """Deliver a new message to its author's followers' timelines.
+
+    Entries left by an earlier attempt, or copied in by a follow's
+    backfill before this ran, are replaced rather than inserted twice.
+    """
+
+    message = Message.query.get(message_id)
+    if message is not None:
+        TimelineEntry.remove_message(message_id)
+        TimelineEntry.fan_out(message)
+
+
+@task('sync_timeline')
+def sync_timeline(user_id, followed_id):
+    """Make a user's timeline match whether they follow `followed_id`.
+
+    Run after both follows and unfollows, so it doesn't matter which of
+    two quick toggles' jobs runs last.
+    """
+
+    TimelineEntry.purge(user_id, followed_id)
+
+    if Follows.query.get((followed_id, user_id)):
+        TimelineEntry.backfill(user_id, followed_id)
+
+
+@task('delete_user')
+def delete_user(user_id):
+    """Delete a user, and everything of theirs the database cascades to.
+
+    The route forgets the user's cached snapshot, likes and follows in
+    the web process that took the request; they're forgotten again here
+    once the deletion commits, in case anything re-cached them since.
+    """
+
+    user = User.query.get(user_id)
+    if user is not None:
+        User.release_counts(user_id)
+        db.session.delete(user)
+
+        after_commit(forget_user, user_id)
+        after_commit(forget_likes, user_id)
+        after_commit(followgraph.forget_user, user_id)
@@ -1,12 +1,32 @@
 """SQLAlchemy models for Warbler."""
 
+import heapq
+import re
+from collections import defaultdict
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from flask import g, has_request_context
+from sqlalchemy import DDL, event
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+import followgraph
+import passwords
+import routing
+from passwords import bcrypt, hash_password, check_password, needs_rehash
+
+db = routing.RoutingSQLAlchemy()
+
+# how many messages the home page shows, and how many of a newly
+# followed user's messages are copied into the follower's timeline
+TIMELINE_PAGE_SIZE = 100
+TIMELINE_BACKFILL = 100
+
+# authors with at least this many followers are not fanned out on write;
+# their messages are merged into followers' home pages at read time
+FANOUT_MAX_FOLLOWERS = 10000
+
+# rows fetched per round trip from each message stream being merged; a
+# materialized timeline is read a whole page at a time instead
+MERGE_BATCH_SIZE = 20
 
 
 class Follows(db.Model):
@@ -26,6 +46,61 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # the primary key leads on the followed user; this one answers
+    # "who does this user follow?" without scanning the table
+    __table_args__ = (
+        db.Index('ix_follows_following',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
+    @classmethod
+    def follower_count(cls, user_id):
+        """How many users follow `user_id`?"""
+
+        return (db.session
+                .query(User.followers_count)
+                .filter(User.id == user_id)
+                .scalar()) or 0
+
+    @classmethod
+    def follower_ids(cls, user_id):
+        """Ids of the users following `user_id`."""
+
+        rows = (db.session
+                .query(cls.user_following_id)
+                .filter(cls.user_being_followed_id == user_id))
+
+        return [follower_id for (follower_id,) in rows]
+
+    @classmethod
+    def popular_ids(cls):
+        """Query for ids of users too popular to fan out on write."""
+
+        return (db.session
+                .query(User.id)
+                .filter(User.followers_count >= FANOUT_MAX_FOLLOWERS))
+
+    @classmethod
+    def pairs(cls, batch_size=50000):
+        """Every (follower_id, followed_id), sorted, streamed `batch_size` rows at a time."""
+
+        return (db.session
+                .query(cls.user_following_id, cls.user_being_followed_id)
+                .order_by(cls.user_following_id, cls.user_being_followed_id)
+                .yield_per(batch_size))
+
+    @classmethod
+    def popular_followed_ids(cls, user_id):
+        """Ids of the popular users that `user_id` follows."""
+
+        rows = (db.session
+                .query(cls.user_being_followed_id)
+                .join(User, User.id == cls.user_being_followed_id)
+                .filter(cls.user_following_id == user_id,
+                        User.followers_count >= FANOUT_MAX_FOLLOWERS))
+
+        return [followed_id for (followed_id,) in rows]
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
@@ -45,9 +120,48 @@ class Likes(db.Model):
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
     )
 
+    # one like per user and message; also answers "which of these
+    # messages has this user liked?" from the index alone
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'message_id',
+                            name='uq_likes_user_message'),
+    )
+
+    @classmethod
+    def liked_ids(cls, user_id, message_ids):
+        """The subset of `message_ids` that `user_id` has liked."""
+
+        if not message_ids:
+            return set()
+
+        rows = (db.session
+                .query(cls.message_id)
+                .filter(cls.user_id == user_id,
+                        cls.message_id.in_(message_ids)))
+
+        return {message_id for (message_id,) in rows}
+
+    @classmethod
+    def version(cls, user_id):
+        """(like count, newest like id) of `user_id`, read fresh.
+
+        Every change to the user's likes changes one or the other: a new
+        like gets a higher id than any before it, and an unlike lowers
+        the count unless a newer like makes up for it.
+        """
+
+        newest = (db.session
+                  .query(db.func.max(cls.id))
+                  .filter(cls.user_id == user_id)
+                  .as_scalar())
+
+        return tuple(db.session
+                     .query(User.likes_count, newest)
+                     .filter(User.id == user_id)
+                     .one())
+
 
 class User(db.Model):
     """User in the system."""
@@ -89,11 +203,50 @@ class User(db.Model):
         db.Text,
     )
 
+    # when the public profile (username, avatar, ...) last changed;
+    # cached renderings of the user's messages are stamped with it
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=db.func.now(),
+    )
+
     password = db.Column(
         db.Text,
         nullable=False,
     )
 
+    # denormalized counters, kept current by the routes that change them;
+    # `reconcile_counts` repairs any drift
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -115,20 +268,128 @@ class User(db.Model):
         secondary="likes"
     )
 
+    # trigram indexes behind search.search_users; on Postgres these make
+    # substring and similarity matches index scans instead of table scans
+    __table_args__ = tuple(
+        db.Index(f'ix_users_{column}_trgm', column,
+                 postgresql_using='gin',
+                 postgresql_ops={column: 'gin_trgm_ops'})
+        for column in ('username', 'bio', 'location')
+    )
+
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return _follows_exists(other_user.id, self.id)
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        if _is_current_user(self.id):
+            return other_user.id in following_ids(self.id)
+
+        return _follows_exists(self.id, other_user.id)
+
+    @classmethod
+    def adjust_counts(cls, user_ids, **deltas):
+        """Add `deltas` to the counters of one or more users.
+
+        `user_ids` is a single id, a list of ids or a query selecting ids.
+        Keywords name the counter without its `_count` suffix, e.g.
+        `User.adjust_counts(user.id, followers=1)`. The update is done in
+        SQL, so concurrent requests can't lose each other's increments.
+        """
+
+        if isinstance(user_ids, int):
+            matches = cls.id == user_ids
+        else:
+            matches = cls.id.in_(user_ids)
+
+        counters = {}
+        for name, delta in deltas.items():
+            column = getattr(cls, f"{name}_count")
+            counters[column] = column + delta
+
+        cls.query.filter(matches).update(counters, synchronize_session=False)
+
+    @classmethod
+    def release_counts(cls, user_id):
+        """Take a user about to be deleted out of everyone else's counters."""
+
+        followers = (db.session
+                     .query(Follows.user_following_id)
+                     .filter(Follows.user_being_followed_id == user_id))
+        followed = (db.session
+                    .query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == user_id))
+
+        cls.adjust_counts(followers.subquery(), following=-1)
+        cls.adjust_counts(followed.subquery(), followers=-1)
+
+        # likes of the user's messages disappear with the messages; their
+        # likers are updated by id, grouped by how many they lose
+        likes_lost = (db.session
+                      .query(Likes.user_id, db.func.count(Likes.id))
+                      .join(Message, Message.id == Likes.message_id)
+                      .filter(Message.user_id == user_id,
+                              Likes.user_id != user_id)
+                      .group_by(Likes.user_id))
+
+        likers_by_loss = defaultdict(list)
+        for liker_id, lost in likes_lost:
+            likers_by_loss[lost].append(liker_id)
+
+        for lost, liker_ids in likers_by_loss.items():
+            cls.adjust_counts(liker_ids, likes=-lost)
+
+    @classmethod
+    def reconcile_counts(cls, batch_size=10000):
+        """Recompute every user's counters from the source tables.
+
+        Only users whose counters have drifted are written. Users are
+        done `batch_size` ids at a time, and each count is a range scan
+        of an index that leads on the user's id, so the work grows with
+        the rows counted rather than users times rows. Returns the
+        number of users that were fixed.
+        """
+
+        actual = {
+            cls.messages_count: (db.session
+                                 .query(db.func.count(Message.id))
+                                 .filter(Message.user_id == cls.id)
+                                 .as_scalar()),
+            cls.following_count: (db.session
+                                  .query(db.func.count())
+                                  .select_from(Follows)
+                                  .filter(Follows.user_following_id == cls.id)
+                                  .as_scalar()),
+            cls.followers_count: (db.session
+                                  .query(db.func.count())
+                                  .select_from(Follows)
+                                  .filter(Follows.user_being_followed_id == cls.id)
+                                  .as_scalar()),
+            cls.likes_count: (db.session
+                              .query(db.func.count(Likes.id))
+                              .filter(Likes.user_id == cls.id)
+                              .as_scalar()),
+        }
+
+        drifted = db.or_(*[column != count for column, count in actual.items()])
+
+        lowest, highest = db.session.query(db.func.min(cls.id), db.func.max(cls.id)).one()
+        if lowest is None:
+            return 0
+
+        fixed = 0
+        for start in range(lowest, highest + 1, batch_size):
+            fixed += (cls.query
+                      .filter(cls.id >= start, cls.id < start + batch_size, drifted)
+                      .update(actual, synchronize_session=False))
+
+        return fixed
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -137,7 +398,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hash_password(password)
 
         user = User(
             username=username,
@@ -162,13 +423,42 @@ class User(db.Model):
 
         user = cls.query.filter_by(username=username).first()
 
-        if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
-            if is_auth:
-                return user
+        if user and user.check_password(password):
+            return user
 
         return False
 
+    def check_password(self, password):
+        """Is `password` this user's password?
+
+        On a match, a hash made with an outdated work factor is replaced
+        with one at the current factor; the caller commits it.
+        """
+
+        if not check_password(self.password, password):
+            return False
+
+        if needs_rehash(self.password):
+            self.password = hash_password(password)
+
+        return True
+
+
+event.listen(
+    User.__table__,
+    'before_create',
+    DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'),
+)
+
+# lowercased usernames in index order, for search.search_users' prefix
+# matches on terms too short for the trigram indexes
+event.listen(
+    User.__table__,
+    'after_create',
+    DDL('CREATE INDEX ix_users_username_prefix ON users '
+        '(lower(username) text_pattern_ops)').execute_if(dialect='postgresql'),
+)
+
 
 class Message(db.Model):
     """An individual message ("warble")."""
@@ -188,7 +478,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -199,6 +489,609 @@ class Message(db.Model):
 
     user = db.relationship('User')
 
+    # backs "messages by this user, older than (timestamp, id)" range scans
+    __table_args__ = (
+        db.Index('ix_messages_user_timestamp_id',
+                 'user_id', 'timestamp', 'id'),
+    )
+
+    CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+
+    @property
+    def cursor(self):
+        """Opaque keyset cursor for "messages older than this one"."""
+
+        return self.make_cursor(self.timestamp, self.id)
+
+    @classmethod
+    def make_cursor(cls, timestamp, msg_id):
+        """Cursor for a message known only by its (timestamp, id)."""
+
+        return f"{timestamp.strftime(cls.CURSOR_FORMAT)}-{msg_id}"
+
+    @classmethod
+    def parse_cursor(cls, cursor):
+        """Turn a cursor back into a (timestamp, id) pair.
+
+        Raises ValueError if the cursor is malformed.
+        """
+
+        timestamp, _, msg_id = cursor.partition('-')
+        return (datetime.strptime(timestamp, cls.CURSOR_FORMAT), int(msg_id))
+
+
+class TimelineEntry(db.Model):
+    """A message delivered to a follower's home timeline.
+
+    Rows are written when a message is posted (fan-out on write), so the
+    home page only has to read the newest entries of a single user.
+    """
+
+    __tablename__ = 'timelines'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # copied from the message so the timeline can be read in order
+    # straight off the index, without touching the messages table
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timelines_user_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+        db.Index('ix_timelines_message_id', 'message_id'),
+    )
+
+    @classmethod
+    def fan_out(cls, message):
+        """Deliver `message` to the timeline of every follower of its author.
+
+        The message must already be flushed so that it has an id. Messages
+        by popular authors are skipped; `home_timeline` merges them in.
+        """
+
+        if Follows.follower_count(message.user_id) >= FANOUT_MAX_FOLLOWERS:
+            return
+
+        followers = (db.session
+                     .query(Follows.user_following_id,
+                            db.literal(message.id),
+                            db.literal(message.timestamp))
+                     .filter(Follows.user_being_followed_id == message.user_id))
+
+        db.session.execute(cls.__table__.insert().from_select(
+            ['user_id', 'message_id', 'timestamp'], followers.statement))
+
+    @classmethod
+    def backfill(cls, user_id, followed_id, limit=TIMELINE_BACKFILL):
+        """Copy the newest messages of `followed_id` into a user's timeline."""
+
+        if Follows.follower_count(followed_id) >= FANOUT_MAX_FOLLOWERS:
+            return
+
+        newest = (db.session
+                  .query(db.literal(user_id), Message.id, Message.timestamp)
+                  .filter(Message.user_id == followed_id)
+                  .order_by(Message.timestamp.desc(), Message.id.desc())
+                  .limit(limit))
+
+        db.session.execute(cls.__table__.insert().from_select(
+            ['user_id', 'message_id', 'timestamp'], newest.statement))
+
+    @classmethod
+    def purge(cls, user_id, followed_id):
+        """Remove the messages of `followed_id` from a user's timeline."""
+
+        followed_messages = (db.session
+                             .query(Message.id)
+                             .filter(Message.user_id == followed_id))
+
+        (cls.query
+            .filter(cls.user_id == user_id,
+                    cls.message_id.in_(followed_messages.subquery()))
+            .delete(synchronize_session=False))
+
+    @classmethod
+    def remove_message(cls, message_id):
+        """Remove a message from every timeline it was delivered to."""
+
+        (cls.query
+            .filter(cls.message_id == message_id)
+            .delete(synchronize_session=False))
+
+    @classmethod
+    def rebuild(cls):
+        """Recompute every timeline from the follows and messages tables."""
+
+        cls.query.delete(synchronize_session=False)
+
+        entries = (db.session
+                   .query(Follows.user_following_id, Message.id, Message.timestamp)
+                   .join(Message,
+                         Message.user_id == Follows.user_being_followed_id)
+                   .filter(~Follows.user_being_followed_id.in_(
+                       Follows.popular_ids().subquery())))
+
+        db.session.execute(cls.__table__.insert().from_select(
+            ['user_id', 'message_id', 'timestamp'], entries.statement))
+
+    @classmethod
+    def stream(cls, user_id, before=None, batch_size=MERGE_BATCH_SIZE):
+        """Iterate over a user's timeline, newest first."""
+
+        query = (Message
+                 .query
+                 .join(cls, cls.message_id == Message.id)
+                 .filter(cls.user_id == user_id)
+                 .options(db.joinedload(Message.user)))
+
+        return iter_messages(query, cls.timestamp, cls.message_id,
+                             before=before, batch_size=batch_size)
+
+
+class MessageTerm(db.Model):
+    """Posting in the inverted index over message text.
+
+    One row per distinct term of a message; `search.search_messages`
+    reads them back newest first.
+    """
+
+    __tablename__ = 'message_terms'
+
+    term = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # copied from the message so a term's postings come off the index
+    # already in keyset order
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_message_terms_term_timestamp',
+                 'term', 'timestamp', 'message_id'),
+        db.Index('ix_message_terms_message_id', 'message_id'),
+    )
+
+    @classmethod
+    def index_message(cls, message):
+        """Add the postings for a flushed message."""
+
+        db.session.bulk_insert_mappings(cls, [
+            dict(term=term, message_id=message.id, timestamp=message.timestamp)
+            for term in tokenize(message.text)
+        ])
+
+    @classmethod
+    def unindex_message(cls, message):
+        """Remove the postings for a message."""
+
+        (cls.query
+            .filter(cls.message_id == message.id)
+            .delete(synchronize_session=False))
+
+    @classmethod
+    def rebuild(cls, batch_size=1000):
+        """Re-index every message from scratch."""
+
+        cls.query.delete(synchronize_session=False)
+
+        rows = (db.session
+                .query(Message.id, Message.text, Message.timestamp)
+                .order_by(Message.id)
+                .yield_per(batch_size))
+
+        postings = []
+        for msg_id, text, timestamp in rows:
+            postings.extend(dict(term=term, message_id=msg_id, timestamp=timestamp)
+                            for term in tokenize(text))
+
+            if len(postings) >= batch_size:
+                db.session.bulk_insert_mappings(cls, postings)
+                postings = []
+
+        db.session.bulk_insert_mappings(cls, postings)
+
+
+# words too common to be worth a posting list
+STOP_WORDS = frozenset("""
+    a an and are as at be but by for from has have i in is it its of on or
+    so that the this to was were will with
+""".split())
+
+MAX_TERM_LENGTH = 40
+
+
+def tokenize(text):
+    """The set of searchable terms in `text`.
+
+    Terms are lowercased words, numbers, #hashtags and @mentions, minus
+    stop words and single characters.
+    """
+
+    words = re.findall(r"[#@]?\w+", text.lower())
+
+    return {word[:MAX_TERM_LENGTH] for word in words
+            if len(word) > 1 and word not in STOP_WORDS}
+
+
+class Suggestion(db.Model):
+    """A precomputed "who to follow" suggestion; see suggestions.py."""
+
+    __tablename__ = 'suggestions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    suggested_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # how many of the users `user_id` follows follow `suggested_id`
+    score = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # 0 for the best suggestion
+    rank = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_suggestions_user_rank', 'user_id', 'rank'),
+        db.Index('ix_suggestions_suggested_id', 'suggested_id'),
+    )
+
+    @classmethod
+    def for_user(cls, user_id, limit):
+        """The best `limit` suggested users that `user_id` doesn't already follow."""
+
+        followed = Follows.query.filter(Follows.user_following_id == user_id,
+                                        Follows.user_being_followed_id == cls.suggested_id)
+
+        return (User
+                .query
+                .join(cls, cls.suggested_id == User.id)
+                .filter(cls.user_id == user_id, ~followed.exists())
+                .order_by(cls.rank)
+                .limit(limit)
+                .all())
+
+
+class SuggestionRefresh(db.Model):
+    """A user whose suggestions are out of date since they followed or unfollowed."""
+
+    __tablename__ = 'suggestion_refreshes'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # no foreign key: the mark outlives a deleted user, whose followers
+    # still need refreshing
+    user_id = db.Column(
+        db.Integer,
+        nullable=False,
+        index=True,
+    )
+
+    @classmethod
+    def request(cls, *user_ids):
+        """Mark `user_ids` for the next `flask refresh-suggestions`."""
+
+        if user_ids:
+            db.session.execute(cls.__table__.insert(),
+                               [dict(user_id=user_id) for user_id in user_ids])
+
+
+class TrendingBucket(db.Model):
+    """Checkpointed hashtag counts for one time bucket; see trending.py."""
+
+    __tablename__ = 'trending_buckets'
+
+    # seconds since the epoch divided by TRENDING_BUCKET_SECONDS
+    bucket = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    # the bucket's count-min sketch, as packed counters
+    sketch = db.Column(
+        db.LargeBinary,
+        nullable=False,
+    )
+
+    # JSON list of the bucket's best tags, since a sketch can't list them
+    tags = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+
+class Job(db.Model):
+    """A piece of deferred work, run by `flask jobs-worker`; see jobs.py."""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # name of the task to run, and its keyword arguments as JSON
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    payload = db.Column(
+        db.Text,
+        nullable=False,
+        default='{}',
+    )
+
+    # enqueueing again with the same key returns this job instead
+    key = db.Column(
+        db.Text,
+        unique=True,
+    )
+
+    # queued, running, done or failed
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default='queued',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # not run before this; pushed back after each failed attempt
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    # when a worker claimed it; a job running for too long is reclaimed
+    locked_at = db.Column(
+        db.DateTime,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+
+    def __repr__(self):
+        return f"<Job #{self.id}: {self.kind} {self.status}>"
+
+
+##############################################################################
+# Relationship lookups
+
+
+def _is_current_user(user_id):
+    """Are we in a request made by `user_id`?"""
+
+    if not has_request_context():
+        return False
+
+    user = g.get('user')
+    return user is not None and user.id == user_id
+
+
+def _follows_exists(follower_id, followed_id):
+    """Does `follower_id` follow `followed_id`? Checked with one EXISTS query."""
+
+    graph = followgraph.get_graph()
+    if graph is not None:
+        return graph.is_following(follower_id, followed_id)
+
+    follow = Follows.query.filter(Follows.user_following_id == follower_id,
+                                  Follows.user_being_followed_id == followed_id)
+
+    return db.session.query(follow.exists()).scalar()
+
+
+def following_ids(user_id):
+    """Set of the ids `user_id` follows.
+
+    Loaded with a single range scan of the follows primary key the first
+    time it's needed in a request and shared for the rest of it, so pages
+    that check is_following for every card do one query instead of one
+    per card. With the follow graph on, the set comes from memory instead.
+    """
+
+    cache = g.setdefault('following_ids', {})
+
+    if user_id not in cache:
+        graph = followgraph.get_graph()
+
+        if graph is not None:
+            following = set(graph.following(user_id))
+
+        else:
+            following = {followed_id for (followed_id,) in (
+                db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == user_id))}
+
+        # follows the current user has queued but not yet written
+        if _is_current_user(user_id):
+            for followed_id, wanted in g.get('pending_follows', {}).items():
+                (following.add if wanted else following.discard)(followed_id)
+
+        cache[user_id] = following
+
+    return cache[user_id]
+
+
+def forget_following_ids(user_id):
+    """Drop the request's cached following ids for `user_id`."""
+
+    if has_request_context():
+        g.get('following_ids', {}).pop(user_id, None)
+
+
+##############################################################################
+# Timeline merging
+
+
+def _recency(message):
+    return (message.timestamp, message.id)
+
+
+def iter_messages(query, timestamp_col=Message.timestamp, id_col=Message.id,
+                  before=None, batch_size=MERGE_BATCH_SIZE):
+    """Iterate over the messages of `query`, newest first.
+
+    Rows are fetched `batch_size` at a time, each batch resuming strictly
+    after the (timestamp, id) of the last message seen, so a consumer that
+    stops early never pays for the rest of the stream.
+    """
+
+    while True:
+        page = query
+        if before is not None:
+            page = page.filter(db.tuple_(timestamp_col, id_col) < before)
+
+        batch = (page
+                 .order_by(timestamp_col.desc(), id_col.desc())
+                 .limit(batch_size)
+                 .all())
+
+        yield from batch
+
+        if len(batch) < batch_size:
+            return
+
+        before = _recency(batch[-1])
+
+
+def user_messages(user_id, before=None, batch_size=MERGE_BATCH_SIZE):
+    """Iterate over the messages written by `user_id`, newest first."""
+
+    query = (Message
+             .query
+             .filter(Message.user_id == user_id)
+             .options(db.joinedload(Message.user)))
+
+    return iter_messages(query, before=before, batch_size=batch_size)
+
+
+def merge_streams(streams, limit):
+    """Heap-merge newest-first message streams into one list of `limit`.
+
+    Only as many rows as needed are pulled from each stream. A message
+    appearing in more than one stream is returned once.
+    """
+
+    merged = heapq.merge(*streams, key=_recency, reverse=True)
+    messages = []
+
+    for msg in merged:
+        if messages and messages[-1].id == msg.id:
+            continue
+
+        messages.append(msg)
+        if len(messages) == limit:
+            break
+
+    return messages
+
+
+def next_cursor(messages, limit):
+    """Cursor for the page after `messages`, fetched as `limit + 1` rows.
+
+    Returns None on the last page.
+    """
+
+    if len(messages) > limit:
+        return messages[limit - 1].cursor
+
+    return None
+
+
+def merged_timeline(user_ids, limit=TIMELINE_PAGE_SIZE, before=None,
+                    batch_size=MERGE_BATCH_SIZE):
+    """Newest `limit` messages written by any of `user_ids`, merged at read time."""
+
+    batch_size = min(batch_size, limit)
+    streams = [user_messages(user_id, before, batch_size)
+               for user_id in user_ids]
+
+    return merge_streams(streams, limit)
+
+
+def home_timeline(user_id, limit=TIMELINE_PAGE_SIZE, before=None,
+                  batch_size=MERGE_BATCH_SIZE):
+    """Newest `limit` messages for a user's home page.
+
+    Merges the user's materialized timeline with the messages of the
+    popular accounts they follow, which are never fanned out. The
+    timeline is read in one query of `limit` rows; only the popular
+    accounts' streams are read in batches.
+    """
+
+    batch_size = min(batch_size, limit)
+    streams = [TimelineEntry.stream(user_id, before, limit)]
+    streams.extend(user_messages(followed_id, before, batch_size)
+                   for followed_id in Follows.popular_followed_ids(user_id))
+
+    return merge_streams(streams, limit)
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -208,3 +1101,5 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+    routing.init_app(app)
+    passwords.init_app(app)
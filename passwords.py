@@ -0,0 +1,117 @@
+"""Password hashing for Warbler.
+
+bcrypt is deliberately slow. It releases the GIL while it works, so a
+login storm would otherwise have every request thread of a process
+hashing at once and starve the reads sharing its CPU. Hashes run off
+the request thread instead, on a pool of PASSWORD_HASH_WORKERS threads
+per process; logins beyond that queue for the pool without burning
+CPU, and reads keep flowing. A login that has waited
+PASSWORD_HASH_TIMEOUT seconds for its hash gives up with a 503 rather
+than holding its request thread indefinitely behind the queue.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from time import perf_counter
+
+from flask_bcrypt import Bcrypt
+from werkzeug.exceptions import ServiceUnavailable
+
+DEFAULT_LOG_ROUNDS = 12
+DEFAULT_HASH_WORKERS = 2
+DEFAULT_HASH_TIMEOUT = 10
+
+bcrypt = Bcrypt()
+
+
+def _make_pool(workers):
+    return ThreadPoolExecutor(workers, thread_name_prefix='password-hash')
+
+
+_pool = _make_pool(DEFAULT_HASH_WORKERS)
+_timeout = DEFAULT_HASH_TIMEOUT
+_log_rounds = DEFAULT_LOG_ROUNDS
+
+
+def init_app(app):
+    """Configure hashing from the app's config.
+
+    BCRYPT_LOG_ROUNDS is the work factor new hashes get,
+    PASSWORD_HASH_WORKERS how many hashes may run at once and
+    PASSWORD_HASH_TIMEOUT how many seconds a caller waits for one.
+    """
+
+    global _pool, _timeout, _log_rounds
+
+    app.config.setdefault('BCRYPT_LOG_ROUNDS', DEFAULT_LOG_ROUNDS)
+    app.config.setdefault('PASSWORD_HASH_WORKERS', DEFAULT_HASH_WORKERS)
+    app.config.setdefault('PASSWORD_HASH_TIMEOUT', DEFAULT_HASH_TIMEOUT)
+
+    bcrypt.init_app(app)
+    _log_rounds = app.config['BCRYPT_LOG_ROUNDS']
+    _timeout = app.config['PASSWORD_HASH_TIMEOUT']
+
+    _pool.shutdown(wait=False)
+    _pool = _make_pool(app.config['PASSWORD_HASH_WORKERS'])
+
+
+def _run(fn, *args):
+    """Run `fn` on the hashing pool and wait for its result.
+
+    Raises ServiceUnavailable if it isn't done within the timeout; a
+    hash still queued by then is dropped.
+    """
+
+    future = _pool.submit(fn, *args)
+
+    try:
+        return future.result(timeout=_timeout)
+    except TimeoutError:
+        future.cancel()
+        raise ServiceUnavailable("Too many logins at once; please try again shortly.")
+
+
+def hash_password(password):
+    """Hash `password` at the configured work factor."""
+
+    return _run(bcrypt.generate_password_hash, password).decode('UTF-8')
+
+
+def check_password(pw_hash, password):
+    """Does `password` match `pw_hash`?"""
+
+    return _run(bcrypt.check_password_hash, pw_hash, password)
+
+
+def hash_rounds(pw_hash):
+    """The work factor `pw_hash` was made with."""
+
+    # bcrypt hashes look like $2b$<rounds>$<salt and hash>
+    return int(pw_hash.split('$')[2])
+
+
+def needs_rehash(pw_hash):
+    """Was `pw_hash` made with a different work factor than the current one?"""
+
+    return hash_rounds(pw_hash) != _log_rounds
+
+
+def calibrate_rounds(target_seconds, min_rounds=4, max_rounds=16):
+    """Highest work factor whose hash takes at most `target_seconds` here.
+
+    Each extra round doubles the cost, so this stops at the first factor
+    that's too slow. Never returns less than `min_rounds`.
+    """
+
+    rounds = min_rounds
+
+    for candidate in range(min_rounds, max_rounds + 1):
+        start = perf_counter()
+        bcrypt.generate_password_hash('calibration', candidate)
+        elapsed = perf_counter() - start
+
+        if elapsed > target_seconds:
+            break
+
+        rounds = candidate
+
+    return rounds
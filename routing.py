@@ -0,0 +1,113 @@
+"""Read-replica routing and connection pool settings for Warbler.
+
+Set DATABASE_REPLICA_URL and the views decorated with `@replica_reads`
+run their queries against the replica (the 'replica' entry of
+SQLALCHEMY_BINDS) instead of the primary. Everything else, and any
+session that has written, stays on the primary:
+
+- a session that flushes, or executes an INSERT/UPDATE/DELETE, uses the
+  primary for the rest of its life;
+- a browser whose request wrote is kept on the primary for
+  REPLICA_STICKY_SECONDS afterwards, so the page it's redirected to
+  doesn't read from a replica that hasn't caught up yet.
+
+asgi.py routes its native endpoints the same way, through
+`replica_allowed` and g.read_replica.
+
+Without a replica configured, `@replica_reads` does nothing.
+"""
+
+import time
+from functools import wraps
+
+from flask import current_app, g, has_app_context, has_request_context, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm
+from sqlalchemy.sql.dml import UpdateBase
+
+REPLICA = 'replica'
+
+# seconds a browser reads from the primary after it has written
+REPLICA_STICKY_SECONDS = 5
+
+STICKY_KEY = 'primary_until'
+
+
+class RoutingSession(SignallingSession):
+    """Session reading from the replica while a `@replica_reads` view runs."""
+
+    def __init__(self, db, **options):
+        super().__init__(db, **options)
+        self.db = db
+        self.wrote = False
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.wrote = True
+            if has_request_context():
+                g.wrote_primary = True
+
+        elif not self.wrote and self._reading_replica():
+            return self.db.get_engine(self.app, bind=REPLICA)
+
+        return super().get_bind(mapper, clause)
+
+    def _reading_replica(self):
+        return (has_app_context()
+                and g.get('read_replica', False)
+                and REPLICA in (self.app.config['SQLALCHEMY_BINDS'] or {}))
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy whose sessions can read from a replica."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def replica_allowed(session):
+    """May a browser with this (decoded) `session` read from the replica?"""
+
+    return session.get(STICKY_KEY, 0) < time.time()
+
+
+def replica_reads(view):
+    """Decorate read-only views that can tolerate slightly stale data."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.read_replica = replica_allowed(session)
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+def stick_to_primary(response):
+    """Keep a browser that has just written on the primary for a little while."""
+
+    if g.get('wrote_primary'):
+        session[STICKY_KEY] = time.time() + current_app.config['REPLICA_STICKY_SECONDS']
+
+    return response
+
+
+def pool_options(url, pool_size, max_overflow, pool_recycle, pool_pre_ping=True):
+    """SQLALCHEMY_ENGINE_OPTIONS for a database URL.
+
+    SQLite has no connection pool to size, so it gets no options.
+    """
+
+    if url.startswith('sqlite'):
+        return {}
+
+    return dict(pool_size=pool_size, max_overflow=max_overflow,
+                pool_recycle=pool_recycle, pool_pre_ping=pool_pre_ping)
+
+
+def init_app(app):
+    """Register the primary-stickiness hook with `app`."""
+
+    app.config.setdefault('SQLALCHEMY_BINDS', None)
+    app.config.setdefault('REPLICA_STICKY_SECONDS', REPLICA_STICKY_SECONDS)
+
+    app.after_request(stick_to_primary)
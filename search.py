@@ -0,0 +1,137 @@
+"""Search for Warbler users and messages."""
+
+from models import db, User, Message, MessageTerm, tokenize
+
+# most results a user search will ever return
+USER_SEARCH_LIMIT = 50
+
+MESSAGE_SEARCH_PAGE_SIZE = 20
+
+# shortest term matched anywhere in a username, bio or location; trigram
+# indexes can't serve shorter ones, so those only match username prefixes
+MIN_SUBSTRING_LENGTH = 3
+
+
+def escape_like(term):
+    """Escape the LIKE wildcards in user input."""
+
+    return (term
+            .replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+def search_users(term, limit=USER_SEARCH_LIMIT):
+    """Find users matching `term` by username, bio or location.
+
+    Results are ranked: exact username matches first, then username
+    prefixes, then other username matches, then bio/location matches.
+    On Postgres, matching uses the trigram indexes on users (which also
+    catch near-miss usernames) and ties are broken by similarity. Other
+    databases get the same ranking over a plain LIKE scan, which is fine
+    for development and tests.
+
+    Terms shorter than MIN_SUBSTRING_LENGTH only match the start of
+    usernames; see `search_username_prefix`.
+
+    Returns at most `limit` users.
+    """
+
+    term = term.strip()
+    if not term:
+        return []
+
+    if len(term) < MIN_SUBSTRING_LENGTH:
+        return search_username_prefix(term, limit)
+
+    escaped = escape_like(term)
+    contains = f"%{escaped}%"
+
+    username_match = User.username.ilike(contains, escape='\\')
+    matches = [
+        username_match,
+        User.bio.ilike(contains, escape='\\'),
+        User.location.ilike(contains, escape='\\'),
+    ]
+
+    rank = db.case(
+        [
+            (db.func.lower(User.username) == term.lower(), 0),
+            (User.username.ilike(f"{escaped}%", escape='\\'), 1),
+            (username_match, 2),
+        ],
+        else_=3,
+    )
+    order = [rank]
+
+    if db.session.bind.dialect.name == 'postgresql':
+        similarity = db.func.similarity(User.username, term)
+        matches.append(User.username.op('%')(term))
+        order.append(similarity.desc())
+
+    return (User
+            .query
+            .filter(db.or_(*matches))
+            .order_by(*order, User.username)
+            .limit(limit)
+            .all())
+
+
+def search_username_prefix(term, limit=USER_SEARCH_LIMIT):
+    """Users whose username starts with `term`, ignoring case.
+
+    Reads the lower(username) index in order, so it stops after `limit`
+    users however many match. An exact match sorts first, since it's a
+    prefix of every other match.
+    """
+
+    lowered = db.func.lower(User.username)
+
+    return (User
+            .query
+            .filter(lowered.like(f"{escape_like(term.lower())}%", escape='\\'))
+            .order_by(lowered)
+            .limit(limit)
+            .all())
+
+
+def search_messages(text, before=None, limit=MESSAGE_SEARCH_PAGE_SIZE):
+    """Newest messages containing every term of `text`.
+
+    Reads the inverted index in message_terms: the postings of one term
+    are walked newest first from `before` (a (timestamp, id) pair), and
+    each candidate must have a posting for every other term too. The
+    longest term drives the scan since it's usually the rarest.
+
+    Returns up to `limit` messages with their authors loaded.
+    """
+
+    terms = sorted(tokenize(text), key=len, reverse=True)
+    if not terms:
+        return []
+
+    driver, others = terms[0], terms[1:]
+
+    query = (Message
+             .query
+             .join(MessageTerm, MessageTerm.message_id == Message.id)
+             .filter(MessageTerm.term == driver)
+             .options(db.joinedload(Message.user)))
+
+    for term in others:
+        posting = db.aliased(MessageTerm)
+        query = query.filter(
+            db.session
+            .query(posting)
+            .filter(posting.term == term,
+                    posting.message_id == MessageTerm.message_id)
+            .exists())
+
+    if before is not None:
+        query = query.filter(
+            db.tuple_(MessageTerm.timestamp, MessageTerm.message_id) < before)
+
+    return (query
+            .order_by(MessageTerm.timestamp.desc(), MessageTerm.message_id.desc())
+            .limit(limit)
+            .all())
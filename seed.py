@@ -1,20 +1,187 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
+
+Run it like:
+
+    python seed.py
+    python seed.py --chunk-rows 100000 --messages part-0.csv part-1.csv
+
+The CSVs are streamed into the database a chunk at a time, never held
+in memory whole: with COPY FROM STDIN on Postgres, and batched INSERTs
+elsewhere (SQLite, in tests). Secondary indexes are dropped while
+loading and rebuilt once at the end, unless --keep-indexes is given.
+"""
+
+import argparse
+import csv
+import io
+import time
+from contextlib import contextmanager
+from itertools import islice
 
-from csv import DictReader
 from app import db
-from models import User, Message, Follows
+from models import User, Message, Follows, MessageTerm, TimelineEntry
+
+CHUNK_ROWS = 50000
+
+USERS_CSV = ['generator/users.csv']
+MESSAGES_CSV = ['generator/messages.csv']
+FOLLOWS_CSV = ['generator/follows.csv']
+
+
+def read_chunks(path, chunk_rows):
+    """The header of the CSV at `path`, and an iterator over its rows in chunks."""
+
+    f = open(path, newline='')
+    reader = csv.reader(f)
+    header = next(reader)
+
+    def chunks():
+        with f:
+            while True:
+                chunk = list(islice(reader, chunk_rows))
+                if not chunk:
+                    return
+                yield chunk
+
+    return header, chunks()
+
+
+def copy_chunk(connection, table, header, rows):
+    """Load `rows` into `table` with Postgres' COPY FROM STDIN."""
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    with connection.connection.cursor() as cursor:
+        cursor.copy_expert(
+            f"COPY {table.name} ({', '.join(header)}) FROM STDIN WITH (FORMAT csv)",
+            buffer)
+
+
+def insert_chunk(connection, table, header, rows):
+    """Load `rows` into `table` with one batched INSERT."""
+
+    insert = db.text(f"INSERT INTO {table.name} ({', '.join(header)}) "
+                     f"VALUES ({', '.join(':' + col for col in header)})")
+
+    connection.execute(insert, [dict(zip(header, row)) for row in rows])
+
+
+def load_csvs(table, paths, chunk_rows=CHUNK_ROWS):
+    """Stream the CSVs at `paths` into `table`. Returns the number of rows."""
+
+    connection = db.session.connection()
+
+    if connection.dialect.name == 'postgresql':
+        load_chunk = copy_chunk
+    else:
+        load_chunk = insert_chunk
+
+    loaded = 0
+    start = time.perf_counter()
+
+    for path in paths:
+        header, chunks = read_chunks(path, chunk_rows)
+        for rows in chunks:
+            load_chunk(connection, table, header, rows)
+            loaded += len(rows)
+
+    report(f"Loaded {loaded} rows into {table.name}", loaded, start)
+    return loaded
+
+
+def report(what, rows, start):
+    elapsed = time.perf_counter() - start
+    rate = rows / elapsed if elapsed else 0
+
+    print(f"{what} in {elapsed:.1f}s ({rate:,.0f} rows/s)")
+
+
+@contextmanager
+def indexes_dropped(tables, keep=False):
+    """Drop the secondary indexes of `tables`, and rebuild them on exit.
+
+    Loading into unindexed tables and building each index once is much
+    faster than updating the indexes row by row. Primary keys and unique
+    constraints are left alone.
+    """
+
+    connection = db.session.connection()
+    indexes = [] if keep else [index for table in tables for index in table.indexes]
+
+    for index in indexes:
+        index.drop(bind=connection)
+
+    yield
+
+    start = time.perf_counter()
+    for index in indexes:
+        index.create(bind=connection)
+
+    if indexes:
+        print(f"Rebuilt {len(indexes)} indexes in {time.perf_counter() - start:.1f}s")
+
+
+def reset_sequences(tables):
+    """Move Postgres id sequences past the ids loaded by COPY."""
+
+    connection = db.session.connection()
+    if connection.dialect.name != 'postgresql':
+        return
+
+    for table in tables:
+        if 'id' not in table.c:
+            continue
+
+        connection.execute(db.text(
+            f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+            f"coalesce(max(id), 1), max(id) IS NOT NULL) FROM {table.name}"))
+
+
+def rebuild(what, fn):
+    start = time.perf_counter()
+    fn()
+    print(f"Rebuilt {what} in {time.perf_counter() - start:.1f}s")
+
+
+def seed(users=USERS_CSV, messages=MESSAGES_CSV, follows=FOLLOWS_CSV,
+         chunk_rows=CHUNK_ROWS, keep_indexes=False):
+    """Recreate the database and load it from CSVs."""
+
+    db.drop_all()
+    db.create_all()
+
+    sources = [(User.__table__, users),
+               (Message.__table__, messages),
+               (Follows.__table__, follows)]
+
+    with indexes_dropped([table for table, _ in sources], keep_indexes):
+        for table, paths in sources:
+            load_csvs(table, paths, chunk_rows)
+
+    reset_sequences([table for table, _ in sources])
 
+    rebuild("counters", User.reconcile_counts)
 
-db.drop_all()
-db.create_all()
+    with indexes_dropped([TimelineEntry.__table__, MessageTerm.__table__],
+                         keep_indexes):
+        rebuild("timelines", TimelineEntry.rebuild)
+        rebuild("search index", MessageTerm.rebuild)
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+    db.session.commit()
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', nargs='+', default=USERS_CSV)
+    parser.add_argument('--messages', nargs='+', default=MESSAGES_CSV)
+    parser.add_argument('--follows', nargs='+', default=FOLLOWS_CSV)
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS,
+                        help="rows sent to the database at a time")
+    parser.add_argument('--keep-indexes', action='store_true',
+                        help="don't drop secondary indexes while loading")
+    args = parser.parse_args()
 
-db.session.commit()
+    seed(args.users, args.messages, args.follows, args.chunk_rows,
+         args.keep_indexes)
@@ -0,0 +1,225 @@
+"""Precomputed "who to follow" suggestions for Warbler.
+
+A user is suggested the people followed by the people they follow:
+friends of friends, scored by how many of the user's follows lead to
+them, and ranked by score, then by id. `flask refresh-suggestions`
+writes each user's best SUGGESTIONS_PER_USER to the suggestions table,
+which the home page reads with one indexed query.
+
+With numpy and scipy installed, scores are counted as a sparse matrix
+product: with A the follows adjacency matrix, row u of A @ A counts the
+two-step paths from u to everyone. Rows are multiplied BATCH_SIZE users
+at a time to bound memory. Without them, the same counts are taken from
+the follow graph's sorted arrays in plain Python, which is far slower
+but gives the same suggestions.
+
+Only users whose neighborhood changed are recomputed by default. When
+u follows or unfollows someone, the routes mark u in the
+suggestion_refreshes table. u's own suggestions change, and so do those
+of everyone following u, since u's follows are their friends of
+friends. Nobody else's do. Each batch of those users is scored on a
+graph of just their follows and their follows' follows, read through
+the follows indexes, so an incremental refresh costs what the stale
+users' neighborhoods do rather than the whole follows table. A full
+refresh builds the whole graph once.
+"""
+
+import heapq
+from collections import Counter
+from functools import partial
+
+try:
+    import numpy
+    from scipy import sparse
+except ImportError:
+    numpy = sparse = None
+
+from followgraph import FollowGraph
+from models import db, User, Follows, Suggestion, SuggestionRefresh
+
+SUGGESTIONS_PER_USER = 10
+
+# users whose suggestions are computed and written together
+BATCH_SIZE = 1000
+
+
+def _rank(candidates, limit):
+    """The best `limit` of (suggested_id, score) pairs, highest score first."""
+
+    return heapq.nsmallest(limit, candidates, key=lambda pair: (-pair[1], pair[0]))
+
+
+def _adjacency(graph):
+    """The graph's follows as a scipy CSR matrix, sharing its arrays."""
+
+    offsets, ids = graph.following_arrays()
+    indptr = numpy.frombuffer(offsets, dtype=numpy.int32)
+    indices = numpy.frombuffer(ids, dtype=numpy.int32)
+    data = numpy.ones(len(indices), dtype=numpy.int32)
+
+    return sparse.csr_matrix((data, indices, indptr), shape=(graph.size, graph.size))
+
+
+def _compute_sparse(adjacency, user_ids, limit):
+    rows = numpy.array([user_id for user_id in user_ids if user_id < adjacency.shape[0]],
+                       dtype=numpy.int32)
+    results = {user_id: [] for user_id in user_ids}
+
+    if not len(rows):
+        return results
+
+    followed = adjacency[rows]
+    paths = followed @ adjacency
+
+    # drop users already followed, and the users themselves
+    itself = sparse.csr_matrix((numpy.ones(len(rows), dtype=numpy.int32),
+                                (numpy.arange(len(rows)), rows)),
+                               shape=paths.shape)
+    paths = paths - paths.multiply(followed) - paths.multiply(itself)
+    paths.eliminate_zeros()
+
+    for i, user_id in enumerate(rows.tolist()):
+        lo, hi = paths.indptr[i], paths.indptr[i + 1]
+        ids, scores = paths.indices[lo:hi], paths.data[lo:hi]
+
+        if len(scores) > limit:
+            # keep everyone tied with the limit-th best score, so ties
+            # are broken by id below rather than by argpartition
+            cutoff = scores[numpy.argpartition(-scores, limit - 1)[limit - 1]]
+            keep = scores >= cutoff
+            ids, scores = ids[keep], scores[keep]
+
+        order = numpy.lexsort((ids, -scores))[:limit]
+        results[user_id] = list(zip(ids[order].tolist(), scores[order].tolist()))
+
+    return results
+
+
+def _compute_python(graph, user_ids, limit):
+    results = {}
+
+    for user_id in user_ids:
+        following = graph.following(user_id)
+
+        paths = Counter()
+        for followed_id in following:
+            paths.update(graph.following(followed_id))
+
+        paths.pop(user_id, None)
+        for followed_id in following:
+            paths.pop(followed_id, None)
+
+        results[user_id] = _rank(paths.items(), limit)
+
+    return results
+
+
+def scorer(graph):
+    """`compute` for one graph, preparing it once for many batches of users."""
+
+    if sparse is not None:
+        return partial(_compute_sparse, _adjacency(graph))
+
+    return partial(_compute_python, graph)
+
+
+def compute(graph, user_ids, limit=SUGGESTIONS_PER_USER):
+    """{user_id: [(suggested_id, score), ...]} for `user_ids`, best first.
+
+    `graph` is a FollowGraph; only its arrays are read, so it should be
+    freshly built rather than carrying an overlay.
+    """
+
+    return scorer(graph)(user_ids, limit)
+
+
+def _stale_users(marked, batch_size):
+    """The marked users and their followers."""
+
+    stale = set(marked)
+    for batch in _batches(marked, batch_size):
+        stale.update(follower_id for (follower_id,) in (db.session
+                                                        .query(Follows.user_following_id)
+                                                        .filter(Follows.user_being_followed_id
+                                                                .in_(batch))))
+
+    return stale
+
+
+def neighborhood(user_ids):
+    """FollowGraph of the follows of `user_ids`, and of everyone they follow.
+
+    That's every two-step path out of `user_ids`, so their suggestions
+    come out of it just as they would from the whole graph.
+    """
+
+    followed = (db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id.in_(user_ids)))
+
+    pairs = (db.session
+             .query(Follows.user_following_id, Follows.user_being_followed_id)
+             .filter(db.or_(Follows.user_following_id.in_(user_ids),
+                            Follows.user_following_id.in_(followed.subquery())))
+             .order_by(Follows.user_following_id, Follows.user_being_followed_id))
+
+    return FollowGraph.build(pairs)
+
+
+def _batches(ids, size):
+    ids = sorted(ids)
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
+def refresh(full=False, limit=SUGGESTIONS_PER_USER, batch_size=BATCH_SIZE):
+    """Recompute the suggestions of users whose neighborhood changed.
+
+    With `full`, recompute everyone's. Returns how many users were
+    recomputed; the caller commits.
+    """
+
+    # marks made while this runs are left for the next refresh
+    upto = db.session.query(db.func.max(SuggestionRefresh.id)).scalar()
+    if upto is None and not full:
+        return 0
+
+    if full:
+        score = scorer(FollowGraph.build(Follows.pairs()))
+        Suggestion.query.delete(synchronize_session=False)
+        user_ids = [user_id for (user_id,) in db.session.query(User.id)]
+    else:
+        score = None
+        marked = {user_id for (user_id,) in (db.session
+                                             .query(SuggestionRefresh.user_id)
+                                             .filter(SuggestionRefresh.id <= upto)
+                                             .distinct())}
+        user_ids = _stale_users(marked, batch_size)
+
+    refreshed = 0
+
+    for batch in _batches(user_ids, batch_size):
+        # marked users may have been deleted since
+        live = [user_id for (user_id,) in (db.session
+                                           .query(User.id)
+                                           .filter(User.id.in_(batch)))]
+        if not full:
+            (Suggestion.query
+                .filter(Suggestion.user_id.in_(batch))
+                .delete(synchronize_session=False))
+
+        batch_score = score or scorer(neighborhood(live))
+        rows = [dict(user_id=user_id, suggested_id=suggested_id, score=score, rank=rank)
+                for user_id, suggested in batch_score(live, limit).items()
+                for rank, (suggested_id, score) in enumerate(suggested)]
+        if rows:
+            db.session.execute(Suggestion.__table__.insert(), rows)
+
+        refreshed += len(live)
+
+    if upto is not None:
+        (SuggestionRefresh.query
+            .filter(SuggestionRefresh.id <= upto)
+            .delete(synchronize_session=False))
+
+    return refreshed
@@ -0,0 +1,146 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_api.py
+
+
+import json
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Follows, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from caching import user_cache
+
+db.drop_all()
+db.create_all()
+
+
+class ApiTestCase(TestCase):
+    """Tests the read-only /api/v1 endpoints."""
+
+    def setUp(self):
+        """Make a reader following a writer with a few messages."""
+
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+        user_cache.clear()
+
+        reader = User(username="reader", email="reader@test.com", password="HASHED_PASSWORD")
+        writer = User(username="writer", email="writer@test.com", password="HASHED_PASSWORD",
+                      bio="Writes things")
+        db.session.add_all([reader, writer])
+        db.session.flush()
+
+        db.session.add(Follows(user_being_followed_id=writer.id, user_following_id=reader.id))
+        User.adjust_counts(reader.id, following=1)
+        User.adjust_counts(writer.id, followers=1)
+
+        start = datetime(2020, 1, 1)
+        for i in range(5):
+            msg = Message(text=f"warble {i}", user_id=writer.id,
+                          timestamp=start + timedelta(minutes=i))
+            db.session.add(msg)
+            db.session.flush()
+            TimelineEntry.fan_out(msg)
+
+        db.session.commit()
+
+        self.reader_id = reader.id
+        self.writer_id = writer.id
+        self.client = app.test_client()
+
+    def login(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader_id
+
+    def get_json(self, url, status=200):
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, status)
+        self.assertEqual(resp.mimetype, "application/json")
+        return json.loads(resp.get_data(as_text=True))
+
+    def test_user_projection(self):
+        """ Are only the requested user fields returned? """
+
+        data = self.get_json(f"/api/v1/users/{self.writer_id}?fields=username,bio,followers_count")
+
+        self.assertEqual(data, {"username": "writer", "bio": "Writes things", "followers_count": 1})
+
+    def test_private_fields(self):
+        """ Are unknown (and private) fields refused? """
+
+        data = self.get_json(f"/api/v1/users/{self.writer_id}?fields=email,password", status=400)
+
+        self.assertIn("email", data["error"])
+
+    def test_missing(self):
+        """ Are missing users and messages a JSON 404? """
+
+        self.get_json("/api/v1/users/99999", status=404)
+        self.get_json("/api/v1/messages/99999", status=404)
+
+    def test_user_messages_pages(self):
+        """ Can a client walk a user's messages with the cursor? """
+
+        url = f"/api/v1/users/{self.writer_id}/messages?fields=text&limit=2"
+        texts = []
+
+        while url:
+            data = self.get_json(url)
+            texts.extend(msg["text"] for msg in data["data"])
+            self.assertTrue(all(set(msg) == {"text"} for msg in data["data"]))
+
+            url = data["next"] and f"/api/v1/users/{self.writer_id}/messages?fields=text&limit=2&cursor={data['next']}"
+
+        self.assertEqual(texts, [f"warble {i}" for i in reversed(range(5))])
+
+    def test_message_author_fields(self):
+        """ Can a message carry its author's username? """
+
+        msg_id = Message.query.filter_by(text="warble 0").one().id
+
+        data = self.get_json(f"/api/v1/messages/{msg_id}?fields=text,username,timestamp")
+
+        self.assertEqual(data, {"text": "warble 0", "username": "writer",
+                                "timestamp": "2020-01-01T00:00:00"})
+
+    def test_follow_lists(self):
+        """ Do follower lists need a login, and list the right users? """
+
+        self.get_json(f"/api/v1/users/{self.writer_id}/followers", status=401)
+
+        self.login()
+
+        followers = self.get_json(f"/api/v1/users/{self.writer_id}/followers?fields=username")
+        following = self.get_json(f"/api/v1/users/{self.reader_id}/following?fields=username")
+
+        self.assertEqual(followers, {"data": [{"username": "reader"}], "next": None})
+        self.assertEqual(following, {"data": [{"username": "writer"}], "next": None})
+
+    def test_timeline(self):
+        """ Is the home timeline served newest first, and only when logged in? """
+
+        self.get_json("/api/v1/timeline", status=401)
+
+        self.login()
+        data = self.get_json("/api/v1/timeline?limit=3&fields=id,text")
+
+        self.assertEqual([msg["text"] for msg in data["data"]],
+                         ["warble 4", "warble 3", "warble 2"])
+        self.assertIsNotNone(data["next"])
+
+        data = self.get_json(f"/api/v1/timeline?limit=3&fields=text&cursor={data['next']}")
+
+        self.assertEqual(data, {"data": [{"text": "warble 1"}, {"text": "warble 0"}], "next": None})
+
+    def test_bad_cursor(self):
+        """ Is a malformed cursor a 400? """
+
+        self.get_json(f"/api/v1/users/{self.writer_id}/messages?cursor=nonsense", status=400)
@@ -0,0 +1,139 @@
+"""ASGI entry point tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_asgi.py
+
+
+import asyncio
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from caching import user_cache
+import asgi
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+
+def call(path, query=b'', method='GET', headers=(), body=b''):
+    """Run one request through the ASGI app; returns (status, headers, body)."""
+
+    scope = dict(type='http', http_version='1.1', method=method, scheme='http',
+                 path=path, root_path='', query_string=query,
+                 headers=list(headers), server=('testserver', 80), client=('127.0.0.1', 1))
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi.application(scope, receive, send))
+
+    start, *rest = sent
+    return (start['status'], dict(start['headers']),
+            b''.join(message.get('body', b'') for message in rest))
+
+
+class AsgiTestCase(TestCase):
+    """Tests the natively served endpoints against Flask's, and the fallback."""
+
+    def setUp(self):
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+        user_cache.clear()
+
+        reader = User.signup(username="reader", email="reader@test.com",
+                             password="password", image_url=None)
+        writer = User.signup(username="writer", email="writer@test.com",
+                             password="password", image_url=None)
+        db.session.flush()
+
+        db.session.add(Follows(user_being_followed_id=writer.id, user_following_id=reader.id))
+        for i in range(3):
+            msg = Message(text=f"warble {i}", user_id=writer.id)
+            db.session.add(msg)
+            db.session.flush()
+            TimelineEntry.fan_out(msg)
+        db.session.commit()
+
+        self.reader_id = reader.id
+        self.writer_id = writer.id
+        self.message_id = msg.id
+
+        serializer = app.session_interface.get_signing_serializer(app)
+        cookie = f"{app.config['SESSION_COOKIE_NAME']}={serializer.dumps({CURR_USER_KEY: reader.id})}"
+        self.cookie = (b'cookie', cookie.encode())
+
+        self.client = app.test_client()
+
+    def assertSameAsFlask(self, path, query=b'', logged_in=False):
+        headers = [self.cookie] if logged_in else []
+        status, _, body = call(path, query, headers=headers)
+
+        if logged_in:
+            with self.client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.reader_id
+        resp = self.client.get(path, query_string=query)
+
+        self.assertEqual((status, body), (resp.status_code, resp.get_data()), path)
+        return status
+
+    def test_same_responses(self):
+        """ Are the native endpoints' responses Flask's, byte for byte? """
+
+        writer, message = self.writer_id, self.message_id
+
+        self.assertSameAsFlask(f"/api/v1/users/{writer}", b'fields=username,bio')
+        self.assertSameAsFlask(f"/api/v1/users/{writer}/messages", b'limit=2')
+        self.assertSameAsFlask(f"/api/v1/messages/{message}")
+        self.assertSameAsFlask("/api/v1/users/9999")
+        self.assertSameAsFlask(f"/api/v1/users/{writer}", b'fields=password')
+
+        self.assertEqual(self.assertSameAsFlask("/api/v1/timeline"), 401)
+        self.assertEqual(self.assertSameAsFlask("/api/v1/timeline", b'limit=2',
+                                                logged_in=True), 200)
+        self.assertSameAsFlask(f"/api/v1/users/{writer}/followers", logged_in=True)
+        self.assertSameAsFlask(f"/api/v1/users/{self.reader_id}/following", logged_in=True)
+
+    def test_flask_fallback(self):
+        """ Do the HTML pages and writes still work through Flask? """
+
+        status, headers, body = call("/login")
+        self.assertEqual(status, 200)
+        self.assertIn(b'text/html', headers[b'content-type'])
+
+        status, headers, _ = call("/messages/new", method='POST',
+                                  headers=[self.cookie,
+                                           (b'content-type', b'application/x-www-form-urlencoded')],
+                                  body=b'text=Through+ASGI')
+        self.assertEqual(status, 302)
+        self.assertEqual(Message.query.filter_by(text="Through ASGI").count(), 1)
+
+    def test_websocket_refused(self):
+        """ Is a websocket handshake received, then refused? """
+
+        scope = dict(type='websocket', path='/', headers=[], query_string=b'')
+        messages = [{'type': 'websocket.connect'}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(asgi.application(scope, receive, send))
+
+        self.assertEqual([message['type'] for message in sent], ['websocket.close'])
+        self.assertEqual(messages, [])
@@ -0,0 +1,110 @@
+"""Static asset pipeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+import gzip
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+import assets
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+
+
+class AssetsTestCase(TestCase):
+    """Tests fingerprinting and serving of static files."""
+
+    def setUp(self):
+        """Build a small static folder into a temporary directory."""
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.static = self.tmp.name
+
+        os.makedirs(os.path.join(self.static, "images"))
+        with open(os.path.join(self.static, "images", "logo.png"), "wb") as f:
+            f.write(b"not really a png")
+        with open(os.path.join(self.static, "style.css"), "w") as f:
+            f.write('body { background: url("/static/images/logo.png"); }')
+
+        self.manifest = assets.build_assets(self.static)
+
+        self.old_static = app.static_folder
+        self.old_manifest = app.extensions["assets"]
+        self.old_version = app.extensions["assets_version"]
+        app.static_folder = self.static
+        app.extensions["assets"] = self.manifest
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.static_folder = self.old_static
+        app.extensions["assets"] = self.old_manifest
+        app.extensions["assets_version"] = self.old_version
+        self.tmp.cleanup()
+
+    def test_build_assets(self):
+        """ Are files fingerprinted, stylesheets rewritten and text precompressed? """
+
+        self.assertEqual(set(self.manifest), {"images/logo.png", "style.css"})
+        self.assertRegex(self.manifest["style.css"], r"^style\.[0-9a-f]{12}\.css$")
+
+        dist = os.path.join(self.static, assets.DIST_DIR)
+
+        with open(os.path.join(dist, self.manifest["style.css"])) as f:
+            css = f.read()
+        self.assertIn(f'url("/assets/{self.manifest["images/logo.png"]}")', css)
+
+        with gzip.open(os.path.join(dist, self.manifest["style.css"] + ".gz"), "rt") as f:
+            self.assertEqual(f.read(), css)
+
+        self.assertFalse(os.path.exists(
+            os.path.join(dist, self.manifest["images/logo.png"] + ".gz")))
+
+        with open(os.path.join(dist, assets.MANIFEST)) as f:
+            self.assertEqual(json.load(f), self.manifest)
+
+    def test_serve_asset(self):
+        """ Are hashed files served precompressed and cacheable forever? """
+
+        with app.test_request_context():
+            url = assets.static_url("style.css")
+            self.assertEqual(url, f"/assets/{self.manifest['style.css']}")
+            self.assertEqual(assets.static_url("missing.js"), "/static/missing.js")
+
+        resp = self.client.get(url, headers={"Accept-Encoding": "gzip"})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertEqual(resp.mimetype, "text/css")
+        self.assertIn("immutable", resp.headers["Cache-Control"])
+        self.assertIn("Accept-Encoding", resp.headers["Vary"])
+        self.assertIn(b"/assets/images/logo.", gzip.decompress(resp.get_data()))
+
+        resp = self.client.get(url)
+        self.assertNotIn("Content-Encoding", resp.headers)
+        resp.close()
+
+    def test_rebuild_keeps_old_files(self):
+        """ Do pages rendered before a rebuild still find their assets, and stop matching? """
+
+        with app.test_request_context():
+            self.assertEqual(assets.asset_url("/static/images/logo.png"),
+                             f"/assets/{self.manifest['images/logo.png']}")
+            self.assertEqual(assets.asset_url("https://example.com/me.png"),
+                             "https://example.com/me.png")
+
+        with open(os.path.join(self.static, "style.css"), "w") as f:
+            f.write("body { color: red; }")
+
+        rebuilt = assets.build_assets(self.static)
+        self.assertNotEqual(rebuilt["style.css"], self.manifest["style.css"])
+        self.assertEqual(self.client.get(f"/assets/{self.manifest['style.css']}").status_code, 200)
+        self.assertNotEqual(assets.manifest_version(rebuilt),
+                            assets.manifest_version(self.manifest))
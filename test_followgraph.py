@@ -0,0 +1,161 @@
+"""Follow graph tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_followgraph.py
+
+
+import os
+import time
+from unittest import TestCase, mock
+
+import followgraph
+from followgraph import FollowGraph
+from models import db, User, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from caching import user_cache
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+
+class FollowGraphTestCase(TestCase):
+    """Tests the CSR arrays and their overlay."""
+
+    def setUp(self):
+        # 1 follows 2 and 3; 2 follows 1; 3 follows 2; 5 follows nobody
+        self.graph = FollowGraph.build([(1, 2), (1, 3), (2, 1), (3, 2)])
+
+    def test_lookups(self):
+        """ Are both directions, mutuals and counts right? """
+
+        graph = self.graph
+
+        self.assertEqual(list(graph.following(1)), [2, 3])
+        self.assertEqual(list(graph.followers(2)), [1, 3])
+        self.assertEqual(list(graph.followers(1)), [2])
+        self.assertEqual(graph.mutuals(1), [2])
+        self.assertEqual((graph.following_count(3), graph.followers_count(3)), (1, 1))
+
+        self.assertTrue(graph.is_following(3, 2))
+        self.assertFalse(graph.is_following(2, 3))
+        self.assertEqual(list(graph.following(5)), [])
+        self.assertEqual(list(graph.followers(1000)), [])
+
+        self.assertEqual(graph.edges, 4)
+        self.assertEqual(graph.nbytes, 4 * (2 * 4 + 2 * (graph.size + 1)))
+
+    def test_overlay(self):
+        """ Do follows made after the build show up in both directions? """
+
+        graph = self.graph
+
+        graph.follow(2, 3)
+        graph.unfollow(1, 2)
+        graph.follow(7, 1)
+
+        self.assertEqual(list(graph.following(1)), [3])
+        self.assertEqual(list(graph.following(2)), [1, 3])
+        self.assertEqual(list(graph.followers(1)), [2, 7])
+        self.assertEqual(list(graph.followers(2)), [3])
+        self.assertTrue(graph.is_following(7, 1))
+        self.assertFalse(graph.is_following(1, 2))
+
+        graph.follow(1, 2)
+        graph.unfollow(7, 1)
+
+        self.assertEqual(list(graph.followers(2)), [1, 3])
+        self.assertEqual(list(graph.followers(1)), [2])
+
+
+    def test_builds_agree(self):
+        """ Do the numpy and pure Python builds make the same arrays? """
+
+        pairs = [(1, 2), (1, 3), (2, 1), (3, 2), (9, 4)]
+        graph = FollowGraph.build(pairs)
+
+        with mock.patch.object(followgraph, "numpy", None):
+            python_graph = FollowGraph.build(pairs)
+            python_empty = FollowGraph.build([])
+
+        self.assertEqual((graph._out_offsets, graph._out_ids, graph._in_offsets, graph._in_ids),
+                         (python_graph._out_offsets, python_graph._out_ids,
+                          python_graph._in_offsets, python_graph._in_ids))
+        self.assertEqual(FollowGraph.build([]).size, python_empty.size)
+
+
+class FollowGraphViewsTestCase(TestCase):
+    """Tests the follow routes and pages with the graph on."""
+
+    def setUp(self):
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+        user_cache.clear()
+        followgraph.reset()
+
+        users = [User.signup(username=f"user{i}", email=f"user{i}@test.com",
+                             password="testuser", image_url=None)
+                 for i in range(3)]
+        db.session.commit()
+        self.user_ids = [u.id for u in users]
+
+        users[1].followers.append(users[2])
+        db.session.commit()
+
+        app.config['FOLLOW_GRAPH'] = True
+        with app.app_context():
+            followgraph.build_now()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['FOLLOW_GRAPH'] = False
+        followgraph.reset()
+
+    def test_follow_pages(self):
+        """ Are follows loaded from the table, then kept current by the routes? """
+
+        me, other, fan = self.user_ids
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = me
+
+            html = c.get(f"/users/{other}/followers").get_data(as_text=True)
+            self.assertIn("@user2", html)
+
+            c.post(f"/users/follow/{other}")
+
+            graph = followgraph.get_graph()
+            self.assertEqual(list(graph.followers(other)), [me, fan])
+
+            html = c.get(f"/users/{me}/following").get_data(as_text=True)
+            self.assertIn("@user1", html)
+            self.assertIn("Unfollow", html)
+
+            c.post(f"/users/stop-following/{other}")
+
+            self.assertFalse(graph.is_following(me, other))
+            self.assertEqual(Follows.query.count(), 1)
+
+    def test_loads_in_background(self):
+        """ Do lookups fall back to SQL while the graph is loading? """
+
+        me, other, fan = self.user_ids
+        followgraph.reset()
+
+        with app.app_context():
+            self.assertIsNone(followgraph.get_graph())
+            self.assertIsNone(followgraph.get_graph())
+
+            for _ in range(100):
+                if followgraph.get_graph() is not None:
+                    break
+                time.sleep(0.05)
+
+            self.assertTrue(followgraph.get_graph().is_following(fan, other))
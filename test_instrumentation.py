@@ -0,0 +1,119 @@
+"""SQL instrumentation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_instrumentation.py
+
+
+import os
+from types import SimpleNamespace
+from unittest import TestCase
+
+from flask import g
+
+import instrumentation
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+
+db.drop_all()
+db.create_all()
+
+
+class InstrumentationTestCase(TestCase):
+    """Tests per-request statement counting and N+1 detection."""
+
+    def setUp(self):
+        db.session.rollback()
+        User.query.delete()
+
+        self.user_ids = []
+        for i in range(6):
+            user = User(username=f"user{i}", email=f"user{i}@test.com", password="HASHED_PASSWORD")
+            db.session.add(user)
+            db.session.flush()
+            self.user_ids.append(user.id)
+
+        db.session.commit()
+        db.session.expunge_all()
+
+        app.config['SQL_INSTRUMENTATION'] = True
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['SQL_INSTRUMENTATION'] = False
+        db.session.rollback()
+
+    def test_statement_shape(self):
+        """ Do literals and IN lists collapse to one shape? """
+
+        self.assertEqual(
+            instrumentation.statement_shape("SELECT *\n  FROM users WHERE id IN (?, ?, ?) AND bio = 'x'"),
+            instrumentation.statement_shape("SELECT * FROM users WHERE id IN (?) AND bio = 'other'"))
+        self.assertEqual(
+            instrumentation.statement_shape("SELECT * FROM users WHERE id = 12"),
+            "SELECT * FROM users WHERE id = ?")
+
+    def test_server_timing(self):
+        """ Does an instrumented request report its queries? """
+
+        resp = self.client.get(f"/users/{self.user_ids[0]}")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertRegex(resp.headers["Server-Timing"],
+                         r'^db;dur=[\d.]+;desc="[1-9]\d* queries", app;dur=[\d.]+$')
+
+    def test_off(self):
+        """ With instrumentation off, is nothing added? """
+
+        app.config['SQL_INSTRUMENTATION'] = False
+
+        resp = self.client.get(f"/users/{self.user_ids[0]}")
+
+        self.assertNotIn("Server-Timing", resp.headers)
+
+    def test_n_plus_one(self):
+        """ Are repeated statement shapes flagged and logged with their SQL? """
+
+        with app.test_request_context("/users"):
+            instrumentation.start_request()
+            for user_id in self.user_ids:
+                db.session.query(User).filter_by(id=user_id).one()
+
+            with self.assertLogs(app.logger, "WARNING") as logs:
+                resp = instrumentation.finish_request(app.response_class())
+
+        self.assertIn('nplus1;desc="1 repeated"', resp.headers["Server-Timing"])
+        self.assertIn("probable N+1, run 6 times", logs.output[0])
+        self.assertIn("FROM users", logs.output[0])
+
+    def test_failed_statement(self):
+        """ Does a statement that raises leave nothing behind for the next one? """
+
+        conn = SimpleNamespace(info={})
+        failed, ok = SimpleNamespace(), SimpleNamespace()
+
+        with app.test_request_context("/users"):
+            instrumentation.start_request()
+
+            # the first statement raises, so after_cursor_execute never runs
+            instrumentation.before_cursor_execute(conn, None, "SELECT 1", (), failed, False)
+            instrumentation.before_cursor_execute(conn, None, "SELECT 2", (), ok, False)
+            instrumentation.after_cursor_execute(conn, None, "SELECT 2", (), ok, False)
+
+            self.assertEqual(g.sql_stats.count, 1)
+            self.assertFalse(conn.info.get("query_started"))
+
+    def test_slow_request(self):
+        """ Are slow requests logged? """
+
+        app.config['SLOW_REQUEST_MS'] = 0
+        try:
+            with self.assertLogs(app.logger, "WARNING") as logs:
+                self.client.get(f"/users/{self.user_ids[0]}")
+        finally:
+            app.config['SLOW_REQUEST_MS'] = instrumentation.SLOW_REQUEST_MS
+
+        self.assertIn(f"GET /users/{self.user_ids[0]}", logs.output[0])
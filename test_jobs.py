@@ -0,0 +1,250 @@
+"""Background job tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+
+import jobs
+from models import db, User, Message, Follows, TimelineEntry, Job
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from caching import user_cache, like_cache, get_user_snapshot
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+# test task: fails its first `failures` calls for each `label`
+calls = {}
+
+
+@jobs.task('flaky', max_attempts=3)
+def flaky(label, failures):
+    calls[label] = calls.get(label, 0) + 1
+    if calls[label] <= failures:
+        raise ValueError(f"failure {calls[label]}")
+
+
+class JobsTestCase(TestCase):
+    """Tests queueing, retrying and reclaiming jobs."""
+
+    def setUp(self):
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+        calls.clear()
+
+        app.config['JOBS_INLINE'] = False
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.ctx.pop()
+        app.config['JOBS_INLINE'] = True
+
+    def make_due(self):
+        Job.query.update({Job.run_at: datetime.utcnow() - timedelta(seconds=1)})
+        db.session.commit()
+
+    def test_idempotency_key(self):
+        """ Is a job with a key only queued once? """
+
+        first = jobs.enqueue('flaky', key="once", label="once", failures=0)
+        db.session.commit()
+        again = jobs.enqueue('flaky', key="once", label="once", failures=0)
+
+        self.assertEqual(again.id, first.id)
+        self.assertEqual(jobs.work_pending(), 1)
+
+        jobs.enqueue('flaky', key="once", label="once", failures=0)
+        db.session.commit()
+        self.assertEqual(jobs.work_pending(), 0)
+        self.assertEqual(calls, {"once": 1})
+
+    def test_idempotency_key_race(self):
+        """ Does queueing a key another request just queued return its job? """
+
+        first = jobs.enqueue('flaky', key="race", label="race", failures=0)
+        db.session.commit()
+
+        # the other request's job wasn't there yet when this one looked
+        with patch('sqlalchemy.orm.Query.first', return_value=None):
+            again = jobs.enqueue('flaky', key="race", label="race", failures=0)
+        db.session.commit()
+
+        self.assertEqual(again.id, first.id)
+        self.assertEqual(Job.query.count(), 1)
+
+    def test_after_commit(self):
+        """ Do callbacks wait for the outermost commit, and drop on rollback? """
+
+        jobs.enqueue('flaky', key="nested", label="nested", failures=0)
+        db.session.commit()
+
+        called = []
+        jobs.after_commit(called.append, "kept")
+        jobs.enqueue('flaky', key="other", label="other", failures=0)
+
+        # a savepoint failing on a key queued concurrently
+        with patch('sqlalchemy.orm.Query.first', return_value=None):
+            jobs.enqueue('flaky', key="nested", label="nested", failures=0)
+        self.assertEqual(called, [])
+
+        db.session.commit()
+        self.assertEqual(called, ["kept"])
+
+        jobs.after_commit(called.append, "dropped")
+        db.session.rollback()
+        db.session.commit()
+        self.assertEqual(called, ["kept"])
+
+    def test_retries(self):
+        """ Is a failing job retried with growing delays, then given up on? """
+
+        recovers = jobs.enqueue('flaky', key="recovers", label="recovers", failures=1)
+        fails = jobs.enqueue('flaky', key="fails", label="fails", failures=5)
+        db.session.commit()
+
+        self.assertEqual(jobs.work_pending(), 2)
+        self.assertEqual(recovers.status, jobs.QUEUED)
+        self.assertIn("failure 1", recovers.last_error)
+        self.assertGreater(recovers.run_at, datetime.utcnow())
+
+        # not due again until the backoff has passed
+        self.assertEqual(jobs.work_pending(), 0)
+        self.assertEqual([jobs.backoff(n) for n in (1, 2, 3)], [5, 10, 20])
+
+        self.make_due()
+        jobs.work_pending()
+        self.make_due()
+        jobs.work_pending()
+
+        self.assertEqual((recovers.status, recovers.attempts), (jobs.DONE, 2))
+        self.assertEqual((fails.status, fails.attempts), (jobs.FAILED, 3))
+        self.assertEqual(calls, {"recovers": 2, "fails": 3})
+
+    def test_reclaim(self):
+        """ Is a job whose worker died run again? """
+
+        job = jobs.enqueue('flaky', key="abandoned", label="abandoned", failures=0)
+        db.session.commit()
+        self.assertEqual(jobs.claim().id, job.id)
+        self.assertIsNone(jobs.claim())
+
+        job.locked_at = datetime.utcnow() - timedelta(seconds=app.config['JOBS_LOCK_TIMEOUT'] + 1)
+        db.session.commit()
+
+        jobs.work_pending()
+        self.assertEqual((job.status, job.attempts), (jobs.DONE, 2))
+
+
+class JobsViewsTestCase(TestCase):
+    """Tests the routes that defer work to jobs."""
+
+    def setUp(self):
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+        user_cache.clear()
+
+        users = [User.signup(username=f"user{i}", email=f"user{i}@test.com",
+                             password="testuser", image_url=None)
+                 for i in range(2)]
+        db.session.commit()
+        self.author_id, self.fan_id = [u.id for u in users]
+
+        users[0].followers.append(users[1])
+        User.reconcile_counts()
+        db.session.commit()
+
+        app.config['JOBS_INLINE'] = False
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['JOBS_INLINE'] = True
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def work(self):
+        with app.app_context():
+            return jobs.work_pending()
+
+    def test_fan_out(self):
+        """ Is a new message delivered to followers by a job? """
+
+        with self.client as c:
+            self.login(c, self.author_id)
+            c.post("/messages/new", data={"text": "Deferred"})
+
+        self.assertEqual(TimelineEntry.query.count(), 0)
+        self.assertEqual(self.work(), 1)
+        self.assertEqual([e.user_id for e in TimelineEntry.query], [self.fan_id])
+
+    def test_fan_out_again(self):
+        """ Can a fan-out job that already delivered its message run again? """
+
+        with self.client as c:
+            self.login(c, self.author_id)
+            c.post("/messages/new", data={"text": "Deferred"})
+
+        self.work()
+        Job.query.update({Job.status: jobs.QUEUED,
+                          Job.run_at: datetime.utcnow() - timedelta(seconds=1)})
+        db.session.commit()
+
+        self.assertEqual(self.work(), 1)
+        self.assertEqual(Job.query.one().status, jobs.DONE)
+        self.assertEqual([e.user_id for e in TimelineEntry.query], [self.fan_id])
+
+    def test_follow_toggles(self):
+        """ Does the timeline end up right whichever order the jobs run in? """
+
+        db.session.add(Message(text="Old message", user_id=self.author_id))
+        Follows.query.delete()
+        User.reconcile_counts()
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c, self.fan_id)
+            c.post(f"/users/follow/{self.author_id}")
+            c.post(f"/users/stop-following/{self.author_id}")
+            c.post(f"/users/follow/{self.author_id}")
+
+        self.assertEqual(self.work(), 3)
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=self.fan_id).count(), 1)
+
+    def test_delete_user(self):
+        """ Is a deleted user removed by a job, once? """
+
+        like_cache.set(self.author_id, (None, {}))
+
+        with self.client as c:
+            self.login(c, self.author_id)
+            c.post("/users/delete")
+
+        # the route's process forgets them straight away
+        self.assertIsNotNone(User.query.get(self.author_id))
+        self.assertIsNone(like_cache.get(self.author_id))
+
+        # a request before the job runs caches the user again
+        with app.app_context():
+            get_user_snapshot(self.author_id)
+
+        self.assertEqual(self.work(), 1)
+        self.assertIsNone(user_cache.get(self.author_id))
+
+        db.session.expire_all()
+        self.assertIsNone(User.query.get(self.author_id))
+        self.assertEqual(User.query.get(self.fan_id).following_count, 0)
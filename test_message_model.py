@@ -6,9 +6,13 @@
 
 
 import os
-from unittest import TestCase
+from datetime import datetime, timedelta
+from unittest import TestCase, mock
 
-from models import db, User, Message, Follows, Likes
+from sqlalchemy import event
+
+import models
+from models import db, User, Message, Follows, Likes, TimelineEntry, merged_timeline, home_timeline
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -99,6 +103,28 @@ class MessageModelTestCase(TestCase):
         self.assertEqual(len(u2.likes), 1)
         
         
+    def test_liked_ids(self):
+        """ Can several users like a message, and is the liked subset of a page found? """
+
+        u1, u2 = [User(email=f"user{i}@test.com", username=f"user{i}", password="HASHED_PASSWORD")
+                  for i in range(2)]
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        messages = [Message(text=f"Message {i}", user_id=u1.id) for i in range(3)]
+        db.session.add_all(messages)
+        db.session.commit()
+
+        u1.likes.append(messages[0])
+        u2.likes.extend([messages[0], messages[2]])
+        db.session.commit()
+
+        page = [m.id for m in messages]
+
+        self.assertEqual(Likes.liked_ids(u1.id, page), {messages[0].id})
+        self.assertEqual(Likes.liked_ids(u2.id, page), {messages[0].id, messages[2].id})
+        self.assertEqual(Likes.liked_ids(u2.id, []), set())
+
     def test_deleting_message(self):
         """ 
         Deleting a message should:
@@ -138,4 +164,100 @@ class MessageModelTestCase(TestCase):
         
         self.assertEqual(len(Message.query.all()), 0)
         self.assertEqual(len(u2.likes), 0)
-        self.assertEqual(len(u1.messages), 0)
\ No newline at end of file
+        self.assertEqual(len(u1.messages), 0)
+        
+        
+    #######################################################################################
+    # Testing timeline merging
+
+    def make_users(self, count):
+        """ Create `count` users, each with three messages a minute apart """
+
+        users = [User(email=f"test{i}@test.com",
+                      username=f"testuser{i}",
+                      password="HASHED_PASSWORD")
+                 for i in range(count)]
+
+        db.session.add_all(users)
+        db.session.commit()
+
+        start = datetime(2020, 1, 1)
+
+        for i, user in enumerate(users):
+            for j in range(3):
+                db.session.add(Message(text=f"{user.username} #{j}",
+                                       user_id=user.id,
+                                       timestamp=start + timedelta(minutes=3 * j + i)))
+
+        db.session.commit()
+        return users
+
+    def test_merged_timeline(self):
+        """ Are several users' messages merged newest first and cut at the limit? """
+
+        users = self.make_users(3)
+
+        messages = merged_timeline([u.id for u in users], limit=4, batch_size=2)
+        expected = (Message.query
+                    .order_by(Message.timestamp.desc())
+                    .limit(4)
+                    .all())
+
+        self.assertEqual(messages, expected)
+
+        older = merged_timeline([u.id for u in users], limit=100,
+                                before=(messages[-1].timestamp, messages[-1].id))
+
+        self.assertEqual(len(older), 5)
+        self.assertTrue(all(m.timestamp < messages[-1].timestamp for m in older))
+
+    def test_home_timeline_merges_popular_users(self):
+        """ Are popular users read at request time instead of fanned out? """
+
+        reader, regular, popular = self.make_users(3)
+        TimelineEntry.query.delete()
+
+        with mock.patch.object(models, "FANOUT_MAX_FOLLOWERS", 2):
+            popular.followers.append(reader)
+            popular.followers.append(regular)
+            regular.followers.append(reader)
+            db.session.commit()
+
+            User.reconcile_counts()
+            TimelineEntry.rebuild()
+            db.session.commit()
+
+            delivered = {e.message_id for e in TimelineEntry.query.filter_by(user_id=reader.id)}
+            messages = home_timeline(reader.id)
+
+        self.assertEqual(delivered, {m.id for m in regular.messages})
+        self.assertEqual({m.user_id for m in messages}, {regular.id, popular.id})
+        self.assertEqual(len(messages), 6)
+        self.assertEqual(messages, sorted(messages, key=lambda m: m.timestamp, reverse=True))
+
+    def test_home_timeline_one_query(self):
+        """ Is the materialized timeline read in a single query? """
+
+        reader, *followed = self.make_users(3)
+        for user in followed:
+            user.followers.append(reader)
+        db.session.commit()
+
+        User.reconcile_counts()
+        TimelineEntry.rebuild()
+        db.session.commit()
+
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            if "timelines" in statement:
+                statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            messages = home_timeline(reader.id, limit=5, batch_size=2)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count)
+
+        self.assertEqual(len(messages), 5)
+        self.assertEqual(len(statements), 1)
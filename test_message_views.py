@@ -6,9 +6,9 @@
 
 
 import os
-from unittest import TestCase
+from unittest import TestCase, mock
 
-from models import db, connect_db, Message, User
+from models import db, connect_db, Message, User, TimelineEntry
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -21,6 +21,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+from caching import user_cache, fragment_cache
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -46,6 +47,9 @@ class MessageViewTestCase(TestCase):
         # User.query.delete()
         # Message.query.delete()
 
+        user_cache.clear()
+        fragment_cache.clear()
+
         self.client = app.test_client()
 
         self.testuser = User.signup(username="testuser",
@@ -115,3 +119,133 @@ class MessageViewTestCase(TestCase):
         self.assertEqual(resp.status_code, 302)
         self.assertEqual(resp.location, 'http://localhost/users/1')
         self.assertEqual(len(Message.query.all()), 0)
+
+    def test_message_fans_out_to_followers(self):
+        """ Does a new message show up on the home page of followers? """
+
+        follower = User.signup(username="follower",
+                               email="follower@test.com",
+                               password="follower",
+                               image_url=None)
+
+        db.session.commit()
+
+        self.testuser.followers.append(follower)
+        db.session.commit()
+
+        testuser_id = self.testuser.id
+        follower_id = follower.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            c.post("/messages/new", data={"text": "Fanned out"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = follower_id
+
+            resp = c.get("/")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(TimelineEntry.query.count(), 1)
+            self.assertIn("<p>Fanned out</p>", html)
+
+            msg = Message.query.one()
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            c.post(f"/messages/{msg.id}/delete")
+
+            self.assertEqual(TimelineEntry.query.count(), 0)
+
+    def test_search_messages(self):
+        """ Are messages found by every word searched, newest first, one page at a time? """
+
+        testuser_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            c.post("/messages/new", data={"text": "Warbling in the rain"})
+            c.post("/messages/new", data={"text": "Rain again, no warbling"})
+            c.post("/messages/new", data={"text": "Sunny warbling today"})
+
+            resp = c.get("/messages/search?q=RAIN warbling")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("<p>Warbling in the rain</p>", html)
+            self.assertIn("<p>Rain again, no warbling</p>", html)
+            self.assertNotIn("Sunny", html)
+            self.assertLess(html.index("Rain again"), html.index("Warbling in the rain"))
+
+            with mock.patch("app.MESSAGE_SEARCH_PAGE_SIZE", 1):
+                resp = c.get("/messages/search?q=warbling")
+                html = resp.get_data(as_text=True)
+
+                self.assertIn("Sunny", html)
+                self.assertNotIn("Rain again", html)
+
+                next_url = html.split('href="')[-1].split('"')[0].replace("&amp;", "&")
+                html = c.get(next_url).get_data(as_text=True)
+
+                self.assertIn("Rain again", html)
+                self.assertNotIn("Sunny", html)
+
+            msg = Message.query.filter_by(text="Sunny warbling today").one()
+            c.post(f"/messages/{msg.id}/delete")
+
+            html = c.get("/messages/search?q=sunny").get_data(as_text=True)
+            self.assertIn("Sorry, no messages found", html)
+
+    def test_message_card_cache(self):
+        """ Are message cards cached, and re-rendered when their author changes? """
+
+        testuser_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            c.post("/messages/new", data={"text": "Cached card"})
+            msg_id = Message.query.one().id
+
+            c.get(f"/users/{testuser_id}")
+            stamp, html = fragment_cache.get(msg_id)
+            self.assertIn("@testuser</a>", html)
+
+            c.post("/users/profile", data={"username": "renamed",
+                                           "password": "testuser"})
+
+            resp = c.get(f"/users/{testuser_id}")
+            self.assertIn("@renamed</a>", resp.get_data(as_text=True))
+            self.assertNotEqual(fragment_cache.get(msg_id)[0], stamp)
+
+            c.post(f"/messages/{msg_id}/delete")
+            self.assertIsNone(fragment_cache.get(msg_id))
+
+    def test_show_message_conditional_get(self):
+        """ Do anonymous message permalinks revalidate by date? """
+
+        msg = Message(text="TEST", user_id=self.testuser.id)
+
+        db.session.add(msg)
+        db.session.commit()
+
+        msg_id = msg.id
+
+        with self.client as c:
+            resp = c.get(f"/messages/{msg_id}")
+            last_modified = resp.headers["Last-Modified"]
+
+            self.assertIn("public", resp.headers["Cache-Control"])
+
+            resp = c.get(f"/messages/{msg_id}",
+                         headers={"If-Modified-Since": last_modified})
+            self.assertEqual(resp.status_code, 304)
+
+            resp = c.get("/messages/12345")
+            self.assertEqual(resp.status_code, 404)
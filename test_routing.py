@@ -0,0 +1,135 @@
+"""Read-replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_routing.py
+#
+# They need a second, empty database standing in for the replica.
+
+
+import asyncio
+import os
+import time
+from unittest import TestCase
+
+import routing
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+REPLICA_URL = "postgresql:///warbler-test-replica"
+
+from app import app, CURR_USER_KEY
+from caching import user_cache
+import asgi
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+
+def asgi_get(path, session_cookie=None):
+    """Body of a GET of `path` served by asgi.py."""
+
+    headers = []
+    if session_cookie:
+        headers.append((b'cookie', f"{app.config['SESSION_COOKIE_NAME']}={session_cookie}".encode()))
+
+    scope = dict(type='http', http_version='1.1', method='GET', scheme='http', path=path,
+                 root_path='', query_string=b'', headers=headers, server=('testserver', 80))
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi.application(scope, receive, send))
+
+    return b''.join(message.get('body', b'') for message in sent[1:])
+
+
+class RoutingTestCase(TestCase):
+    """Tests that safe reads go to the replica and writes stick to the primary."""
+
+    def setUp(self):
+        """Give the primary and the replica different copies of the same user."""
+
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+        user_cache.clear()
+
+        app.config['SQLALCHEMY_BINDS'] = {'replica': REPLICA_URL}
+        replica = db.get_engine(app, bind='replica')
+        db.metadata.drop_all(bind=replica)
+        db.metadata.create_all(bind=replica)
+
+        user = User.signup(username="primary", email="test@test.com",
+                           password="testuser", image_url=None)
+        db.session.commit()
+        self.user_id = user.id
+
+        replica.execute(User.__table__.insert(),
+                        dict(id=user.id, username="replica", email="test@test.com",
+                             password=user.password))
+
+        # requests get a fresh session, as they would in production
+        db.session.remove()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.metadata.drop_all(bind=db.get_engine(app, bind='replica'))
+        app.config['SQLALCHEMY_BINDS'] = None
+
+    def test_reads_from_replica(self):
+        """ Do marked views read from the replica, and others from the primary? """
+
+        html = self.client.get(f"/users/{self.user_id}").get_data(as_text=True)
+        self.assertIn("@replica", html)
+
+        html = self.client.get("/login").get_data(as_text=True)
+        self.assertNotIn("@replica", html)
+
+        self.assertEqual(User.query.get(self.user_id).username, "primary")
+
+    def test_api_reads_from_replica(self):
+        """ Do the API's reads, natively under ASGI too, go to the replica? """
+
+        path = f"/api/v1/users/{self.user_id}"
+
+        self.assertIn(b'"replica"', self.client.get(path).get_data())
+        self.assertIn(b'"replica"', asgi_get(path))
+
+        # a browser that has just written reads from the primary
+        serializer = app.session_interface.get_signing_serializer(app)
+        cookie = serializer.dumps({routing.STICKY_KEY: time.time() + 60})
+        self.assertIn(b'"primary"', asgi_get(path, cookie))
+
+    def test_writes_stick_to_primary(self):
+        """ After writing, does a browser read its writes from the primary? """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            c.post("/messages/new", data={"text": "Just written"})
+
+            html = c.get(f"/users/{self.user_id}").get_data(as_text=True)
+            self.assertIn("Just written", html)
+
+            with c.session_transaction() as sess:
+                sess[routing.STICKY_KEY] = 0
+
+            html = c.get(f"/users/{self.user_id}").get_data(as_text=True)
+            self.assertNotIn("Just written", html)
+
+    def test_pool_options(self):
+        """ Are pool options only set for pooled databases? """
+
+        self.assertEqual(routing.pool_options("sqlite:///warbler.db", 5, 10, 60), {})
+        self.assertEqual(routing.pool_options("postgresql:///warbler", 5, 10, 60),
+                         dict(pool_size=5, max_overflow=10, pool_recycle=60, pool_pre_ping=True))
@@ -0,0 +1,81 @@
+"""Seed loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_seed.py
+
+
+import csv
+import os
+import tempfile
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from models import db, User, Message, Follows, TimelineEntry, MessageTerm
+import seed
+
+
+class SeedTestCase(TestCase):
+    """Tests loading CSVs into a fresh database."""
+
+    def setUp(self):
+        """Write small CSVs to a temporary directory."""
+
+        db.session.rollback()
+
+        self.tmp = tempfile.TemporaryDirectory()
+
+        self.users = self.write_csv("users.csv",
+                                    ["email", "username", "password"],
+                                    [[f"user{i}@test.com", f"user{i}", "HASHED_PASSWORD"]
+                                     for i in range(1, 6)])
+        self.messages = [
+            self.write_csv(f"messages-{part}.csv",
+                           ["text", "timestamp", "user_id"],
+                           [[f"Hello from part {part}", "2020-01-01 10:00:00.000000", user_id]
+                            for user_id in range(1, 6)])
+            for part in range(2)
+        ]
+        self.follows = self.write_csv("follows.csv",
+                                      ["user_being_followed_id", "user_following_id"],
+                                      [[1, 2], [1, 3], [2, 1]])
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write_csv(self, name, header, rows):
+        path = os.path.join(self.tmp.name, name)
+
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
+
+        return path
+
+    def test_seed(self):
+        """ Are all rows loaded in chunks, with indexes and derived tables rebuilt? """
+
+        seed.seed(users=[self.users], messages=self.messages, follows=[self.follows],
+                  chunk_rows=2)
+
+        self.assertEqual(User.query.count(), 5)
+        self.assertEqual(Message.query.count(), 10)
+        self.assertEqual(Follows.query.count(), 3)
+
+        user = User.query.get(1)
+        self.assertEqual((user.messages_count, user.followers_count, user.following_count),
+                         (2, 2, 1))
+
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=2).count(), 2)
+        self.assertEqual(MessageTerm.query.filter_by(term="hello").count(), 10)
+
+        indexes = {index["name"] for index in db.inspect(db.engine).get_indexes("messages")}
+        self.assertIn("ix_messages_user_timestamp_id", indexes)
+
+        # ids keep counting from the loaded rows
+        new_user = User.signup("newuser", "new@test.com", "PASSWORD", None)
+        db.session.commit()
+        self.assertEqual(new_user.id, 6)
@@ -0,0 +1,149 @@
+"""Who-to-follow suggestion tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_suggestions.py
+
+
+import os
+from unittest import TestCase, skipIf
+
+import suggestions
+from followgraph import FollowGraph
+from models import db, User, Follows, Suggestion, SuggestionRefresh
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from caching import user_cache
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+# 1 follows 2 and 3, who both follow 4; 3 also follows 5 and 1; 2 follows 6
+PAIRS = [(1, 2), (1, 3), (2, 4), (2, 6), (3, 1), (3, 4), (3, 5)]
+
+
+class ComputeTestCase(TestCase):
+    """Tests scoring friends of friends."""
+
+    def setUp(self):
+        self.graph = FollowGraph.build(PAIRS)
+
+    def test_python(self):
+        """ Are friends of friends ranked by paths, then id, without follows or self? """
+
+        results = suggestions._compute_python(self.graph, [1, 3, 7], 2)
+
+        self.assertEqual(results[1], [(4, 2), (5, 1)])
+        self.assertEqual(results[3], [(2, 1)])
+        self.assertEqual(results[7], [])
+
+    @skipIf(suggestions.sparse is None, "needs numpy and scipy")
+    def test_sparse_matches_python(self):
+        """ Does the sparse matrix product give the same suggestions? """
+
+        user_ids = list(range(10))
+        adjacency = suggestions._adjacency(self.graph)
+
+        for limit in (1, 2, 10):
+            self.assertEqual(suggestions._compute_sparse(adjacency, user_ids, limit),
+                             suggestions._compute_python(self.graph, user_ids, limit))
+
+
+class RefreshTestCase(TestCase):
+    """Tests writing suggestions, fully and incrementally."""
+
+    def setUp(self):
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+        user_cache.clear()
+
+        users = [User.signup(username=f"user{i}", email=f"user{i}@test.com",
+                             password="testuser", image_url=None)
+                 for i in range(7)]
+        db.session.commit()
+        self.ids = [u.id for u in users]
+
+        db.session.execute(Follows.__table__.insert(),
+                           [dict(user_following_id=self.ids[a],
+                                 user_being_followed_id=self.ids[b])
+                            for a, b in PAIRS])
+        db.session.commit()
+
+    def suggested(self, i):
+        rows = (Suggestion.query
+                .filter_by(user_id=self.ids[i])
+                .order_by(Suggestion.rank))
+        return [self.ids.index(row.suggested_id) for row in rows]
+
+    def test_full(self):
+        """ Does a full refresh write everyone's top suggestions? """
+
+        self.assertEqual(suggestions.refresh(full=True), 7)
+        db.session.commit()
+
+        self.assertEqual(self.suggested(1), [4, 5, 6])
+        self.assertEqual(self.suggested(3), [2])
+        self.assertEqual(self.suggested(0), [])
+
+    def test_incremental(self):
+        """ Are only marked users and their followers recomputed? """
+
+        suggestions.refresh(full=True)
+        db.session.commit()
+        self.assertEqual(suggestions.refresh(), 0)
+
+        # 2 follows 5: 1 follows 2, so both change; 3's can't
+        db.session.execute(Follows.__table__.insert(),
+                           dict(user_following_id=self.ids[2],
+                                user_being_followed_id=self.ids[5]))
+        SuggestionRefresh.request(self.ids[2])
+        Suggestion.query.filter_by(user_id=self.ids[3]).delete()
+        db.session.commit()
+
+        self.assertEqual(suggestions.refresh(), 2)
+        db.session.commit()
+
+        self.assertEqual(self.suggested(1), [4, 5, 6])
+        self.assertEqual(Suggestion.query.filter_by(user_id=self.ids[1],
+                                                    suggested_id=self.ids[5]).one().score, 2)
+        self.assertEqual(self.suggested(3), [])
+        self.assertEqual(SuggestionRefresh.query.count(), 0)
+
+    def test_neighborhood(self):
+        """ Does a user's neighborhood give the same suggestions as the whole graph? """
+
+        whole = FollowGraph.build(Follows.pairs())
+        some = [self.ids[3]]
+        part = suggestions.neighborhood(some)
+
+        self.assertLess(part.edges, whole.edges)
+        self.assertEqual(suggestions.compute(part, some), suggestions.compute(whole, some))
+
+    def test_routes_mark(self):
+        """ Do follows mark the user, and do suggestions show in the sidebar? """
+
+        suggestions.refresh(full=True)
+        db.session.commit()
+
+        me = self.ids[1]
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = me
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn("Who to follow", html)
+            self.assertIn(f'action="/users/follow/{self.ids[4]}"', html)
+
+            c.post(f"/users/follow/{self.ids[4]}")
+            self.assertEqual([r.user_id for r in SuggestionRefresh.query], [me])
+
+            # already followed, so hidden before the next refresh
+            html = c.get("/").get_data(as_text=True)
+            self.assertNotIn(f'action="/users/follow/{self.ids[4]}"', html)
+            self.assertIn(f'action="/users/follow/{self.ids[5]}"', html)
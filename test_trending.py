@@ -0,0 +1,171 @@
+"""Trending hashtag tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_trending.py
+
+
+import os
+from unittest import TestCase
+
+import trending
+from trending import CountMinSketch, Candidates, TrendingTracker, cells
+from models import db, User, TrendingBucket
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from caching import user_cache
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class SketchTestCase(TestCase):
+    """Tests the count-min sketch and candidate set."""
+
+    def test_hashtags(self):
+        """ Are hashtags found once each, lowercased? """
+
+        self.assertEqual(trending.hashtags("#Flask and #flask, #SQL! x"),
+                         ['#flask', '#sql'])
+
+    def test_sketch(self):
+        """ Are estimates exact for a few tags, and do they survive a round trip? """
+
+        sketch = CountMinSketch()
+        for tag, times in [('#a', 3), ('#b', 1)]:
+            for _ in range(times):
+                sketch.add(cells(tag))
+
+        copy = CountMinSketch.from_bytes(sketch.to_bytes())
+        self.assertEqual(copy.estimate(cells('#a')), 3)
+        self.assertEqual(copy.estimate(cells('#b')), 1)
+        self.assertEqual(copy.estimate(cells('#c')), 0)
+
+        copy.update(sketch, -1)
+        self.assertEqual(copy.estimate(cells('#a')), 0)
+
+    def test_candidates(self):
+        """ Does a stronger tag push out the weakest candidate? """
+
+        candidates = Candidates(2)
+        candidates.offer('#a', 3)
+        candidates.offer('#b', 1)
+        candidates.offer('#c', 1)
+        candidates.offer('#d', 2)
+
+        self.assertEqual(candidates.top(5), [('#a', 3), ('#d', 2)])
+
+
+class TrackerTestCase(TestCase):
+    """Tests sliding windows and checkpoints."""
+
+    def setUp(self):
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+
+        self.clock = Clock()
+
+    def tracker(self):
+        return TrendingTracker(bucket_seconds=60, windows={'5m': 300, '1h': 3600},
+                               candidates=10, clock=self.clock)
+
+    def test_windows(self):
+        """ Do buckets slide out of each window in turn? """
+
+        tracker = self.tracker()
+        tracker.add(['#old', '#both'])
+
+        self.clock.now = 250
+        tracker.add(['#both'])
+        self.assertEqual(tracker.top('5m', 5), [('#both', 2), ('#old', 1)])
+
+        self.clock.now = 300
+        self.assertEqual(tracker.top('5m', 5), [('#both', 1)])
+        self.assertEqual(tracker.top('1h', 5), [('#both', 2), ('#old', 1)])
+
+        self.clock.now = 3600
+        self.assertEqual(tracker.top('1h', 5), [('#both', 1)])
+
+        self.clock.now = 10000
+        self.assertEqual(tracker.top('1h', 5), [])
+
+    def test_checkpoint(self):
+        """ Are counts saved, restored, and merged between processes? """
+
+        first = self.tracker()
+        first.add(['#a', '#b'])
+        first.add(['#a'])
+        self.assertEqual(first.checkpoint(), 1)
+        self.assertEqual(first.checkpoint(), 0)
+
+        second = self.tracker()
+        second.restore()
+        self.assertEqual(second.top('5m', 5), [('#a', 2), ('#b', 1)])
+
+        second.add(['#b', '#c'])
+        second.checkpoint()
+
+        first.add(['#c'])
+        first.checkpoint()
+        self.assertEqual(first.top('5m', 5), [('#a', 2), ('#b', 2), ('#c', 2)])
+
+        # buckets older than the longest window are dropped
+        self.clock.now = 3600
+        first.checkpoint()
+        self.assertEqual(TrendingBucket.query.count(), 0)
+
+
+class TrendingViewsTestCase(TestCase):
+    """Tests the trending panel and endpoint."""
+
+    def setUp(self):
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+        user_cache.clear()
+        trending.reset()
+
+        user = User.signup(username="testuser", email="test@test.com",
+                           password="testuser", image_url=None)
+        db.session.commit()
+        self.user_id = user.id
+
+        app.config['TRENDING'] = True
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['TRENDING'] = False
+        trending.reset()
+
+    def test_trending(self):
+        """ Do posted hashtags show in the panel and the API? """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            c.post("/messages/new", data={"text": "Loving #Flask"})
+            c.post("/messages/new", data={"text": "#flask and #python"})
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn('href="/messages/search?q=%23flask"', html)
+
+            resp = c.get("/api/v1/trending?window=24h")
+            self.assertEqual(resp.get_json(), {'data': [{'tag': '#flask', 'count': 2},
+                                                        {'tag': '#python', 'count': 1}]})
+
+            resp = c.get("/api/v1/trending?window=1y")
+            self.assertEqual(resp.status_code, 400)
@@ -6,9 +6,15 @@
 
 
 import os
-from unittest import TestCase
+import threading
+import time
+from unittest import TestCase, mock
 
-from models import db, User, Message, Follows
+from flask import g
+from werkzeug.exceptions import ServiceUnavailable
+
+import passwords
+from models import db, User, Message, Follows, Likes
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -37,6 +43,7 @@ class UserModelTestCase(TestCase):
         
         db.session.rollback()
 
+        Likes.query.delete()
         User.query.delete()
         Message.query.delete()
         Follows.query.delete()
@@ -87,6 +94,38 @@ class UserModelTestCase(TestCase):
         self.assertTrue(following_user.is_following(followed_user))
         
 
+    def test_follow_checks_in_request(self):
+        """ Are the current user's follow checks answered from one cached load? """
+
+        followed_user = User(
+            email = "tester1@testcase.com",
+            username = "followed_testuser",
+            password = "HASHED_PASSWORD"
+        )
+
+        following_user = User(
+            email = "tester2@testcase.com",
+            username = "following_testuser",
+            password = "ANOTHER_HASHED_PASSWORD"
+        )
+
+        db.session.add_all([followed_user, following_user])
+        followed_user.followers.append(following_user)
+
+        db.session.commit()
+
+        with app.test_request_context():
+            g.user = following_user
+
+            self.assertTrue(following_user.is_following(followed_user))
+            self.assertFalse(following_user.is_followed_by(followed_user))
+            self.assertEqual(g.following_ids, {following_user.id: {followed_user.id}})
+
+            # followers are never loaded; each check is an EXISTS query
+            self.assertTrue(followed_user.is_followed_by(following_user))
+            self.assertNotIn(followed_user.id, g.following_ids)
+
+
     def test_unfollow(self):
         """ Deos unfollowing work? """
         
@@ -189,4 +228,139 @@ class UserModelTestCase(TestCase):
         user = User.signup(username=correct_username, email=email, password=password, image_url=image_url)
         
         self.assertFalse(user.authenticate(incorrect_username, password))
-        
\ No newline at end of file
+        
+        
+        
+    #######################################################################################
+    # Test denormalized counters
+
+    def test_reconcile_counts(self):
+        """ Does reconcile_counts repair counters that have drifted? """
+
+        u1 = User(
+            email="test@domain.com",
+            username="testuser",
+            password="HASHED_PASSWORD"
+        )
+
+        u2 = User(
+            email="test2@domain.com",
+            username="testuser2",
+            password="HASHED_PASSWORD"
+        )
+
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        msg = Message(text="Counted", user_id=u1.id)
+        db.session.add(msg)
+        u1.followers.append(u2)
+        u2.likes.append(msg)
+        db.session.commit()
+
+        self.assertEqual(User.reconcile_counts(batch_size=1), 2)
+        db.session.commit()
+
+        self.assertEqual((u1.messages_count, u1.followers_count, u1.following_count), (1, 1, 0))
+        self.assertEqual((u2.following_count, u2.likes_count), (1, 1))
+
+        self.assertEqual(User.reconcile_counts(), 0)
+        
+        
+    def test_release_counts(self):
+        """ Does a deleted user's departure update only the counters it touches? """
+
+        users = [User(email=f"test{i}@domain.com", username=f"testuser{i}",
+                      password="HASHED_PASSWORD") for i in range(4)]
+        db.session.add_all(users)
+        db.session.commit()
+
+        leaving, fan, reader, bystander = users
+        messages = [Message(text=f"Counted {i}", user_id=leaving.id) for i in range(2)]
+        db.session.add_all(messages)
+        db.session.commit()
+
+        fan.likes.extend(messages)
+        reader.likes.append(messages[0])
+        leaving.likes.append(messages[1])
+        leaving.followers.append(fan)
+        User.reconcile_counts()
+        bystander.likes_count = 5
+        db.session.commit()
+
+        User.release_counts(leaving.id)
+        db.session.commit()
+
+        self.assertEqual((fan.likes_count, fan.following_count), (0, 0))
+        self.assertEqual(reader.likes_count, 0)
+        self.assertEqual(bystander.likes_count, 5)
+
+
+    def test_authentication_upgrades_hash(self):
+        """ Is a hash with an outdated work factor replaced on successful login? """
+
+        user = User.signup(username="testuser",
+                           email="test@domain.com",
+                           password="PASSWORD",
+                           image_url=None)
+        db.session.commit()
+
+        self.assertEqual(passwords.hash_rounds(user.password), app.config["BCRYPT_LOG_ROUNDS"])
+
+        user.password = passwords.bcrypt.generate_password_hash("PASSWORD", 4).decode("UTF-8")
+        db.session.commit()
+
+        self.assertFalse(User.authenticate("testuser", "WRONG"))
+        self.assertEqual(passwords.hash_rounds(user.password), 4)
+
+        self.assertEqual(User.authenticate("testuser", "PASSWORD"), user)
+        self.assertEqual(passwords.hash_rounds(user.password), app.config["BCRYPT_LOG_ROUNDS"])
+        self.assertTrue(user.check_password("PASSWORD"))
+
+    def test_calibrate_rounds(self):
+        """ Does calibration stay within its bounds? """
+
+        self.assertEqual(passwords.calibrate_rounds(0), 4)
+        self.assertEqual(passwords.calibrate_rounds(60, max_rounds=5), 5)
+
+    def test_hashing_is_bounded(self):
+        """ Do no more than PASSWORD_HASH_WORKERS hashes run at once? """
+
+        running = []
+        most = []
+        lock = threading.Lock()
+
+        def hash_slowly():
+            with lock:
+                running.append(1)
+                most.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.pop()
+
+        threads = [threading.Thread(target=passwords._run, args=(hash_slowly,))
+                   for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(max(most), app.config["PASSWORD_HASH_WORKERS"])
+
+    def test_hashing_off_request_thread(self):
+        """ Do hashes run on the pool, and does a caller stop waiting at the timeout? """
+
+        self.assertNotEqual(passwords._run(threading.get_ident), threading.get_ident())
+
+        release = threading.Event()
+        busy = [passwords._pool.submit(release.wait)
+                for _ in range(app.config["PASSWORD_HASH_WORKERS"])]
+
+        try:
+            with mock.patch.object(passwords, "_timeout", 0.05):
+                with self.assertRaises(ServiceUnavailable):
+                    passwords._run(passwords.hash_rounds, "$2b$04$")
+        finally:
+            release.set()
+            for future in busy:
+                future.result()
@@ -2,9 +2,13 @@
 # FLASK_ENV=production python -m unittest test_message_views.py
 
 from app import app, CURR_USER_KEY
+from caching import user_cache, fragment_cache, like_cache
 import os
-from unittest import TestCase
-from models import db, connect_db, Message, User
+from datetime import datetime, timedelta
+from unittest import TestCase, mock
+from models import db, connect_db, Message, User, Likes, TimelineEntry
+from search import search_users
+import writebehind
 from app import app
 
 os.environ["DATABASE_URL"] = "postgresql:///warbler-test"
@@ -27,6 +31,10 @@ class UserViewTestCase(TestCase):
         db.drop_all()
         db.create_all()
 
+        user_cache.clear()
+        fragment_cache.clear()
+        like_cache.clear()
+
         self.client = app.test_client()
 
         self.testuser = User.signup(username="testuser",
@@ -50,6 +58,59 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn(member, container)
 
+    def test_list_users_search(self):
+        """ Are search results ranked and bounded? """
+
+        for username, bio in [("atestuser", None),
+                              ("testuser_two", None),
+                              ("someone", "Just testuser things"),
+                              ("nobody", None)]:
+            User.signup(username=username,
+                        email=f"{username}@test.com",
+                        password="testuser",
+                        image_url=None).bio = bio
+
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get("/users?q=testuser")
+            html = resp.get_data(as_text=True)
+
+            found = [name for name in ["testuser_two", "atestuser", "someone"]
+                     if f"<p>@{name}</p>" in html]
+            self.assertEqual(len(found), 3)
+            self.assertNotIn("<p>@nobody</p>", html)
+
+            order = [html.index(f"<p>@{name}</p>")
+                     for name in ["testuser", "testuser_two", "atestuser", "someone"]]
+            self.assertEqual(order, sorted(order))
+
+            self.assertEqual([u.username for u in search_users("testuser", limit=1)],
+                             ["testuser"])
+
+            resp = c.get("/users?q=%25")
+            self.assertIn("Sorry, no users found", resp.get_data(as_text=True))
+
+    def test_list_users_short_search(self):
+        """ Do terms too short for substring search match username prefixes only? """
+
+        for username, bio in [("te", None),
+                              ("Tea", None),
+                              ("atestuser", None),
+                              ("someone", "te")]:
+            User.signup(username=username,
+                        email=f"{username}@test.com",
+                        password="testuser",
+                        image_url=None).bio = bio
+
+        db.session.commit()
+
+        self.assertEqual([u.username for u in search_users("TE")],
+                         ["te", "Tea", "testuser"])
+        self.assertEqual([u.username for u in search_users("te", limit=2)],
+                         ["te", "Tea"])
+        self.assertEqual(search_users("_"), [])
+
     def test_users_show(self):
         """ Does showing a specific user work? """
 
@@ -64,6 +125,38 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn(member, container)
 
+    def test_users_show_pagination(self):
+        """ Can older messages be reached through the next-page cursor? """
+
+        start = datetime(2020, 1, 1)
+        for i in range(3):
+            db.session.add(Message(text=f"Message {i}",
+                                   user_id=self.testuser.id,
+                                   timestamp=start + timedelta(minutes=i)))
+        db.session.commit()
+
+        testuser_id = self.testuser.id
+
+        with self.client as c, mock.patch("app.TIMELINE_PAGE_SIZE", 2):
+            resp = c.get(f"/users/{testuser_id}")
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("<p>Message 2</p>", html)
+            self.assertIn("<p>Message 1</p>", html)
+            self.assertNotIn("<p>Message 0</p>", html)
+            self.assertIn('id="older-messages"', html)
+
+            cursor = html.split("?before=")[1].split('"')[0]
+            resp = c.get(f"/users/{testuser_id}?before={cursor}")
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("<p>Message 0</p>", html)
+            self.assertNotIn("<p>Message 1</p>", html)
+            self.assertNotIn('id="older-messages"', html)
+
+            resp = c.get(f"/users/{testuser_id}?before=garbage")
+            self.assertEqual(resp.status_code, 400)
+
     def test_show_following(self):
         """ Does the request respond with a list of people that testuser is following?"""
 
@@ -160,6 +253,91 @@ class UserViewTestCase(TestCase):
                 resp.location, f"http://localhost/users/{testuser.id}/following")
             self.assertEqual(len(testuser.following), 0)
 
+    def test_follow_updates_counters(self):
+        """ Do following, liking and posting keep the counters current? """
+
+        followed_user = User.signup(username="testuser2",
+                                    email="test2@test.com",
+                                    password="testuser",
+                                    image_url=None)
+
+        db.session.commit()
+
+        testuser_id = self.testuser.id
+        followed_id = followed_user.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            c.post(f"/users/follow/{followed_id}")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = followed_id
+
+            c.post("/messages/new", data={"text": "Counted"})
+            msg = Message.query.one()
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            c.post(f"/users/add_like/{msg.id}")
+
+            testuser = User.query.get(testuser_id)
+            followed_user = User.query.get(followed_id)
+
+            self.assertEqual(testuser.following_count, 1)
+            self.assertEqual(testuser.likes_count, 1)
+            self.assertEqual(followed_user.followers_count, 1)
+            self.assertEqual(followed_user.messages_count, 1)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = followed_id
+
+            c.post(f"/messages/{msg.id}/delete")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            c.post(f"/users/stop-following/{followed_id}")
+
+            testuser = User.query.get(testuser_id)
+            followed_user = User.query.get(followed_id)
+
+            self.assertEqual(testuser.following_count, 0)
+            self.assertEqual(testuser.likes_count, 0)
+            self.assertEqual(followed_user.followers_count, 0)
+            self.assertEqual(followed_user.messages_count, 0)
+
+    def test_follow_updates_timeline(self):
+        """ Does following copy messages into the timeline, and unfollowing remove them? """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            followed_user = User.signup(username="testuser2",
+                                        email="test2@test.com",
+                                        password="testuser",
+                                        image_url=None)
+
+            db.session.commit()
+
+            msg = Message(text="Backfilled", user_id=followed_user.id)
+
+            db.session.add(msg)
+            db.session.commit()
+
+            c.post(f"/users/follow/{followed_user.id}")
+
+            entry = TimelineEntry.query.one()
+            self.assertEqual(entry.user_id, self.testuser.id)
+            self.assertEqual(entry.message_id, msg.id)
+
+            c.post(f"/users/stop-following/{followed_user.id}")
+
+            self.assertEqual(TimelineEntry.query.count(), 0)
+
     def test_show_likes(self):
         """ Should show a list of logged in users liked messages """
 
@@ -203,6 +381,191 @@ class UserViewTestCase(TestCase):
             resp.location, f"http://localhost/users/{self.testuser.id}/likes")
         self.assertEqual(len(testuser.likes), 1)
 
+    def test_home_like_buttons(self):
+        """ Are liked messages marked from the page's ids, and refreshed after a toggle? """
+
+        author = User.signup(username="author",
+                             email="author@test.com",
+                             password="PASSWORD",
+                             image_url=None)
+        db.session.commit()
+
+        testuser_id = self.testuser.id
+        author_id = author.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            c.post(f"/users/follow/{author_id}")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = author_id
+
+            c.post("/messages/new", data={"text": "Liked"})
+            c.post("/messages/new", data={"text": "Not liked"})
+            liked_id = Message.query.filter_by(text="Liked").one().id
+            other_id = Message.query.filter_by(text="Not liked").one().id
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertNotIn("btn-primary", html)
+            self.assertEqual(like_cache.get(testuser_id)[1], {liked_id: False, other_id: False})
+
+            c.post(f"/users/add_like/{liked_id}")
+            self.assertIsNone(like_cache.get(testuser_id))
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertEqual(html.count("btn-primary"), 1)
+            self.assertEqual(like_cache.get(testuser_id)[1], {liked_id: True, other_id: False})
+
+            c.post(f"/users/add_like/{liked_id}")
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertNotIn("btn-primary", html)
+            self.assertEqual(User.query.get(testuser_id).likes_count, 0)
+
+            # a like made by another process, which can't clear this one's cache
+            db.session.add(Likes(user_id=testuser_id, message_id=other_id))
+            User.adjust_counts(testuser_id, likes=1)
+            db.session.commit()
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertEqual(html.count("btn-primary"), 1)
+
+    def test_add_like_conflict(self):
+        """ Is a like inserted by a concurrent toggle taken as done rather than a 500? """
+
+        msg = Message(text="Raced", user_id=self.testuser.id)
+        db.session.add(msg)
+        db.session.commit()
+        testuser_id = self.testuser.id
+        msg_id = msg.id
+
+        db.session.add(Likes(user_id=testuser_id, message_id=msg_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            # the other toggle's insert lands between our delete and insert
+            with mock.patch("flask_sqlalchemy.BaseQuery.delete", return_value=0):
+                resp = c.post(f"/users/add_like/{msg_id}")
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(Likes.query.filter_by(user_id=testuser_id).count(), 1)
+        self.assertEqual(User.query.get(testuser_id).likes_count, 0)
+
+    def test_write_behind_toggles(self):
+        """ Are queued toggles coalesced, visible to their user, and written on flush? """
+
+        author = User.signup(username="author",
+                             email="author@test.com",
+                             password="PASSWORD",
+                             image_url=None)
+        db.session.commit()
+
+        testuser_id = self.testuser.id
+        author_id = author.id
+
+        msg = Message(text="Queued", user_id=author_id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        app.config["WRITE_BEHIND"] = True
+        app.config["WRITE_BEHIND_INTERVAL"] = 3600
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = testuser_id
+
+                c.post(f"/users/follow/{author_id}")
+                for _ in range(3):
+                    c.post(f"/users/add_like/{msg_id}")
+
+                self.assertEqual(len(writebehind.queue), 2)
+                self.assertEqual(Likes.query.count(), 0)
+                self.assertFalse(User.query.get(testuser_id).following)
+
+                html = c.get(f"/users/{testuser_id}/following").get_data(as_text=True)
+                self.assertIn("@author", html)
+
+                html = c.get(f"/users/{testuser_id}/likes").get_data(as_text=True)
+                self.assertIn("Queued", html)
+
+                html = c.get(f"/users/{author_id}").get_data(as_text=True)
+                self.assertIn("Unfollow", html)
+
+                c.post(f"/users/stop-following/{author_id}")
+                c.post(f"/users/follow/{author_id}")
+
+                with app.app_context():
+                    self.assertEqual(writebehind.queue.flush(), 2)
+
+                testuser = User.query.get(testuser_id)
+                self.assertEqual([u.id for u in testuser.following], [author_id])
+                self.assertEqual([m.id for m in testuser.likes], [msg_id])
+                self.assertEqual((testuser.following_count, testuser.likes_count), (1, 1))
+                self.assertEqual(User.query.get(author_id).followers_count, 1)
+                self.assertEqual(TimelineEntry.query.filter_by(user_id=testuser_id).count(), 1)
+
+                c.post(f"/users/add_like/{msg_id}")
+                c.post(f"/users/add_like/{msg_id}")
+                self.assertEqual(len(writebehind.queue), 0)
+        finally:
+            app.config["WRITE_BEHIND"] = False
+            app.config["WRITE_BEHIND_INTERVAL"] = writebehind.WRITE_BEHIND_INTERVAL
+
+    def test_write_behind_conditional_get(self):
+        """ Do queued toggles that cancel out in the counters still change the ETag? """
+
+        author = User.signup(username="author",
+                             email="author@test.com",
+                             password="PASSWORD",
+                             image_url=None)
+        db.session.commit()
+        author.followers.append(self.testuser)
+        m1 = Message(text="First", user_id=author.id)
+        m2 = Message(text="Second", user_id=author.id)
+        db.session.add_all([m1, m2])
+        db.session.commit()
+        db.session.add(Likes(user_id=self.testuser.id, message_id=m1.id))
+        User.reconcile_counts()
+        TimelineEntry.rebuild()
+        db.session.commit()
+
+        testuser_id = self.testuser.id
+        m1_id, m2_id = m1.id, m2.id
+
+        app.config["WRITE_BEHIND"] = True
+        app.config["WRITE_BEHIND_INTERVAL"] = 3600
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = testuser_id
+
+                home_etag = c.get("/").headers["ETag"]
+
+                c.post(f"/users/add_like/{m2_id}")
+                c.post(f"/users/add_like/{m1_id}")
+                c.get(f"/users/{testuser_id}/likes")  # shows the flashed messages
+
+                resp = c.get("/", headers={"If-None-Match": home_etag})
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.get_data(as_text=True).count("btn-primary"), 1)
+
+                with app.app_context():
+                    writebehind.queue.flush()
+        finally:
+            app.config["WRITE_BEHIND"] = False
+            app.config["WRITE_BEHIND_INTERVAL"] = writebehind.WRITE_BEHIND_INTERVAL
+
     def test_GET_profile(self):
         """ Does this GET route show a form? """
 
@@ -247,3 +610,101 @@ class UserViewTestCase(TestCase):
 
             self.assertEqual(resp.status_code, 302)
             self.assertEqual(len(User.query.all()), 0)
+
+    def test_current_user_snapshot_is_cached(self):
+        """ Is the logged in user loaded once, then refreshed after a profile change? """
+
+        testuser_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            c.get("/users")
+            snapshot = user_cache.get(testuser_id)
+            self.assertEqual(snapshot.username, "testuser")
+
+            c.get(f"/users/{testuser_id}")
+            self.assertIs(user_cache.get(testuser_id), snapshot)
+
+            c.post("/users/profile", data={"username": "renamed",
+                                           "password": "testuser"})
+            self.assertIsNone(user_cache.get(testuser_id))
+
+            c.get("/users")
+            self.assertEqual(user_cache.get(testuser_id).username, "renamed")
+
+    def test_users_show_conditional_get(self):
+        """ Is an unchanged profile answered with a 304, and a changed one re-rendered? """
+
+        followed_user = User.signup(username="testuser2",
+                                    email="test2@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        db.session.commit()
+
+        testuser_id = self.testuser.id
+        followed_id = followed_user.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            resp = c.get(f"/users/{followed_id}")
+            etag = resp.headers["ETag"]
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("private", resp.headers["Cache-Control"])
+            self.assertIn("Cookie", resp.headers["Vary"])
+
+            resp = c.get(f"/users/{followed_id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b"")
+
+            c.post(f"/users/follow/{followed_id}")
+
+            resp = c.get(f"/users/{followed_id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers["ETag"], etag)
+
+            etag = resp.headers["ETag"]
+            c.post("/users/profile", data={"username": "renamed", "password": "testuser"})
+            c.get("/users")  # shows the flashed message
+
+            # the navbar shows the viewer's new name
+            resp = c.get(f"/users/{followed_id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("renamed", resp.get_data(as_text=True))
+
+    def test_home_conditional_get_sees_renamed_authors(self):
+        """ Is the home page re-rendered when an author on it changes their profile? """
+
+        author = User.signup(username="author",
+                             email="author@test.com",
+                             password="PASSWORD",
+                             image_url=None)
+        db.session.commit()
+        author.followers.append(self.testuser)
+        db.session.add(Message(text="Stamped", user_id=author.id))
+        db.session.commit()
+        TimelineEntry.rebuild()
+        db.session.commit()
+
+        testuser_id = self.testuser.id
+        author_id = author.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            etag = c.get("/").headers["ETag"]
+            self.assertEqual(c.get("/", headers={"If-None-Match": etag}).status_code, 304)
+
+            author = User.query.get(author_id)
+            author.username = "renamed-author"
+            author.updated_at = datetime.utcnow() + timedelta(seconds=1)
+            db.session.commit()
+
+            resp = c.get("/", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("renamed-author", resp.get_data(as_text=True))
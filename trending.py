@@ -0,0 +1,432 @@
+"""Trending hashtags for Warbler.
+
+Each new message's hashtags are counted in memory as it's posted, so
+trending never queries `messages`. Time is cut into buckets of
+TRENDING_BUCKET_SECONDS, and each bucket counts tags in a count-min
+sketch: DEPTH rows of WIDTH counters, each tag adding one to a hashed
+counter per row and estimated as the smallest of them. The sketch is
+a fixed 16 KB however many distinct tags come through. Its estimates can
+only be too high, and only by a little for the tags that matter.
+
+Each window in TRENDING_WINDOWS (e.g. the last hour) keeps a running
+sketch of its buckets. A bucket's sketch is subtracted as the bucket
+slides out. Each window also keeps its TRENDING_CANDIDATES best tags
+with their estimates. A new tag replaces the weakest candidate once its
+estimate beats it. Reading a window's top tags only sorts those
+candidates, however busy the site is.
+
+Every TRENDING_CHECKPOINT_SECONDS a background thread adds the counts
+taken since the last checkpoint to the trending_buckets table, one row
+per bucket. It reads back the totals, which include other processes'
+counts. A restarted process loads the buckets of its longest window
+from there instead of starting cold.
+"""
+
+import atexit
+import hashlib
+import json
+import struct
+import threading
+import time
+from array import array
+
+from flask import current_app, has_app_context
+
+from models import db, TrendingBucket, tokenize
+
+SKETCH_WIDTH = 1024
+SKETCH_DEPTH = 4
+
+TRENDING_BUCKET_SECONDS = 300
+TRENDING_WINDOWS = {'1h': 3600, '24h': 86400}
+TRENDING_CANDIDATES = 50
+TRENDING_CHECKPOINT_SECONDS = 60
+
+
+def hashtags(text):
+    """The distinct #hashtags in `text`, lowercased."""
+
+    return sorted(term for term in tokenize(text) if term.startswith('#'))
+
+
+def cells(tag):
+    """The counter each sketch row uses for `tag`."""
+
+    digest = hashlib.blake2b(tag.encode(), digest_size=4 * SKETCH_DEPTH).digest()
+    hashes = struct.unpack(f'<{SKETCH_DEPTH}I', digest)
+
+    return [row * SKETCH_WIDTH + h % SKETCH_WIDTH for row, h in enumerate(hashes)]
+
+
+class CountMinSketch:
+    """Approximate counts of tags in a fixed SKETCH_DEPTH x SKETCH_WIDTH table."""
+
+    def __init__(self, counts=None):
+        self.counts = counts if counts is not None else array('i', [0]) * (SKETCH_WIDTH
+                                                                            * SKETCH_DEPTH)
+
+    def add(self, tag_cells, count=1):
+        for cell in tag_cells:
+            self.counts[cell] += count
+
+    def estimate(self, tag_cells):
+        return min(self.counts[cell] for cell in tag_cells)
+
+    def update(self, other, sign=1):
+        """Add (or with `sign` -1, subtract) `other`'s counts."""
+
+        counts = self.counts
+        for cell, count in enumerate(other.counts):
+            if count:
+                counts[cell] += sign * count
+
+    def copy(self):
+        return CountMinSketch(array('i', self.counts))
+
+    def to_bytes(self):
+        return self.counts.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        counts = array('i')
+        counts.frombytes(data)
+        return cls(counts)
+
+
+class Candidates:
+    """The best `size` tags seen, with their estimated counts."""
+
+    def __init__(self, size):
+        self.size = size
+        self.counts = {}
+
+    def offer(self, tag, count):
+        if tag in self.counts or len(self.counts) < self.size:
+            self.counts[tag] = count
+            return
+
+        weakest = min(self.counts, key=self.counts.get)
+        if count > self.counts[weakest]:
+            del self.counts[weakest]
+            self.counts[tag] = count
+
+    def rescore(self, sketch):
+        """Re-estimate every candidate from `sketch`, dropping those now at zero."""
+
+        estimates = {tag: sketch.estimate(cells(tag)) for tag in self.counts}
+        self.counts = {tag: count for tag, count in estimates.items() if count > 0}
+
+    def top(self, limit):
+        """[(tag, count), ...] of the best `limit`, highest count first."""
+
+        return sorted(self.counts.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+
+class _Bucket:
+    def __init__(self, size):
+        self.sketch = CountMinSketch()
+        self.candidates = Candidates(size)
+        # counts taken since the last checkpoint
+        self.unsaved = None
+
+
+class _Window:
+    def __init__(self, span, size):
+        # how many buckets, up to and including the current one
+        self.span = span
+        self.sketch = CountMinSketch()
+        self.candidates = Candidates(size)
+
+
+class TrendingTracker:
+    """Hashtag counts over sliding windows of time buckets.
+
+    `clock` returns the time in seconds; tests pass their own.
+    """
+
+    def __init__(self, bucket_seconds=TRENDING_BUCKET_SECONDS, windows=TRENDING_WINDOWS,
+                 candidates=TRENDING_CANDIDATES, clock=time.time):
+        self.bucket_seconds = bucket_seconds
+        self.size = candidates
+        self.clock = clock
+        self.windows = {name: _Window(max(1, seconds // bucket_seconds), candidates)
+                        for name, seconds in windows.items()}
+        self.span = max(window.span for window in self.windows.values())
+
+        self._buckets = {}
+        self._current = None
+        self._lock = threading.Lock()
+
+    def _now(self):
+        return int(self.clock() // self.bucket_seconds)
+
+    def _bucket(self, index):
+        bucket = self._buckets.get(index)
+        if bucket is None:
+            bucket = self._buckets[index] = _Bucket(self.size)
+        return bucket
+
+    def _windows_holding(self, index):
+        return [window for window in self.windows.values()
+                if self._current - window.span < index <= self._current]
+
+    def _advance(self):
+        """Slide every window up to the current bucket."""
+
+        now = self._now()
+        if self._current is not None and now <= self._current:
+            return
+
+        previous, self._current = self._current, now
+
+        if previous is None or now - previous >= self.span:
+            for window in self.windows.values():
+                window.sketch = CountMinSketch()
+                window.candidates = Candidates(self.size)
+        else:
+            for window in self.windows.values():
+                for index in range(previous - window.span + 1, now - window.span + 1):
+                    bucket = self._buckets.get(index)
+                    if bucket is not None:
+                        window.sketch.update(bucket.sketch, -1)
+                window.candidates.rescore(window.sketch)
+
+        for index in [index for index in self._buckets if index <= now - self.span]:
+            del self._buckets[index]
+
+    def add(self, tags):
+        """Count one use of each of `tags` now."""
+
+        with self._lock:
+            self._advance()
+            bucket = self._bucket(self._current)
+            if bucket.unsaved is None:
+                bucket.unsaved = CountMinSketch()
+
+            for tag in tags:
+                tag_cells = cells(tag)
+                bucket.sketch.add(tag_cells)
+                bucket.unsaved.add(tag_cells)
+                bucket.candidates.offer(tag, bucket.sketch.estimate(tag_cells))
+
+                for window in self.windows.values():
+                    window.sketch.add(tag_cells)
+                    window.candidates.offer(tag, window.sketch.estimate(tag_cells))
+
+    def top(self, window, limit):
+        """[(tag, count), ...] of the `limit` top tags in `window`."""
+
+        with self._lock:
+            self._advance()
+            return self.windows[window].candidates.top(limit)
+
+    ##########################################################################
+    # Checkpoints
+
+    def _merge(self, index, total):
+        """Make bucket `index` hold `total` plus counts taken since it was read."""
+
+        bucket = self._bucket(index)
+        if bucket.unsaved is not None:
+            total.update(bucket.unsaved)
+
+        windows = self._windows_holding(index)
+        for window in windows:
+            window.sketch.update(bucket.sketch, -1)
+            window.sketch.update(total)
+
+        tags = list(bucket.candidates.counts)
+        bucket.sketch = total
+        bucket.candidates.rescore(total)
+
+        for tag in tags:
+            tag_cells = cells(tag)
+            bucket.candidates.offer(tag, total.estimate(tag_cells))
+            for window in windows:
+                window.candidates.offer(tag, window.sketch.estimate(tag_cells))
+
+        for window in windows:
+            window.candidates.rescore(window.sketch)
+
+    def checkpoint(self):
+        """Add the counts taken since the last checkpoint to the database.
+
+        Needs an app context; commits. Returns how many buckets were saved.
+        """
+
+        with self._lock:
+            self._advance()
+            unsaved = [(index, bucket.unsaved, list(bucket.candidates.counts))
+                       for index, bucket in self._buckets.items()
+                       if bucket.unsaved is not None]
+            for index, _, _ in unsaved:
+                self._buckets[index].unsaved = None
+            oldest = self._current - self.span + 1
+
+        totals = {}
+
+        try:
+            for index, counts, tags in unsaved:
+                totals[index] = _save_bucket(index, counts, tags, self.size)
+
+            (TrendingBucket.query
+                .filter(TrendingBucket.bucket < oldest)
+                .delete(synchronize_session=False))
+            db.session.commit()
+
+        except Exception:
+            db.session.rollback()
+            with self._lock:
+                for index, counts, _ in unsaved:
+                    bucket = self._bucket(index)
+                    if bucket.unsaved is None:
+                        bucket.unsaved = counts
+                    else:
+                        bucket.unsaved.update(counts)
+            raise
+
+        with self._lock:
+            for index, total in totals.items():
+                if index > self._current - self.span:
+                    self._merge(index, total)
+
+        return len(unsaved)
+
+    def restore(self):
+        """Load the buckets of the longest window from the database."""
+
+        with self._lock:
+            self._advance()
+            rows = TrendingBucket.query.filter(TrendingBucket.bucket > self._current - self.span)
+
+            for row in rows:
+                sketch = CountMinSketch.from_bytes(row.sketch)
+                self._merge(row.bucket, sketch)
+
+                for tag in json.loads(row.tags):
+                    tag_cells = cells(tag)
+                    self._buckets[row.bucket].candidates.offer(tag, sketch.estimate(tag_cells))
+                    for window in self._windows_holding(row.bucket):
+                        window.candidates.offer(tag, window.sketch.estimate(tag_cells))
+
+    ##########################################################################
+    # Background checkpoints
+
+    def start(self, app):
+        """Restore from the database, then checkpoint every TRENDING_CHECKPOINT_SECONDS."""
+
+        self.restore()
+
+        threading.Thread(target=self._run, args=(app,), name='trending', daemon=True).start()
+        atexit.register(self._checkpoint_in, app)
+
+    def _run(self, app):
+        while True:
+            time.sleep(app.config['TRENDING_CHECKPOINT_SECONDS'])
+            self._checkpoint_in(app)
+
+    def _checkpoint_in(self, app):
+        with app.app_context():
+            try:
+                self.checkpoint()
+            except Exception:
+                app.logger.exception("Trending checkpoint failed; will retry.")
+            finally:
+                db.session.remove()
+
+
+def _save_bucket(index, counts, tags, size):
+    """Add `counts` to the stored bucket `index`; returns the new totals."""
+
+    row = TrendingBucket.query.filter_by(bucket=index).with_for_update().first()
+
+    if row is None:
+        row = TrendingBucket(bucket=index)
+        db.session.add(row)
+        total, stored_tags = counts.copy(), []
+    else:
+        total, stored_tags = CountMinSketch.from_bytes(row.sketch), json.loads(row.tags)
+        total.update(counts)
+
+    candidates = Candidates(size)
+    for tag in dict.fromkeys(stored_tags + tags):
+        candidates.offer(tag, total.estimate(cells(tag)))
+
+    row.sketch = total.to_bytes()
+    row.tags = json.dumps([tag for tag, _ in candidates.top(size)])
+
+    return total
+
+
+##############################################################################
+# The process's tracker
+
+
+class _State:
+    tracker = None
+
+
+_state = _State()
+_lock = threading.Lock()
+
+
+def get_tracker():
+    """This process's tracker, or None if TRENDING is off.
+
+    Restored from the database on first use.
+    """
+
+    if not (has_app_context() and current_app.config.get('TRENDING')):
+        return None
+
+    if _state.tracker is None:
+        with _lock:
+            if _state.tracker is None:
+                config = current_app.config
+                tracker = TrendingTracker(config['TRENDING_BUCKET_SECONDS'],
+                                          config['TRENDING_WINDOWS'],
+                                          config['TRENDING_CANDIDATES'])
+                tracker.start(current_app._get_current_object())
+                _state.tracker = tracker
+
+    return _state.tracker
+
+
+def record(text):
+    """Count the hashtags of a message just posted."""
+
+    tags = hashtags(text)
+    tracker = get_tracker() if tags else None
+
+    if tracker is not None:
+        tracker.add(tags)
+
+
+def trending(window=None, limit=10):
+    """[(tag, count), ...] of the `limit` top tags in `window`, or [] if TRENDING is off.
+
+    `window` names one of TRENDING_WINDOWS, by default the first.
+    """
+
+    tracker = get_tracker()
+    if tracker is None:
+        return []
+
+    return tracker.top(window or next(iter(tracker.windows)), limit)
+
+
+def reset():
+    """Forget the tracker; the next use restores one from the database."""
+
+    with _lock:
+        _state.tracker = None
+
+
+def init_app(app):
+    """Set the trending defaults."""
+
+    app.config.setdefault('TRENDING', False)
+    app.config.setdefault('TRENDING_BUCKET_SECONDS', TRENDING_BUCKET_SECONDS)
+    app.config.setdefault('TRENDING_WINDOWS', TRENDING_WINDOWS)
+    app.config.setdefault('TRENDING_CANDIDATES', TRENDING_CANDIDATES)
+    app.config.setdefault('TRENDING_CHECKPOINT_SECONDS', TRENDING_CHECKPOINT_SECONDS)
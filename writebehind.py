@@ -0,0 +1,404 @@
+"""Write-behind batching of like and follow toggles.
+
+With WRITE_BEHIND on, add_like, add_follow and stop_following don't
+write anything: they record the state the user asked for in an
+in-process queue and return. Toggling the same like (or follow) again
+before a flush just overwrites the queued state, and a toggle that
+lands back where the database already is drops out of the queue.
+
+A background thread flushes the queue every WRITE_BEHIND_INTERVAL
+seconds, or as soon as WRITE_BEHIND_BATCH_SIZE toggles are waiting, as
+a single transaction: one batched insert and one delete per table, one
+counter update per distinct delta, plus the timeline backfills, purges
+and suggestion refresh marks of changed follows. Whatever is still
+queued is flushed when the process exits normally.
+
+Until a flush, the acting user reads their own writes: `load_pending`
+lays their queued toggles over their like buttons, follow buttons,
+counters, likes page and following page. Everyone else sees the change
+(and the acting user's home timeline fills in) after the flush.
+"""
+
+import atexit
+import copy
+import threading
+from collections import Counter, defaultdict
+
+from flask import current_app, g
+
+import followgraph
+from caching import forget_user, forget_likes
+from models import db, User, Message, Follows, Likes, TimelineEntry, SuggestionRefresh
+
+# longest a toggle waits in the queue, in seconds
+WRITE_BEHIND_INTERVAL = 0.5
+
+# queued toggles that trigger a flush straight away
+WRITE_BEHIND_BATCH_SIZE = 500
+
+LIKE = 'like'
+FOLLOW = 'follow'
+
+
+def enabled():
+    return current_app.config['WRITE_BEHIND']
+
+
+class WriteBehindQueue:
+    """Toggles waiting to be written, keyed by (kind, user_id, target_id).
+
+    Each value is (was, wanted): the state in the database when the
+    toggle was first queued, and the state last asked for.
+    """
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _queue(self, kind, user_id, target_id, wanted, current):
+        """Ask for `wanted`; `current` finds the stored state if it isn't queued yet."""
+
+        key = (kind, user_id, target_id)
+
+        with self._lock:
+            entry = self._pending.get(key)
+
+        stored = entry[0] if entry else current()
+
+        with self._lock:
+            # another request may have queued this toggle in the meantime
+            was = self._pending.get(key, (stored,))[0]
+
+            if wanted == was:
+                self._pending.pop(key, None)
+            else:
+                self._pending[key] = (was, wanted)
+
+            full = len(self._pending) >= current_app.config['WRITE_BEHIND_BATCH_SIZE']
+
+        self._start(current_app._get_current_object())
+        if full:
+            self._wake.set()
+
+    def toggle_like(self, user_id, message_id):
+        """Queue a like or unlike, whichever flips the user's current state."""
+
+        liked = self.state(LIKE, user_id, message_id)
+        if liked is None:
+            liked = bool(Likes.liked_ids(user_id, [message_id]))
+
+        self._queue(LIKE, user_id, message_id, not liked, lambda: liked)
+
+    def set_follow(self, user_id, followed_id, following):
+        """Queue a follow (or, with `following` False, an unfollow)."""
+
+        def current():
+            return bool(Follows.query.get((followed_id, user_id)))
+
+        self._queue(FOLLOW, user_id, followed_id, following, current)
+
+    def state(self, kind, user_id, target_id):
+        """The queued state of a toggle, or None if nothing is queued."""
+
+        with self._lock:
+            entry = self._pending.get((kind, user_id, target_id))
+
+        return entry and entry[1]
+
+    def pending(self, user_id):
+        """{(kind, target_id): (was, wanted)} of everything `user_id` has queued."""
+
+        with self._lock:
+            return {(kind, target_id): entry
+                    for (kind, queued_by, target_id), entry in self._pending.items()
+                    if queued_by == user_id}
+
+    ##########################################################################
+    # Flushing
+
+    def flush(self):
+        """Write everything queued so far in one transaction.
+
+        Needs an app context. Returns how many toggles were flushed. On a
+        failure, toggles that haven't been queued again are put back.
+        """
+
+        with self._lock:
+            batch, self._pending = self._pending, {}
+
+        if not batch:
+            return 0
+
+        likes = {(user_id, target_id): wanted
+                 for (kind, user_id, target_id), (was, wanted) in batch.items()
+                 if kind == LIKE}
+        follows = {(user_id, target_id): wanted
+                   for (kind, user_id, target_id), (was, wanted) in batch.items()
+                   if kind == FOLLOW}
+
+        follow_changes = []
+
+        try:
+            changed = self._write_likes(likes) | self._write_follows(follows, follow_changes)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            with self._lock:
+                for key, entry in batch.items():
+                    self._pending.setdefault(key, entry)
+            raise
+
+        forget_user(*changed)
+        for follower_id, followed_id, following in follow_changes:
+            followgraph.record(follower_id, followed_id, following)
+        for user_id, _ in likes:
+            forget_likes(user_id)
+
+        return len(batch)
+
+    def _write_likes(self, wanted):
+        """Apply wanted like states; returns the ids of users whose counts changed."""
+
+        if not wanted:
+            return set()
+
+        existing = _existing_pairs(Likes.user_id, Likes.message_id, wanted)
+        live = _existing_ids(Message, {message_id for _, message_id in wanted})
+
+        added = [pair for pair, like in wanted.items()
+                 if like and pair not in existing and pair[1] in live]
+        removed = [pair for pair, like in wanted.items()
+                   if not like and pair in existing]
+
+        if added:
+            db.session.execute(Likes.__table__.insert(),
+                               [dict(user_id=user_id, message_id=message_id)
+                                for user_id, message_id in added])
+        if removed:
+            (Likes.query
+                .filter(_pairs_filter(Likes.user_id, Likes.message_id, removed))
+                .delete(synchronize_session=False))
+
+        likes = Counter(user_id for user_id, _ in added)
+        likes.subtract(user_id for user_id, _ in removed)
+        _adjust_counts('likes', likes)
+
+        return set(likes)
+
+    def _write_follows(self, wanted, changes):
+        """Apply wanted follow states; returns the ids of users whose counts changed.
+
+        Appends (follower_id, followed_id, following) to `changes` for each
+        follow actually made or removed.
+        """
+
+        if not wanted:
+            return set()
+
+        existing = _existing_pairs(Follows.user_following_id,
+                                   Follows.user_being_followed_id, wanted)
+        live = _existing_ids(User, {user_id for pair in wanted for user_id in pair})
+
+        added = [pair for pair, follow in wanted.items()
+                 if follow and pair not in existing and set(pair) <= live]
+        removed = [pair for pair, follow in wanted.items()
+                   if not follow and pair in existing]
+
+        if added:
+            db.session.execute(Follows.__table__.insert(),
+                               [dict(user_following_id=user_id, user_being_followed_id=followed_id)
+                                for user_id, followed_id in added])
+        if removed:
+            (Follows.query
+                .filter(_pairs_filter(Follows.user_following_id,
+                                      Follows.user_being_followed_id, removed))
+                .delete(synchronize_session=False))
+
+        following, followers = Counter(), Counter()
+        for user_id, followed_id in added:
+            following[user_id] += 1
+            followers[followed_id] += 1
+            TimelineEntry.backfill(user_id, followed_id)
+            changes.append((user_id, followed_id, True))
+        for user_id, followed_id in removed:
+            following[user_id] -= 1
+            followers[followed_id] -= 1
+            TimelineEntry.purge(user_id, followed_id)
+            changes.append((user_id, followed_id, False))
+
+        _adjust_counts('following', following)
+        _adjust_counts('followers', followers)
+        SuggestionRefresh.request(*sorted({user_id for user_id, _ in added + removed}))
+
+        return set(following) | set(followers)
+
+    ##########################################################################
+    # Background flushing
+
+    def _start(self, app):
+        """Start the flushing thread, once per process."""
+
+        if self._thread is not None:
+            return
+
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, args=(app,),
+                                                name='write-behind', daemon=True)
+                self._thread.start()
+                atexit.register(self._flush_in, app)
+
+    def _run(self, app):
+        while True:
+            self._wake.wait(app.config['WRITE_BEHIND_INTERVAL'])
+            self._wake.clear()
+            self._flush_in(app)
+
+    def _flush_in(self, app):
+        with app.app_context():
+            try:
+                self.flush()
+            except Exception:
+                app.logger.exception("Write-behind flush failed; will retry.")
+            finally:
+                db.session.remove()
+
+
+queue = WriteBehindQueue()
+
+
+def _pairs_filter(user_col, target_col, pairs):
+    """SQL matching the (user, target) `pairs`, grouped by user."""
+
+    by_user = defaultdict(list)
+    for user_id, target_id in pairs:
+        by_user[user_id].append(target_id)
+
+    return db.or_(*(db.and_(user_col == user_id, target_col.in_(target_ids))
+                    for user_id, target_ids in by_user.items()))
+
+
+def _existing_pairs(user_col, target_col, pairs):
+    rows = (db.session
+            .query(user_col, target_col)
+            .filter(_pairs_filter(user_col, target_col, pairs)))
+
+    return set(rows)
+
+
+def _existing_ids(model, ids):
+    return {row_id for (row_id,) in db.session.query(model.id).filter(model.id.in_(ids))}
+
+
+def _adjust_counts(counter, deltas):
+    """One counter update per distinct delta in {user_id: delta}."""
+
+    by_delta = defaultdict(list)
+    for user_id, delta in deltas.items():
+        if delta:
+            by_delta[delta].append(user_id)
+
+    for delta, user_ids in by_delta.items():
+        User.adjust_counts(user_ids, **{counter: delta})
+
+
+##############################################################################
+# Reading your own writes
+
+
+def load_pending():
+    """Lay the current user's queued toggles over what this request reads.
+
+    Sets g.pending_likes and g.pending_follows ({target_id: wanted}) and
+    swaps g.user for a copy with counters that include the queued changes.
+    """
+
+    if not (g.user and enabled()):
+        return
+
+    pending = queue.pending(g.user.id)
+    if not pending:
+        return
+
+    g.pending_likes = {target_id: wanted for (kind, target_id), (was, wanted)
+                       in pending.items() if kind == LIKE}
+    g.pending_follows = {target_id: wanted for (kind, target_id), (was, wanted)
+                         in pending.items() if kind == FOLLOW}
+
+    user = copy.copy(g.user)
+    for (kind, _), (was, wanted) in pending.items():
+        counter = 'likes_count' if kind == LIKE else 'following_count'
+        setattr(user, counter, getattr(user, counter) + wanted - was)
+    g.user = user
+
+
+def pending_stamp():
+    """The current user's queued toggles, for mixing into page validators.
+
+    Queued toggles can cancel out in the counters (a like and an unlike
+    of different messages), so the pages' other stamps can't see them.
+    """
+
+    return (sorted(g.get('pending_likes', {}).items()),
+            sorted(g.get('pending_follows', {}).items()))
+
+
+def overlay_liked(liked, message_ids):
+    """`liked`, a set of message ids, corrected for the current user's queued likes."""
+
+    pending = g.get('pending_likes')
+    if not pending:
+        return liked
+
+    liked = set(liked)
+    for message_id in message_ids:
+        if message_id in pending:
+            (liked.add if pending[message_id] else liked.discard)(message_id)
+
+    return liked
+
+
+def _split(pending):
+    added = [target_id for target_id, wanted in pending.items() if wanted]
+    removed = [target_id for target_id, wanted in pending.items() if not wanted]
+    return added, removed
+
+
+def overlay_likes_query(query):
+    """Query for the current user's liked messages, with queued likes applied."""
+
+    pending = g.get('pending_likes')
+    if not pending:
+        return query
+
+    added, removed = _split(pending)
+
+    return (query
+            .filter(~Message.id.in_(removed))
+            .union(Message.query.filter(Message.id.in_(added))))
+
+
+def overlay_following(following):
+    """The current user's followed users, with queued follows applied."""
+
+    pending = g.get('pending_follows')
+    if not pending:
+        return following
+
+    added, removed = _split(pending)
+    following = [user for user in following if user.id not in removed]
+
+    return following + User.query.filter(User.id.in_(added)).all()
+
+
+def init_app(app):
+    """Set the write-behind defaults; it stays off unless WRITE_BEHIND is set."""
+
+    app.config.setdefault('WRITE_BEHIND', False)
+    app.config.setdefault('WRITE_BEHIND_INTERVAL', WRITE_BEHIND_INTERVAL)
+    app.config.setdefault('WRITE_BEHIND_BATCH_SIZE', WRITE_BEHIND_BATCH_SIZE)